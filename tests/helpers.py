@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from django.core.mail.backends.locmem import EmailBackend
+
+
+class FlakyEmailBackend(EmailBackend):
+    """
+    A locmem email backend which fails the first ``failures`` sends.
+    """
+    failures = 1
+
+    def send_messages(self, messages):
+        if FlakyEmailBackend.failures > 0:
+            FlakyEmailBackend.failures -= 1
+            raise IOError('Connection refused')
+        return super(FlakyEmailBackend, self).send_messages(messages)
+
+
+class UnreachableEmailBackend(EmailBackend):
+    """
+    A locmem email backend which can't connect the first ``failures`` times.
+    """
+    failures = 1
+
+    def open(self):
+        if UnreachableEmailBackend.failures > 0:
+            UnreachableEmailBackend.failures -= 1
+            raise IOError('Connection refused')
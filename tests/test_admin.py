@@ -1,14 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+from unittest import skipUnless
+
 from django.contrib.admin.sites import AdminSite
 from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.messages.storage.fallback import FallbackStorage
 from django.core import mail
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
 from django.test.client import RequestFactory
-from django.test.utils import override_settings
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import six
 
-from users.admin import UserAdmin
+from example.models import Customer
+from users.admin import UserAdmin, UserModelFilter
 
 
 class AdminTest(TestCase):
@@ -62,3 +69,259 @@ class AdminTest(TestCase):
 
     def tearDown(self):
         self.client.logout()
+
+
+class UserModelFilterTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        get_user_model().objects.create_user('user@example.com', 'pa$sw0Rd')
+        self.request = RequestFactory().get('/admin')
+        self.user_admin = UserAdmin(get_user_model(), AdminSite())
+
+    def lookups(self):
+        user_filter = UserModelFilter(self.request, {}, get_user_model(), self.user_admin)
+        return user_filter.lookup_choices
+
+    def test_lookups(self):
+        user_type = ContentType.objects.get_for_model(get_user_model())
+        self.assertEqual(self.lookups(), [(user_type.id, user_type.name)])
+
+    def test_lookups_are_cached(self):
+        self.lookups()
+        with self.assertNumQueries(0):
+            self.lookups()
+
+    def test_lookups_are_invalidated_by_new_user_type(self):
+        self.lookups()
+        # another user of a known type keeps the cache
+        get_user_model().objects.create_user('user1@example.com', 'pa$sw0Rd')
+        with self.assertNumQueries(0):
+            self.lookups()
+
+        Customer.objects.create_user('customer@example.com', 'cu$t0meR')
+        user_type = ContentType.objects.get_for_model(Customer)
+        self.assertIn((user_type.id, user_type.name), self.lookups())
+
+    def test_lookups_are_invalidated_by_deleted_users(self):
+        customer = Customer.objects.create_user('customer@example.com', 'cu$t0meR')
+        user_type = ContentType.objects.get_for_model(Customer)
+        self.assertIn((user_type.id, user_type.name), self.lookups())
+        customer.delete()
+        self.assertNotIn((user_type.id, user_type.name), self.lookups())
+
+
+def explain(queryset):
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN QUERY PLAN %s' % sql, params)
+        return ' '.join(row[-1] for row in cursor.fetchall())
+
+
+def get_changelist(admin, **params):
+    request = RequestFactory().get('/admin/users/user/', params)
+    request.user = get_user_model()(is_superuser=True, is_active=True)
+    return admin.get_changelist(request)(
+        request, admin.model, admin.list_display, admin.list_display_links,
+        admin.list_filter, admin.date_hierarchy, admin.search_fields,
+        admin.list_select_related, admin.list_per_page, admin.list_max_show_all,
+        admin.list_editable, admin)
+
+
+class ChangeListPerformanceTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        manager = get_user_model().base_objects
+        manager.bulk_create_users(
+            {'email': 'user%d@example.com' % i, 'is_active': bool(i % 3),
+             'is_staff': not i % 50} for i in range(600))
+        Customer.base_objects.bulk_create_users(
+            {'email': 'customer%d@example.com' % i} for i in range(20))
+        self.user_admin = UserAdmin(get_user_model(), AdminSite())
+
+    def changelist(self, **params):
+        return get_changelist(self.user_admin, **params)
+
+    def test_query_count(self):
+        self.changelist()
+        with self.assertNumQueries(3):
+            changelist = self.changelist(is_active__exact=0)
+            self.assertEqual(len(changelist.result_list), 100)
+        self.assertEqual(changelist.result_count, 200)
+
+    @skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is sqlite specific')
+    def test_filters_use_indexes(self):
+        user_type = ContentType.objects.get_for_model(Customer)
+        for params in ({'is_active__exact': 0}, {'is_staff__exact': 1},
+                       {'is_superuser__exact': 0}, {'user_type': user_type.id}):
+            plan = explain(self.changelist(**params).queryset)
+            # the narrowed columns may even be read from the index alone
+            six.assertRegex(self, plan, 'USING (COVERING )?INDEX users_user_', params)
+            self.assertNotIn('TEMP B-TREE', plan, params)
+
+    @skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is sqlite specific')
+    def test_prefix_search(self):
+        # icontains scans the table ...
+        changelist = self.changelist(q='USER1')
+        self.assertEqual(changelist.result_count, 111)
+        self.assertIn('SCAN', explain(changelist.queryset))
+
+        # ... the prefix search matches the start of normalized_email, which
+        # PostgreSQL (with its *_like index) and MySQL read from an index.
+        with self.settings(USERS_ADMIN_PREFIX_SEARCH=True):
+            changelist = self.changelist(q='USER1')
+            self.assertEqual(changelist.result_count, 111)
+            self.assertIn('"users_user"."normalized_email" LIKE', str(changelist.queryset.query))
+            self.assertEqual(self.changelist(q=' ').result_count, 620)
+
+    def test_prefix_search_matches_any_character(self):
+        get_user_model().base_objects.bulk_create_users([
+            {'email': u'user1\U0001f600@example.com'}, {'email': u'user1_x@example.com'}])
+        with self.settings(USERS_ADMIN_PREFIX_SEARCH=True):
+            self.assertEqual(self.changelist(q='user1').result_count, 113)
+            self.assertEqual(
+                [user.email for user in self.changelist(q=u'user1\U0001f600').result_list],
+                [u'user1\U0001f600@example.com'])
+            self.assertEqual(self.changelist(q='user1_').result_count, 1)
+
+
+@override_settings(USERS_ADMIN_FAST_PAGINATION=True, USERS_ADMIN_EXACT_COUNT_THRESHOLD=100)
+class FastPaginationTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        get_user_model().base_objects.bulk_create_users(
+            {'email': 'user%03d@example.com' % i, 'is_active': i < 150} for i in range(250))
+        self.user_admin = UserAdmin(get_user_model(), AdminSite())
+        self.user_admin.list_per_page = 20
+
+    def changelist(self, **params):
+        return get_changelist(self.user_admin, **params)
+
+    def emails(self, changelist):
+        return [user.email for user in changelist.result_list]
+
+    def test_counts_below_threshold_are_exact(self):
+        changelist = self.changelist(is_active__exact=0)
+        self.assertEqual(changelist.result_count, 100)
+        self.assertFalse(changelist.result_count_is_estimate)
+
+    def test_counts_above_threshold_are_cached(self):
+        changelist = self.changelist(is_active__exact=1)
+        self.assertEqual(changelist.result_count, 150)
+        self.assertTrue(changelist.result_count_is_estimate)
+
+        get_user_model().base_objects.bulk_create_users([{'email': 'new@example.com'}])
+        with CaptureQueriesContext(connection) as context:
+            changelist = self.changelist(is_active__exact=1)
+        self.assertEqual(changelist.result_count, 150)
+        # neither count scanned the whole table
+        counts = [q['sql'] for q in context.captured_queries if 'COUNT(' in q['sql']]
+        self.assertEqual(len(counts), 2)
+        self.assertTrue(all('LIMIT 101' in sql for sql in counts))
+
+    def test_keyset_pagination(self):
+        changelist = self.changelist()
+        self.assertEqual(changelist.keyset_field, 'email')
+        self.assertEqual(self.emails(changelist)[-1], 'user019@example.com')
+        self.assertIsNone(changelist.previous_page_url)
+        self.assertEqual(changelist.next_page_url, '?after=user019%40example.com')
+
+        with self.assertNumQueries(3):
+            changelist = self.changelist(after='user019@example.com')
+            self.assertEqual(self.emails(changelist)[0], 'user020@example.com')
+        self.assertEqual(changelist.previous_page_url, '?before=user020%40example.com')
+        self.assertEqual(changelist.next_page_url, '?after=user039%40example.com')
+        # cursors are not kept by filter and ordering links
+        self.assertEqual(changelist.get_query_string({'o': '1'}), '?o=1')
+
+        changelist = self.changelist(before='user020@example.com')
+        self.assertEqual(len(self.emails(changelist)), 20)
+        self.assertEqual(self.emails(changelist)[0], 'user000@example.com')
+        self.assertIsNone(changelist.previous_page_url)
+
+        changelist = self.changelist(after='user239@example.com')
+        self.assertEqual(len(self.emails(changelist)), 10)
+        self.assertIsNone(changelist.next_page_url)
+
+    def test_keyset_pagination_with_filters_and_descending_order(self):
+        changelist = self.changelist(is_active__exact=0, o='-0', after='user200@example.com')
+        self.assertEqual(changelist.keyset_field, '-email')
+        self.assertEqual(self.emails(changelist)[0], 'user199@example.com')
+        self.assertEqual(self.emails(changelist)[-1], 'user180@example.com')
+        self.assertIn('is_active__exact=0', changelist.next_page_url)
+
+    @skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is sqlite specific')
+    def test_keyset_page_uses_index(self):
+        changelist = self.changelist(is_active__exact=1, after='user100@example.com')
+        self.assertEqual(self.emails(changelist)[0], 'user101@example.com')
+        plan = explain(changelist.queryset.filter(email__gt='user100@example.com'))
+        self.assertIn('(is_active=? AND email>?)', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_numbered_pages(self):
+        changelist = self.changelist(p='3')
+        self.assertEqual(self.emails(changelist)[0], 'user060@example.com')
+        self.assertEqual(changelist.previous_page_url, '?before=user060%40example.com')
+
+    def test_non_unique_ordering_uses_numbered_pages(self):
+        changelist = self.changelist(o='1', p='1')
+        self.assertIsNone(changelist.keyset_field)
+        self.assertEqual(len(self.emails(changelist)), 20)
+        self.assertIsNone(changelist.next_page_url)
+
+
+class CustomerAdmin(UserAdmin):
+    list_display = ('email', 'first_name', 'is_active')
+
+
+class ChangeListColumnsTest(TestCase):
+
+    def setUp(self):
+        Customer.objects.create_user('customer@example.com', first_name='Jane', last_name='Doe')
+        get_user_model().objects.create_user('user@example.com', is_active=False)
+
+    def select_columns(self, queryset):
+        sql = str(queryset.query)
+        return sql[len('SELECT '):sql.index(' FROM ')].split(', ')
+
+    def test_list_display_columns(self):
+        user_admin = UserAdmin(get_user_model(), AdminSite())
+        changelist = get_changelist(user_admin)
+        self.assertEqual(self.select_columns(changelist.queryset), [
+            '"users_user"."id"', '"users_user"."email"', '"users_user"."is_active"'])
+        users = list(changelist.result_list)
+        with self.assertNumQueries(0):
+            self.assertEqual([(user.email, user.is_active) for user in users],
+                             [('customer@example.com', True), ('user@example.com', False)])
+        # change views get full rows
+        request = RequestFactory().get('/admin/users/user/1/change/')
+        self.assertEqual(user_admin.get_queryset(request).query.deferred_loading, (set(), True))
+
+    def test_wide_subclass_table_columns(self):
+        customer_admin = CustomerAdmin(Customer, AdminSite())
+        changelist = get_changelist(customer_admin)
+        self.assertEqual(self.select_columns(changelist.queryset), [
+            '"users_user"."email"', '"users_user"."is_active"',
+            '"example_customer"."user_ptr_id"', '"example_customer"."first_name"'])
+        users = list(changelist.result_list)
+        with self.assertNumQueries(0):
+            self.assertEqual([user.first_name for user in users], ['Jane'])
+
+    def test_callable_list_display_loads_full_rows(self):
+        customer_admin = CustomerAdmin(Customer, AdminSite())
+        customer_admin.list_display = ('email', 'get_full_name')
+        changelist = get_changelist(customer_admin)
+        self.assertIn('"example_customer"."last_name"', self.select_columns(changelist.queryset))
+
+    @override_settings(USERS_VERIFY_EMAIL=True)
+    def test_send_activation_email_action_loads_full_rows(self):
+        user_admin = UserAdmin(get_user_model(), AdminSite())
+        request = RequestFactory().post('/admin/users/user/')
+        setattr(request, 'session', 'session')
+        setattr(request, '_messages', FallbackStorage(request))
+        queryset = get_changelist(user_admin).get_queryset(request)
+        with self.assertNumQueries(1):
+            user_admin.send_activation_email(request, queryset)
+        self.assertEqual(len(mail.outbox), 1)
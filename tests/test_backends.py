@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from unittest import skipUnless
+
+from django.contrib.auth import authenticate, get_user_model
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from example.models import Customer
+from users.backends import EmailBackend
+from users.managers import user_cache_version_key
+
+
+def explain(queryset):
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN QUERY PLAN %s' % sql, params)
+        return ' '.join(row[-1] for row in cursor.fetchall())
+
+
+@override_settings(AUTHENTICATION_BACKENDS=['users.backends.EmailBackend'])
+class EmailBackendTest(TestCase):
+
+    user_email = 'User@Example.com'
+    user_password = 'pa$sw0Rd'
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(self.user_email, self.user_password)
+
+    def test_authenticate_is_case_insensitive(self):
+        for username in ('User@Example.com', 'user@example.com', 'USER@EXAMPLE.COM'):
+            self.assertEqual(
+                authenticate(username=username, password=self.user_password), self.user)
+
+    def test_authenticate_with_wrong_password(self):
+        self.assertIsNone(authenticate(username=self.user_email, password='wrong'))
+        self.assertIsNone(authenticate(username='unknown@example.com', password='wrong'))
+
+    def test_inactive_users_cannot_authenticate(self):
+        self.user.is_active = False
+        self.user.save()
+        self.assertIsNone(authenticate(username=self.user_email, password=self.user_password))
+
+    def test_authenticate_downcasts_user(self):
+        Customer.objects.create_user('customer@example.com', 'cu$t0meR')
+        user = authenticate(username='Customer@example.com', password='cu$t0meR')
+        self.assertIsInstance(user, Customer)
+
+    def test_authenticate_uses_a_single_base_table_query(self):
+        with self.assertNumQueries(1):
+            authenticate(username=self.user_email, password=self.user_password)
+
+
+class NormalizedEmailLookupTest(TestCase):
+
+    def setUp(self):
+        get_user_model().objects.bulk_create([
+            get_user_model()(email='user%d@example.com' % i,
+                             normalized_email='user%d@example.com' % i)
+            for i in range(1000)])
+
+    @skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is sqlite specific')
+    def test_normalized_email_lookup_uses_index(self):
+        # iexact has to scan the whole table ...
+        plan = explain(get_user_model().base_objects.filter(email__iexact='USER500@example.com'))
+        self.assertIn('SCAN', plan)
+        # ... while the normalized lookup is an index search
+        plan = explain(get_user_model().base_objects.filter(
+            normalized_email=get_user_model().base_objects.normalize_email_case(
+                'USER500@example.com')))
+        self.assertIn('USING INDEX', plan)
+        self.assertNotIn('SCAN', plan)
+
+
+@override_settings(AUTHENTICATION_BACKENDS=['users.backends.EmailBackend'])
+class CachedUserTest(TestCase):
+
+    user_email = 'user@example.com'
+    user_password = 'pa$sw0Rd'
+
+    def setUp(self):
+        cache.clear()
+        self.user = Customer.objects.create_user(self.user_email, self.user_password)
+        self.assertTrue(self.client.login(username=self.user_email, password=self.user_password))
+        self.url = reverse('users_password_change')
+        self.backend = EmailBackend()
+
+    def test_authenticated_request_queries(self):
+        # base table + customer table on the first request ...
+        with self.assertNumQueries(3):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsInstance(response.context['user'], Customer)
+        # ... only the session afterwards
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+        self.assertEqual(response.context['user'], self.user)
+
+    @override_settings(USERS_USER_CACHE_TIMEOUT=0)
+    def test_cache_disabled(self):
+        self.client.get(self.url)
+        with self.assertNumQueries(3):
+            self.client.get(self.url)
+
+    def test_save_invalidates_cached_user(self):
+        self.backend.get_user(self.user.pk)
+        self.user.first_name = 'Jane'
+        self.user.save()
+        with self.assertNumQueries(2):
+            self.assertEqual(self.backend.get_user(self.user.pk).first_name, 'Jane')
+
+    def test_password_change_logs_out_other_sessions(self):
+        self.client.get(self.url)
+        self.user.set_password('n3w-pa$sw0Rd')
+        self.user.save()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 302)
+
+    def test_deactivated_and_deleted_users_are_not_served(self):
+        self.backend.get_user(self.user.pk)
+        self.user.is_active = False
+        self.user.save()
+        self.assertIsNone(self.backend.get_user(self.user.pk))
+
+        self.user.is_active = True
+        self.user.save()
+        self.assertIsNotNone(self.backend.get_user(self.user.pk))
+        self.user.delete()
+        self.assertIsNone(self.backend.get_user(self.user.pk))
+
+    def test_bulk_activate_invalidates_cached_users(self):
+        user = get_user_model().objects.create_user('inactive@example.com', is_active=False)
+        self.assertIsNone(self.backend.get_user(user.pk))
+        get_user_model().base_objects.bulk_activate([user.pk])
+        self.assertEqual(self.backend.get_user(user.pk), user)
+
+    def test_password_hash_is_not_cached(self):
+        self.backend.get_user(self.user.pk)
+        keys = [key for key in cache._cache if 'users.user.%s.' % self.user.pk in key]
+        self.assertEqual(len(keys), 1)
+        self.assertNotIn(self.user.password.encode('utf-8'), cache._cache[keys[0]])
+
+        user = self.backend.get_user(self.user.pk)
+        self.assertNotIn('password', user.__dict__)
+        with self.assertNumQueries(0):
+            self.assertEqual(user.get_session_auth_hash(), self.user.get_session_auth_hash())
+        # loaded when needed
+        with self.assertNumQueries(1):
+            self.assertTrue(user.check_password(self.user_password))
+
+    def test_saving_cached_user_keeps_password(self):
+        self.backend.get_user(self.user.pk)
+        user = self.backend.get_user(self.user.pk)
+        user.first_name = 'Jane'
+        user.save()
+        self.assertTrue(Customer.objects.get(pk=self.user.pk).check_password(self.user_password))
+
+        user = self.backend.get_user(self.user.pk)
+        user.set_password('n3w-pa$sw0Rd')
+        self.assertNotEqual(user.get_session_auth_hash(), self.user.get_session_auth_hash())
+
+
+@override_settings(AUTHENTICATION_BACKENDS=['users.backends.EmailBackend'])
+class CachedUserTransactionTest(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('user@example.com', 'pa$sw0Rd')
+        self.backend = EmailBackend()
+
+    def test_invalidated_again_on_commit(self):
+        version_key = user_cache_version_key(self.user.pk)
+        with transaction.atomic():
+            self.user.is_active = False
+            self.user.save()
+            # cached (from the old row, for a concurrent request) before the commit
+            self.backend.get_user(self.user.pk)
+            self.assertIsNotNone(cache.get(version_key))
+        self.assertIsNone(cache.get(version_key))
+
+    def test_bulk_activate_and_delete_invalidate_on_commit(self):
+        version_key = user_cache_version_key(self.user.pk)
+        for change in (lambda: get_user_model().base_objects.bulk_activate([self.user.pk]),
+                       self.user.delete):
+            self.user.is_active = False
+            self.user.save()
+            with transaction.atomic():
+                change()
+                cache.set(version_key, 'stale')
+            self.assertIsNone(cache.get(version_key))
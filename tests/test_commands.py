@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import csv
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.utils import timezone
+from django.utils.six import StringIO
+
+try:
+    from unittest import mock
+except ImportError:  # pragma: no cover
+    import mock
+
+from example.models import Customer
+
+
+class ImportUsersCommandTest(TestCase):
+
+    def write(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        return path
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_import_csv(self):
+        path = self.write('users.csv', u'email,password,is_staff\n'
+                                       u'User1@Example.com,pa$sw0Rd1,1\n'
+                                       u'user2@example.com,,\n')
+        out = StringIO()
+        call_command('import_users', path, processes=2, stdout=out)
+        self.assertIn('Imported 2 users', out.getvalue())
+
+        user = get_user_model().objects.get(normalized_email='user1@example.com')
+        self.assertTrue(user.check_password('pa$sw0Rd1'))
+        self.assertTrue(user.is_staff)
+        user = get_user_model().objects.get(email='user2@example.com')
+        self.assertFalse(user.has_usable_password())
+        self.assertFalse(user.is_staff)
+
+    def test_import_jsonl_hashed(self):
+        password = make_password('pa$sw0Rd')
+        path = self.write('users.jsonl', u'{"email": "user@example.com", "password": "%s"}\n\n'
+                                         u'{"email": "user2@example.com"}\n' % password)
+        call_command('import_users', path, hashed=True, batch_size=1,
+                     model='example.Customer', stdout=StringIO())
+        user = Customer.objects.get(email='user@example.com')
+        self.assertEqual(user.password, password)
+        self.assertFalse(Customer.objects.get(email='user2@example.com').has_usable_password())
+
+    def test_import_ignores_derived_columns(self):
+        path = self.write('users.csv', u'email,normalized_email,user_type,user_type_id\n'
+                                       u'User@Example.com,other@example.com,example.Customer,%d\n'
+                                       % ContentType.objects.get_for_model(Customer).pk)
+        call_command('import_users', path, processes=1, stdout=StringIO())
+        user = get_user_model().objects.get()
+        self.assertEqual(user.normalized_email, 'user@example.com')
+        self.assertEqual(user.user_type, ContentType.objects.get_for_model(get_user_model()))
+
+    @unittest.skipUnless(hasattr(multiprocessing, 'get_context'), 'Python 2 always forks')
+    def test_pool_workers_are_forked(self):
+        # spawned workers wouldn't have the settings to hash passwords with
+        path = self.write('users.csv', u'email,password\nuser@example.com,pa$sw0Rd\n')
+        with mock.patch('multiprocessing.get_context', wraps=multiprocessing.get_context) as get_context:
+            call_command('import_users', path, processes=2, stdout=StringIO())
+        get_context.assert_called_once_with('fork')
+        self.assertTrue(get_user_model().objects.get().check_password('pa$sw0Rd'))
+
+    def test_import_unknown_field(self):
+        path = self.write('users.csv', u'email,nickname\nuser@example.com,joe\n')
+        self.assertRaises(CommandError, call_command, 'import_users', path,
+                          processes=1, stdout=StringIO())
+        self.assertFalse(get_user_model().objects.exists())
+
+    def test_import_unknown_format(self):
+        path = self.write('users.txt', u'')
+        self.assertRaises(CommandError, call_command, 'import_users', path, stdout=StringIO())
+
+
+class ExportUsersCommandTest(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('user@example.com', 'pa$sw0Rd')
+        self.inactive = get_user_model().objects.create_user('inactive@example.com', is_active=False)
+        self.customer = Customer.objects.create_user('customer@example.com', first_name=u'J\xf6rg')
+
+    def export(self, **options):
+        out = StringIO()
+        call_command('export_users', stdout=out, **options)
+        return out.getvalue()
+
+    def test_export_csv(self):
+        with self.assertNumQueries(2):
+            output = self.export(chunk_size=2)
+        rows = list(csv.DictReader(StringIO(output)))
+        self.assertEqual([row['email'] for row in rows],
+                         ['user@example.com', 'inactive@example.com', 'customer@example.com'])
+        self.assertEqual(rows[1]['is_active'], 'False')
+        self.assertEqual(rows[2]['user_type'], 'example.Customer')
+        self.assertNotIn('password', rows[0])
+        self.assertNotIn('first_name', rows[0])
+
+    def test_export_jsonl_with_subclass_fields(self):
+        output = self.export(format='jsonl', subclass_fields=True, passwords=True)
+        rows = [json.loads(line) for line in output.splitlines()]
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0]['password'], self.user.password)
+        self.assertNotIn('first_name', rows[0])
+        self.assertEqual(rows[2]['first_name'], u'J\xf6rg')
+        self.assertEqual(rows[2]['user_type'], 'example.Customer')
+
+    def test_export_filters(self):
+        get_user_model().base_objects.filter(pk=self.user.pk).update(
+            date_joined=timezone.now() - timedelta(days=10))
+
+        def emails(**options):
+            return [json.loads(line)['email']
+                    for line in self.export(format='jsonl', **options).splitlines()]
+
+        self.assertEqual(emails(active=False), ['inactive@example.com'])
+        self.assertEqual(emails(active=True), ['user@example.com', 'customer@example.com'])
+        self.assertEqual(emails(types=['example.Customer']), ['customer@example.com'])
+        before = (timezone.now() - timedelta(days=1)).date().isoformat()
+        self.assertEqual(emails(joined_before=before), ['user@example.com'])
+        self.assertEqual(emails(joined_after=before),
+                         ['inactive@example.com', 'customer@example.com'])
+        self.assertRaises(CommandError, emails, joined_after='yesterday')
+
+    def test_export_to_file(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'users.csv')
+        self.assertIn('Exported 3 users', self.export(output=path, subclass_fields=True))
+
+        out = StringIO()
+        get_user_model().base_objects.all().delete()
+        call_command('import_users', path, model='example.Customer', processes=1, stdout=out)
+        self.assertEqual(Customer.objects.get(email='customer@example.com').first_name, u'J\xf6rg')
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from django.contrib.auth import get_user_model
+from django.contrib.sites.models import Site
+from django.core import mail
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.template.loader import get_template
+from django.utils import translation
+from django.utils.six import StringIO
+
+from tests.helpers import FlakyEmailBackend, UnreachableEmailBackend
+from users import dispatch
+from users.dispatch import (ThreadPoolBackend, clear_email_caches,
+                            get_dispatch_backend)
+from users.models import QueuedActivationEmail
+from users.utils import send_activation_email, send_activation_emails
+
+try:
+    from unittest import mock
+except ImportError:  # pragma: no cover
+    import mock
+
+
+class DispatchBackendTestMixin(object):
+
+    def setUp(self):
+        self.request = RequestFactory().get(reverse('users_register'))
+        self.user = get_user_model().objects.create_user(
+            'user@example.com', 'pa$sw0Rd', is_active=False)
+        FlakyEmailBackend.failures = 1
+        UnreachableEmailBackend.failures = 1
+        # a fresh backend per test, so its stats start at zero
+        dispatch._backends.clear()
+
+
+# the workers query the user, which the test transaction would keep locked
+@override_settings(USERS_VERIFY_EMAIL=True, USERS_EMAIL_DISPATCH_RETRY_DELAY=0,
+                   USERS_EMAIL_DISPATCH_BACKEND='users.dispatch.ThreadPoolBackend')
+class ThreadPoolBackendTest(DispatchBackendTestMixin, TransactionTestCase):
+
+    def test_send_activation_email_is_dispatched_to_workers(self):
+        backend = get_dispatch_backend()
+        self.assertIsInstance(backend, ThreadPoolBackend)
+        send_activation_email(user=self.user, request=self.request)
+        backend.join()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [self.user.email])
+        self.assertIn('/activate/', mail.outbox[0].body)
+        stats = backend.stats()
+        self.assertEqual((stats['sent'], stats['queue_depth']), (1, 0))
+
+    @override_settings(EMAIL_BACKEND='tests.helpers.FlakyEmailBackend')
+    def test_failed_sends_are_retried(self):
+        backend = get_dispatch_backend()
+        send_activation_email(user=self.user, request=self.request)
+        backend.join()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(backend.stats()['retried'], 1)
+
+    @override_settings(EMAIL_BACKEND='tests.helpers.FlakyEmailBackend')
+    def test_retries_dont_block_workers(self):
+        backend = ThreadPoolBackend(workers=1, retry_delay=0.5)
+        other = get_user_model().objects.create_user(
+            'other@example.com', 'pa$sw0Rd', is_active=False)
+        start = time.time()
+        with mock.patch('users.utils.get_dispatch_backend', return_value=backend):
+            send_activation_email(user=self.user, request=self.request)
+            send_activation_email(user=other, request=self.request)
+            # the only worker sends the second email while the first waits
+            while not mail.outbox and time.time() - start < 0.4:
+                time.sleep(0.01)
+            self.assertEqual([message.to for message in mail.outbox], [[other.email]])
+            self.assertEqual(backend.stats()['queue_depth'], 1)
+            backend.join()
+        self.assertGreaterEqual(time.time() - start, 0.5)
+        self.assertEqual(mail.outbox[1].to, [self.user.email])
+        self.assertEqual(backend.stats()['queue_depth'], 0)
+
+    @override_settings(EMAIL_BACKEND='tests.helpers.UnreachableEmailBackend')
+    def test_connection_failures_are_retried(self):
+        backend = get_dispatch_backend()
+        send_activation_email(user=self.user, request=self.request)
+        backend.join()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(backend.stats()['retried'], 1)
+
+        # the workers are still running
+        send_activation_email(user=self.user, request=self.request)
+        backend.join()
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_workers_survive_errors_and_are_replaced(self):
+        backend = get_dispatch_backend()
+        # e.g. the workers of the parent process, lost in a fork
+        dead = threading.Thread(target=lambda: None)
+        dead.start()
+        dead.join()
+        backend._threads = [dead] * backend.workers
+        deliver, calls = backend.deliver, []
+
+        def fail_once(items):
+            calls.append(items)
+            if len(calls) == 1:
+                raise RuntimeError('boom')
+            return deliver(items)
+
+        with mock.patch.object(backend, 'deliver', side_effect=fail_once):
+            send_activation_email(user=self.user, request=self.request)
+            backend.join()
+        self.assertNotIn(dead, backend._threads)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(backend.stats()['retried'], 1)
+
+    def test_emails_are_queued_on_commit(self):
+        backend = get_dispatch_backend()
+        try:
+            with transaction.atomic():
+                send_activation_email(user=self.user, request=self.request)
+                self.assertEqual(backend.stats()['queue_depth'], 0)
+                raise ValueError
+        except ValueError:
+            pass
+        with transaction.atomic():
+            send_activation_email(user=self.user, request=self.request)
+            # changed by the request after the email was queued
+            self.user.email = 'changed@example.com'
+        backend.join()
+        self.assertEqual([message.to for message in mail.outbox], [['user@example.com']])
+
+    def test_activated_users_are_skipped(self):
+        backend = get_dispatch_backend()
+        with transaction.atomic():
+            send_activation_email(user=self.user, request=self.request)
+            self.user.activate()
+        backend.join()
+        self.assertEqual(len(mail.outbox), 0)
+
+    @override_settings(EMAIL_BACKEND='tests.helpers.FlakyEmailBackend',
+                       USERS_EMAIL_DISPATCH_MAX_RETRIES=0)
+    def test_gives_up_after_max_retries(self):
+        backend = get_dispatch_backend()
+        send_activation_email(user=self.user, request=self.request)
+        backend.join()
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(backend.stats()['failed'], 1)
+
+
+@override_settings(USERS_VERIFY_EMAIL=True, USERS_EMAIL_DISPATCH_RETRY_DELAY=0,
+                   USERS_EMAIL_DISPATCH_BACKEND='users.dispatch.OutboxBackend')
+class OutboxBackendTest(DispatchBackendTestMixin, TestCase):
+
+    def send_queued_emails(self):
+        out = StringIO()
+        call_command('send_queued_activation_emails', stdout=out)
+        return out.getvalue()
+
+    def test_send_activation_email_is_queued(self):
+        send_activation_email(user=self.user, request=self.request)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(get_dispatch_backend().stats()['queue_depth'], 1)
+
+        self.assertIn('Sent 1 activation emails', self.send_queued_emails())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('/activate/', mail.outbox[0].body)
+        self.assertFalse(QueuedActivationEmail.objects.exists())
+
+    @override_settings(EMAIL_BACKEND='tests.helpers.FlakyEmailBackend')
+    def test_failed_sends_are_retried(self):
+        send_activation_email(user=self.user, request=self.request)
+        self.send_queued_emails()
+        self.assertEqual(QueuedActivationEmail.objects.get().attempts, 1)
+        # retried on the next run, once the backoff delay has passed
+        self.send_queued_emails()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(QueuedActivationEmail.objects.exists())
+
+    @override_settings(EMAIL_BACKEND='tests.helpers.FlakyEmailBackend',
+                       USERS_EMAIL_DISPATCH_MAX_RETRIES=0)
+    def test_gives_up_after_max_retries(self):
+        send_activation_email(user=self.user, request=self.request)
+        self.send_queued_emails()
+        entry = QueuedActivationEmail.objects.get()
+        self.assertEqual(entry.attempts, 1)
+        self.assertIsNone(entry.next_attempt)
+        self.assertIn('Connection refused', entry.last_error)
+
+    @override_settings(EMAIL_BACKEND='tests.helpers.UnreachableEmailBackend')
+    def test_connection_failures_are_retried(self):
+        send_activation_email(user=self.user, request=self.request)
+        self.send_queued_emails()
+        entry = QueuedActivationEmail.objects.get()
+        self.assertEqual(entry.attempts, 1)
+        self.assertIn('Connection refused', entry.last_error)
+        self.send_queued_emails()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(QueuedActivationEmail.objects.exists())
+
+    @override_settings(EMAIL_BACKEND='tests.helpers.FlakyEmailBackend')
+    def test_failed_sends_are_not_retried_in_the_same_run(self):
+        FlakyEmailBackend.failures = 10
+        send_activation_email(user=self.user, request=self.request)
+        # the email is due again right away, the command still stops
+        call_command('send_queued_activation_emails', limit=1, stdout=StringIO())
+        self.assertEqual(QueuedActivationEmail.objects.get().attempts, 1)
+
+    def test_activated_users_are_skipped(self):
+        send_activation_email(user=self.user, request=self.request)
+        self.user.activate()
+        self.send_queued_emails()
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertFalse(QueuedActivationEmail.objects.exists())
+
+
+@override_settings(USERS_VERIFY_EMAIL=True)
+class EmailCacheTest(TestCase):
+
+    def setUp(self):
+        clear_email_caches()
+        self.request = RequestFactory().get(reverse('users_register'))
+        for i in range(10):
+            get_user_model().objects.create_user(
+                'user%d@example.com' % i, 'pa$sw0Rd', is_active=False)
+
+    def test_templates_and_site_are_loaded_once(self):
+        user = get_user_model().objects.first()
+        with mock.patch('users.dispatch.get_template', wraps=get_template) as mock_get_template:
+            send_activation_emails(get_user_model().objects.all(), self.request)
+            # warm caches: the site isn't looked up again either
+            with self.assertNumQueries(0):
+                send_activation_email(user=user, request=self.request)
+        self.assertEqual(len(mail.outbox), 11)
+        self.assertEqual(mock_get_template.call_count, 2)
+
+    def test_templates_are_cached_per_language(self):
+        user = get_user_model().objects.first()
+        for language in ('en', 'fr'):
+            with translation.override(language):
+                send_activation_email(user=user, request=self.request)
+        self.assertEqual(len(dispatch._templates), 4)
+
+    @override_settings(USERS_EMAIL_TEMPLATE_CACHE_SIZE=1)
+    def test_template_cache_is_bounded(self):
+        send_activation_email(user=get_user_model().objects.first(), request=self.request)
+        self.assertEqual(len(dispatch._templates), 1)
+
+    def test_site_changes_clear_the_cache(self):
+        send_activation_email(user=get_user_model().objects.first(), request=self.request)
+        site = Site.objects.get_current()
+        site.name = 'Renamed'
+        site.save()
+        send_activation_email(user=get_user_model().objects.first(), request=self.request)
+        self.assertIn('Renamed', mail.outbox[-1].subject)
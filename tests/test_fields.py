@@ -1,11 +1,37 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import hashlib
+import io
+import os
+import shutil
+import string
+import tempfile
+import threading
+import time
+
 from django import forms
+from django.apps import apps
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import TestCase
 from django.test.utils import override_settings
+from django.utils.six import StringIO
+
+try:
+    from unittest import mock
+except ImportError:  # pragma: no cover
+    import mock
 
-from users.fields import (ComplexityValidator, EmailDomainValidator,
-                          LengthValidator)
+from users.breached import BreachedPasswordIndex, write_breached_password_file
+from users.domains import DomainList
+from users.fields import (BreachedPasswordValidator, ComplexityValidator,
+                          EmailDomainValidator, LengthValidator, PasswordField,
+                          UsersEmailField, complexity_validator, validate_email_domain,
+                          validate_email_mx)
+from users.mx import (BaseResolver, ResolverError, StaticResolver, check_domains,
+                      clear_mx_cache, get_pool, reset_mx)
 
 
 class LengthValidatorTest(TestCase):
@@ -95,6 +121,172 @@ class ComplexityValidatorTest(TestCase):
             self.fail('ValidationError raised when validating \'%s\'' % value)
 
 
+def reference_complexity_errors(policy, value):
+    """
+    The categories the previous validator would have rejected ``value`` for.
+    """
+    uppercase, lowercase, digits, punctuation = set(), set(), set(), set()
+    for char in value:
+        if char.isupper():
+            uppercase.add(char)
+        elif char.islower():
+            lowercase.add(char)
+        elif char.isdigit():
+            digits.add(char)
+        elif char in string.punctuation:
+            punctuation.add(char)
+    counts = {'UPPER': len(uppercase), 'LOWER': len(lowercase),
+              'DIGITS': len(digits), 'PUNCTUATION': len(punctuation)}
+    return [category for category in ('UPPER', 'LOWER', 'DIGITS', 'PUNCTUATION')
+            if counts[category] < policy.get(category, 0)]
+
+
+class PasswordPolicyTest(TestCase):
+    password_policy = {'UPPER': 2, 'LOWER': 1, 'DIGITS': 1, 'PUNCTUATION': 1}
+
+    def test_reports_all_violations(self):
+        validator = ComplexityValidator(self.password_policy)
+        with self.assertRaises(forms.ValidationError) as cm:
+            validator('Password')
+        self.assertEqual([error.code for error in cm.exception.error_list], ['complexity'] * 3)
+        self.assertEqual(len(cm.exception.messages), 3)
+        self.assertIn('2 or more uppercase', cm.exception.messages[0])
+        self.assertIn('numbers', cm.exception.messages[1])
+        self.assertIn('symbols', cm.exception.messages[2])
+
+    def test_counts_distinct_characters(self):
+        validator = ComplexityValidator(self.password_policy)
+        self.assertRaises(forms.ValidationError, validator, 'PPassw0rd!')
+        validator('PAssw0rd!')
+
+    def test_matches_previous_validator(self):
+        validator = ComplexityValidator(self.password_policy)
+        passwords = [u'', u'password', u'PASSWORD', u'Pa$$w0rd', u'PA$$w0rd', u'\xc4\xd6\xfc1!',
+                     u'\u0663\u0664 Ab!', u'\u20ac\u20acAB1a', u'  \t\n', u'AB12cd!?']
+        for password in passwords:
+            expected = reference_complexity_errors(self.password_policy, password)
+            errors = validator.policy.violations(password)
+            self.assertEqual(errors, expected, password)
+
+    def test_validate_many(self):
+        validator = ComplexityValidator(self.password_policy)
+        errors = validator.validate_many(['PAssw0rd!', 'password', 'PAssword!'])
+        self.assertEqual(sorted(errors), [1, 2])
+        self.assertEqual(len(errors[1].messages), 3)
+        self.assertEqual(len(errors[2].messages), 1)
+
+    def test_policy_reloads_on_setting_change(self):
+        with override_settings(USERS_PASSWORD_POLICY={'DIGITS': 1}):
+            self.assertRaises(forms.ValidationError, complexity_validator, 'password')
+            with override_settings(USERS_CHECK_PASSWORD_COMPLEXITY=False):
+                complexity_validator('password')
+        complexity_validator('password')
+
+
+def sha1(password):
+    return hashlib.sha1(password.encode('utf-8')).hexdigest().upper()
+
+
+class BreachedPasswordValidatorTest(TestCase):
+    passwords = ['password', '123456', 'qwerty', u'p\xe4ssw\xf6rd', 'letmein']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'breached.bin')
+
+    def build(self, lines, *args, **options):
+        corpus = os.path.join(self.tmpdir, 'corpus.txt')
+        with io.open(corpus, 'w', encoding='utf-8') as f:
+            f.write(u'\n'.join(lines) + u'\n')
+        out = StringIO()
+        call_command('build_breached_passwords', corpus, self.path, *args, stdout=out, **options)
+        return out.getvalue()
+
+    def test_build_and_lookup(self):
+        lines = [u'%s:%d' % (sha1(password), i + 1) for i, password in enumerate(self.passwords)]
+        # duplicates are dropped
+        output = self.build(lines + lines[:2], chunk_size=2)
+        self.assertIn('Wrote 5 hashes', output)
+
+        index = BreachedPasswordIndex(self.path)
+        self.assertEqual(len(index), 5)
+        self.assertEqual(os.path.getsize(self.path), 16 + 5 * 10)
+        for password in self.passwords:
+            self.assertIn(password, index)
+        for password in ('pa$sw0Rd', 'Password', ''):
+            self.assertNotIn(password, index)
+        index.close()
+
+    def test_lookup_matches_set(self):
+        digests = [hashlib.sha1(str(i).encode('ascii')).digest() for i in range(2000)]
+        write_breached_password_file(iter(digests), self.path, record_length=20, chunk_size=300)
+        index = BreachedPasswordIndex(self.path)
+        for i in range(0, 4000, 7):
+            self.assertEqual(str(i) in index, i < 2000)
+        index.close()
+
+    def test_min_count_and_plaintext(self):
+        self.build([u'%s:1' % sha1('password'), u'%s:5' % sha1('qwerty')], min_count=2)
+        index = BreachedPasswordIndex(self.path)
+        self.assertNotIn('password', index)
+        self.assertIn('qwerty', index)
+        index.close()
+
+        self.build([u'password', u''], '--plaintext')
+        index = BreachedPasswordIndex(self.path)
+        self.assertEqual(len(index), 1)
+        self.assertIn('password', index)
+        index.close()
+
+    def test_invalid_corpus(self):
+        self.assertRaises(CommandError, self.build, [u'not a hash'])
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+    def test_validator(self):
+        self.build([sha1('password')])
+        validator = BreachedPasswordValidator(self.path)
+        self.assertRaises(forms.ValidationError, validator, 'password')
+        validator('pa$sw0Rd')
+
+        field = PasswordField()
+        field.clean('password')
+        with override_settings(USERS_BREACHED_PASSWORDS_FILE=self.path):
+            with self.assertRaises(forms.ValidationError) as cm:
+                field.clean('password')
+            self.assertEqual(cm.exception.error_list[0].code, 'breached')
+            field.clean('pa$sw0Rd')
+
+    def test_validator_reloads_on_setting_change(self):
+        self.build([sha1('password')])
+        with override_settings(USERS_BREACHED_PASSWORDS_FILE=self.path):
+            self.assertRaises(forms.ValidationError, PasswordField().clean, 'password')
+            self.build([sha1('qwerty')])
+        with override_settings(USERS_BREACHED_PASSWORDS_FILE=self.path):
+            PasswordField().clean('password')
+            self.assertRaises(forms.ValidationError, PasswordField().clean, 'qwerty')
+
+    @mock.patch.object(BreachedPasswordIndex, 'check_interval', 0)
+    def test_validator_reloads_replaced_file(self):
+        self.build([sha1('password')])
+        with override_settings(USERS_BREACHED_PASSWORDS_FILE=self.path):
+            self.assertRaises(forms.ValidationError, PasswordField().clean, 'password')
+            # build_breached_passwords renames a new file over the old one
+            self.build([sha1('qwerty')])
+            PasswordField().clean('password')
+            self.assertRaises(forms.ValidationError, PasswordField().clean, 'qwerty')
+
+    def test_file_is_checked_at_most_every_check_interval(self):
+        self.build([sha1('password')])
+        index = BreachedPasswordIndex(self.path)
+        self.addCleanup(index.close)
+        self.build([sha1('qwerty')])
+        self.assertFalse(index.is_stale())
+        with mock.patch('users.breached.time.time', return_value=time.time() + 2):
+            self.assertTrue(index.is_stale())
+
+
 class EmailDomainValidatorTest(TestCase):
     domains_blacklist = ('mailinator.com', )
     domains_whitelist = ('djangoproject.com', )
@@ -120,3 +312,193 @@ class EmailDomainValidatorTest(TestCase):
             pass
         else:
             self.fail('ValidationError not raised when validating \'%s\'' % value)
+
+    def test_email_domain_validator_normalizes_domain(self):
+        validator = EmailDomainValidator(blacklist=['Mailinator.com.'])
+        self.assertRaises(forms.ValidationError, validator, 'spammer@MAILINATOR.com')
+        validator('user@example.com')
+
+    def test_email_domain_validator_with_wildcards(self):
+        validator = EmailDomainValidator(blacklist=['.mailinator.com', '*.temp-mail.org'])
+        for value in ('a@mailinator.com', 'a@x.mailinator.com', 'a@x.y.temp-mail.org'):
+            self.assertRaises(forms.ValidationError, validator, value)
+        for value in ('a@temp-mail.org', 'a@notmailinator.com', 'a@mailinator.com.example.com'):
+            validator(value)
+
+        validator = EmailDomainValidator(whitelist=['.djangoproject.com'])
+        validator('user@code.djangoproject.com')
+        self.assertRaises(forms.ValidationError, validator, 'user@example.com')
+
+    def test_email_domain_validator_with_large_list(self):
+        domains = ['disposable%d.example' % i for i in range(100000)]
+        validator = EmailDomainValidator(blacklist=domains + ['.mailinator.com'])
+        self.assertRaises(forms.ValidationError, validator, 'user@disposable99999.example')
+        self.assertRaises(forms.ValidationError, validator, 'user@a.b.c.mailinator.com')
+        validator('user@disposable100000.example')
+
+
+class DomainListFileTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'domains.txt')
+
+    def write(self, content):
+        with io.open(self.path, 'w', encoding='utf-8') as f:
+            f.write(content)
+
+    def test_file_reloaded_when_changed(self):
+        self.write(u'# disposable domains\nmailinator.com\n.guerrillamail.com  # and subdomains\n\n')
+        domains = DomainList(['spam.example'], path=self.path)
+        domains.check_interval = 0
+        self.assertIn('mailinator.com', domains)
+        self.assertIn('sharklasers.guerrillamail.com', domains)
+        self.assertIn('spam.example', domains)
+        self.assertNotIn('example.com', domains)
+
+        self.write(u'example.com\n')
+        os.utime(self.path, (0, 0))
+        self.assertIn('example.com', domains)
+        self.assertNotIn('mailinator.com', domains)
+        self.assertIn('spam.example', domains)
+
+        # keeps the last version while the file is missing
+        os.remove(self.path)
+        self.assertIn('example.com', domains)
+
+    def test_blacklist_file_setting(self):
+        self.write(u'mailinator.com\n')
+        with override_settings(USERS_EMAIL_DOMAINS_BLACKLIST_FILE=self.path):
+            self.assertRaises(forms.ValidationError, validate_email_domain, 'a@mailinator.com')
+        validate_email_domain('a@mailinator.com')
+
+
+class FakeResolver(BaseResolver):
+    domains = {'nomail.example': False}
+    # domain: callable run by the lookup before it returns
+    hooks = {}
+    calls = []
+    ttl = 60
+
+    def resolve(self, domain, timeout):
+        self.calls.append(domain)
+        hook = self.hooks.get(domain)
+        if hook is not None:
+            hook()
+        if domain == 'broken.example':
+            raise ResolverError('SERVFAIL')
+        return self.domains.get(domain, True), self.ttl
+
+
+@override_settings(USERS_VALIDATE_EMAIL_MX=True,
+                   USERS_EMAIL_MX_RESOLVER='tests.test_fields.FakeResolver')
+class MXRecordValidatorTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        clear_mx_cache()
+        FakeResolver.calls = []
+
+    def join_lookups(self):
+        pool = get_pool()
+        pool.close()
+        pool.join()
+        reset_mx(setting='USERS_EMAIL_MX_WORKERS')
+
+    def test_rejects_domains_without_mail(self):
+        self.assertRaises(forms.ValidationError, UsersEmailField().clean, 'user@NoMail.example')
+        validate_email_mx('user@example.com')
+        self.assertEqual(sorted(FakeResolver.calls), ['example.com', 'nomail.example'])
+
+    @override_settings(USERS_EMAIL_DOMAINS_BLACKLIST=['mailinator.com'])
+    def test_rejected_emails_are_not_looked_up(self):
+        field = UsersEmailField()
+        for email in ('user@', 'user@example..com', 'user@mailinator.com'):
+            self.assertRaises(forms.ValidationError, field.clean, email)
+        self.assertEqual(FakeResolver.calls, [])
+        self.assertEqual(UsersEmailField(required=False).clean(''), '')
+        self.assertEqual(FakeResolver.calls, [])
+
+    def test_results_cached(self):
+        validate_email_mx('user@example.com')
+        validate_email_mx('other@example.com')
+        self.assertEqual(FakeResolver.calls, ['example.com'])
+
+        # shared with other processes through Django's cache
+        clear_mx_cache()
+        validate_email_mx('user@example.com')
+        self.assertEqual(FakeResolver.calls, ['example.com'])
+
+        # until the record's TTL expires
+        expired = time.time() + FakeResolver.ttl + 1
+        with mock.patch('users.mx.time.time', return_value=expired):
+            validate_email_mx('user@example.com')
+        self.assertEqual(FakeResolver.calls, ['example.com', 'example.com'])
+
+    @override_settings(USERS_EMAIL_MX_MAX_TTL=0)
+    def test_max_ttl(self):
+        validate_email_mx('user@example.com')
+        validate_email_mx('user@example.com')
+        self.assertEqual(FakeResolver.calls, ['example.com', 'example.com'])
+
+    @override_settings(USERS_EMAIL_MX_TIMEOUT=0.1)
+    def test_timeout_budget(self):
+        # the lookup doesn't return until the validator has given up on it
+        released = threading.Event()
+        try:
+            with mock.patch.dict(FakeResolver.hooks, {'nomail.example': released.wait}):
+                with mock.patch('users.mx.logger') as logger:
+                    validate_email_mx('user@nomail.example')
+                self.assertEqual(logger.warning.call_count, 1)
+                self.assertEqual(
+                    check_domains(['nomail.example'], timeout=0), {'nomail.example': None})
+        finally:
+            released.set()
+            self.join_lookups()
+        # the late results are cached
+        self.assertRaises(forms.ValidationError, validate_email_mx, 'user@nomail.example')
+        self.assertEqual(FakeResolver.calls, ['nomail.example', 'nomail.example'])
+
+    def test_resolver_errors_accepted(self):
+        with mock.patch('users.mx.logger') as logger:
+            validate_email_mx('user@broken.example')
+            validate_email_mx('user@broken.example')
+        self.assertEqual(logger.warning.call_count, 2)
+        self.assertEqual(FakeResolver.calls, ['broken.example', 'broken.example'])
+
+    def test_validate_many_concurrently(self):
+        domains = ['slow%d.example' % i for i in range(5)]
+        emails = ['user@%s' % domain for domain in domains] + ['user@nomail.example', 'invalid']
+        # each slow lookup waits until all of them have started
+        started, all_started = [], threading.Event()
+
+        def wait_for_all():
+            started.append(True)
+            if len(started) == len(domains):
+                all_started.set()
+            all_started.wait(10)
+
+        try:
+            with mock.patch.dict(FakeResolver.hooks, dict.fromkeys(domains, wait_for_all)):
+                errors = validate_email_mx.validate_many(emails)
+            self.assertTrue(all_started.is_set())
+        finally:
+            all_started.set()
+            self.join_lookups()
+        self.assertEqual(list(errors), [5])
+        self.assertEqual(len(FakeResolver.calls), 6)
+
+    @override_settings(USERS_EMAIL_MX_RESOLVER='tests.test_fields.MissingResolver')
+    def test_resolver_loaded_at_startup(self):
+        self.assertRaises(ImproperlyConfigured, apps.get_app_config('users').ready)
+
+    @override_settings(USERS_VALIDATE_EMAIL_MX=False)
+    def test_disabled(self):
+        validate_email_mx('user@nomail.example')
+        self.assertEqual(FakeResolver.calls, [])
+
+    def test_static_resolver(self):
+        resolver = StaticResolver({'nomail.example': False})
+        self.assertEqual(resolver.resolve('nomail.example', 1), (False, 3600))
+        self.assertEqual(resolver.resolve('example.com', 1), (True, 3600))
@@ -1,10 +1,22 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import time
+
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.utils.encoding import force_text
+from django.utils.six import StringIO
 from django.utils.translation import ugettext as _
 
+try:
+    from unittest import mock
+except ImportError:  # pragma: no cover
+    import mock
+
+from users.bloom import BloomFilter, email_may_exist
 from users.forms import (RegistrationFormHoneypot,
                          RegistrationFormTermsOfService, UserChangeForm,
                          UserCreationForm)
@@ -25,6 +37,36 @@ class UserCreationFormTest(TestCase):
         self.assertEqual(form['email'].errors,
                          [force_text(form.error_messages['duplicate_email'])])
 
+    def test_user_already_exists_with_different_domain_case(self):
+        get_user_model().objects.create_user('testuser@example.com', 'Pa$sw0rd')
+        form = UserCreationForm({
+            'email': 'testuser@EXAMPLE.com',
+            'password1': 'Pa$sw0rd',
+            'password2': 'Pa$sw0rd',
+        })
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form['email'].errors,
+                         [force_text(form.error_messages['duplicate_email'])])
+
+    def test_user_already_exists_with_different_case(self):
+        get_user_model().objects.create_user('TestUser@example.com', 'Pa$sw0rd')
+        form = UserCreationForm({
+            'email': 'testuser@example.com',
+            'password1': 'Pa$sw0rd',
+            'password2': 'Pa$sw0rd',
+        })
+        self.assertFalse(form.is_valid())
+
+    def test_duplicate_email_check_queries(self):
+        form = UserCreationForm({
+            'email': 'testuser@example.com',
+            'password1': 'Pa$sw0rd',
+            'password2': 'Pa$sw0rd',
+        })
+        # only the case-insensitive duplicate check
+        with self.assertNumQueries(1):
+            self.assertTrue(form.is_valid())
+
     def test_invalid_email(self):
         data = {
             'email': 'testuser',
@@ -131,3 +173,107 @@ class RegistrationFormHoneypotTest(TestCase):
         }
         form = RegistrationFormHoneypot(data=data)
         self.assertFalse(form.is_valid())
+
+
+@override_settings(USERS_SPAM_TIMING_CHECK=True)
+class SignedTimestampTest(TestCase):
+    data = {
+        'email': 'testuser@example.com',
+        'password1': 'Pa$sw0rd',
+        'password2': 'Pa$sw0rd',
+    }
+
+    def get_timestamp(self, age):
+        with mock.patch('users.fields.time.time', return_value=time.time() - age):
+            return RegistrationFormHoneypot()['timestamp'].value()
+
+    def test_timestamp_rendered(self):
+        form = RegistrationFormHoneypot()
+        self.assertIn('name="timestamp"', force_text(form['timestamp']))
+        self.assertTrue(form['timestamp'].is_hidden)
+
+    @override_settings(USERS_SPAM_TIMING_CHECK=False)
+    def test_disabled(self):
+        self.assertNotIn('timestamp', RegistrationFormHoneypot().fields)
+        self.assertTrue(RegistrationFormHoneypot(data=self.data).is_valid())
+
+    def test_valid_submission(self):
+        form = RegistrationFormHoneypot(data=dict(self.data, timestamp=self.get_timestamp(5)))
+        self.assertTrue(form.is_valid())
+
+    def test_rejected_submissions(self):
+        get_user_model().objects.create_user('testuser@example.com', 'Pa$sw0rd')
+        for timestamp, message in (
+                (None, 'Invalid form submission'),
+                ('12345:forged', 'Invalid form submission'),
+                (self.get_timestamp(0), 'submitted too quickly'),
+                (self.get_timestamp(2 * 24 * 60 * 60), 'has expired')):
+            data = dict(self.data, accept_terms=True)
+            if timestamp is not None:
+                data['timestamp'] = timestamp
+            form = RegistrationFormHoneypot(data=data)
+            with mock.patch('users.forms.PasswordField.clean') as clean_password:
+                with self.assertNumQueries(0):
+                    self.assertFalse(form.is_valid())
+            self.assertFalse(clean_password.called)
+            self.assertIn(message, form.non_field_errors()[0])
+            self.assertIn('accept_terms', form.errors)
+            # the email, which is taken, wasn't checked
+            self.assertNotIn('email', form.errors)
+
+    @override_settings(USERS_SPAM_MIN_SUBMIT_TIME=0, USERS_SPAM_MAX_SUBMIT_TIME=None)
+    def test_limits_disabled(self):
+        for age in (0, 365 * 24 * 60 * 60):
+            form = RegistrationFormHoneypot(data=dict(self.data, timestamp=self.get_timestamp(age)))
+            self.assertTrue(form.is_valid())
+
+
+@override_settings(USERS_EMAIL_FILTER=True, USERS_EMAIL_FILTER_CAPACITY=1000)
+class EmailFilterTest(TestCase):
+    data = {
+        'email': 'newuser@example.com',
+        'password1': 'Pa$sw0rd',
+        'password2': 'Pa$sw0rd',
+    }
+
+    def setUp(self):
+        cache.clear()
+        get_user_model().objects.create_user('testuser@example.com', 'Pa$sw0rd')
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        values = ['user%d@example.com' % i for i in range(1000)]
+        for value in values:
+            bloom.add(value)
+        self.assertTrue(all(value in bloom for value in values))
+        false_positives = sum('other%d@example.com' % i in bloom for i in range(1000))
+        self.assertLess(false_positives, 50)
+
+    def test_filter_must_be_built(self):
+        self.assertTrue(email_may_exist('newuser@example.com'))
+        call_command('rebuild_email_filter', stdout=StringIO())
+        with self.assertNumQueries(0):
+            self.assertFalse(email_may_exist('newuser@example.com'))
+            self.assertTrue(email_may_exist('TestUser@example.com'))
+
+    def test_new_and_changed_emails_are_added(self):
+        call_command('rebuild_email_filter', stdout=StringIO())
+        get_user_model().objects.create_user('newuser@example.com', 'Pa$sw0rd')
+        user = get_user_model().base_objects.only('pk').get(email='testuser@example.com')
+        user.email = 'taken@example.com'
+        user.save()
+        self.assertTrue(email_may_exist('newuser@example.com'))
+        self.assertTrue(email_may_exist('taken@example.com'))
+        self.assertFalse(email_may_exist('other@example.com'))
+
+    def test_form_still_queries_the_database(self):
+        call_command('rebuild_email_filter', stdout=StringIO())
+        # update() bypasses the filter
+        get_user_model().base_objects.update(
+            email='newuser@example.com', normalized_email='newuser@example.com')
+        self.assertFalse(email_may_exist('newuser@example.com'))
+        form = UserCreationForm(dict(self.data, email='NewUser@example.com'))
+        with self.assertNumQueries(1):
+            self.assertFalse(form.is_valid())
+        self.assertEqual(form['email'].errors,
+                         [force_text(form.error_messages['duplicate_email'])])
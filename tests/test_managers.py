@@ -1,9 +1,23 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+from datetime import timedelta
+
 from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from django.utils.six import StringIO
 
 from example.models import Customer
+from users.bloom import email_may_exist
+from users.forms import UserCreationForm
+from users.managers import UserQuerySet, get_user_type_model
+from users.registry import user_types
+from users.signals import users_bulk_activated
 
 
 class UserManagerTest(TestCase):
@@ -41,6 +55,26 @@ class UserManagerTest(TestCase):
             self.user_email, self.user_password, is_staff=True)
         self.assertTrue(user.is_staff)
 
+    def test_normalized_email(self):
+        user = get_user_model().objects.create_user('User@Example.com')
+        self.assertEqual(user.normalized_email, 'user@example.com')
+        user.email = 'New.User@example.com'
+        user.save(update_fields=['email'])
+        self.assertEqual(
+            get_user_model().base_objects.get(pk=user.pk).normalized_email,
+            'new.user@example.com')
+
+    def test_get_by_natural_key_is_case_insensitive(self):
+        user = get_user_model().objects.create_user('User@Example.com')
+        self.assertEqual(
+            get_user_model().objects.get_by_natural_key('user@example.COM'), user)
+
+    def test_get_by_natural_key_with_legacy_case_duplicates(self):
+        get_user_model().objects.create_user('user@example.com')
+        user = get_user_model().objects.create_user('User@example.com')
+        self.assertEqual(
+            get_user_model().objects.get_by_natural_key('User@example.com'), user)
+
     def test_empty_username(self):
         self.assertRaises(ValueError, get_user_model().objects.create_user, email='')
 
@@ -51,3 +85,264 @@ class UserManagerTest(TestCase):
         self.assertQuerysetEqual(
             get_user_model().objects.all(),
             ['<User: user@example.com>', '<Customer: customer@example.com>'], ordered=False)
+
+
+class TypeDirectedDowncastingTest(TestCase):
+
+    def setUp(self):
+        get_user_model().objects.create_user('user@example.com', 'pa$sw0Rd')
+        Customer.objects.create_user('customer1@example.com', 'cu$t0meR')
+        Customer.objects.create_user('customer2@example.com', 'cu$t0meR')
+        # warm the ContentType cache so query counts only cover user tables
+        list(get_user_model().objects.all().select_subclasses_by_type())
+
+    def test_downcasting_by_user_type(self):
+        qs = get_user_model().objects.all().select_subclasses_by_type().order_by('email')
+        self.assertEqual(
+            [(user.__class__, user.email) for user in qs],
+            [(Customer, 'customer1@example.com'),
+             (Customer, 'customer2@example.com'),
+             (get_user_model(), 'user@example.com')])
+
+    def test_base_query_does_not_join_subclass_tables(self):
+        qs = get_user_model().objects.all().select_subclasses_by_type()
+        self.assertNotIn(Customer._meta.db_table, str(qs.query))
+        self.assertIn(Customer._meta.db_table, str(get_user_model().objects.all().query))
+
+    def test_one_query_per_user_type_present(self):
+        # base table + customers
+        with self.assertNumQueries(2):
+            list(get_user_model().objects.all().select_subclasses_by_type())
+        # no child tables to fetch for plain users
+        with self.assertNumQueries(1):
+            list(get_user_model().objects.filter(
+                email='user@example.com').select_subclasses_by_type())
+
+    def test_select_subclasses_restores_joins(self):
+        qs = get_user_model().objects.all().select_subclasses_by_type().select_subclasses()
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                sorted(user.__class__.__name__ for user in qs),
+                ['Customer', 'Customer', get_user_model().__name__])
+
+    def test_base_objects_downcast(self):
+        with self.assertNumQueries(2):
+            users = list(get_user_model().base_objects.order_by('email').downcast())
+        self.assertEqual([user.__class__ for user in users],
+                         [Customer, Customer, get_user_model()])
+        self.assertIsInstance(get_user_model().base_objects.all(), UserQuerySet)
+
+    def test_as_subclass(self):
+        user = get_user_model().base_objects.get(email='customer1@example.com')
+        self.assertIs(user.__class__, get_user_model())
+        with self.assertNumQueries(1):
+            customer = user.as_subclass()
+        self.assertIsInstance(customer, Customer)
+        self.assertEqual(customer.pk, user.pk)
+
+        user = get_user_model().base_objects.get(email='user@example.com')
+        with self.assertNumQueries(0):
+            self.assertIs(user.as_subclass(), user)
+
+    def test_registry_maps_user_types_to_models(self):
+        user_types.clear()
+        customer_type = ContentType.objects.get_for_model(Customer)
+        self.assertIs(user_types.get_model(customer_type.id), Customer)
+        with self.assertNumQueries(0):
+            self.assertIs(get_user_type_model(customer_type.id), Customer)
+            self.assertEqual(user_types.get_user_type_id(Customer), customer_type.id)
+        self.assertIsNone(user_types.get_model(ContentType.objects.get_for_model(ContentType).id))
+
+    @override_settings(USERS_RESOLVE_SUBCLASSES_BY_TYPE=True)
+    def test_manager_mode_setting(self):
+        self.assertNotIn(Customer._meta.db_table, str(get_user_model().objects.all().query))
+        user = get_user_model().objects.get(email='customer1@example.com')
+        self.assertIsInstance(user, Customer)
+
+
+class BulkActivateTest(TestCase):
+
+    def setUp(self):
+        self.users = [
+            get_user_model().objects.create_user(
+                'user%d@example.com' % i, 'pa$sw0Rd', is_active=False)
+            for i in range(5)
+        ]
+        get_user_model().objects.create_user('active@example.com', 'pa$sw0Rd')
+        self.activated = []
+        users_bulk_activated.connect(self.on_bulk_activated)
+
+    def tearDown(self):
+        users_bulk_activated.disconnect(self.on_bulk_activated)
+
+    def on_bulk_activated(self, sender, user_ids, request, **kwargs):
+        self.activated.append(list(user_ids))
+
+    def test_bulk_activate_queryset(self):
+        # one select for the inactive ids, then a locking select and an
+        # update per chunk
+        with self.assertNumQueries(7):
+            count = get_user_model().base_objects.bulk_activate(
+                get_user_model().base_objects.all(), batch_size=2)
+        self.assertEqual(count, 5)
+        self.assertFalse(get_user_model().objects.filter(is_active=False).exists())
+        self.assertEqual([len(batch) for batch in self.activated], [2, 2, 1])
+
+    def test_bulk_activate_ids(self):
+        user_ids = [user.pk for user in self.users[:3]]
+        count = get_user_model().base_objects.bulk_activate(user_ids)
+        self.assertEqual(count, 3)
+        self.assertEqual(get_user_model().objects.filter(is_active=False).count(), 2)
+        self.assertEqual(self.activated, [user_ids])
+
+    def test_bulk_activate_reports_only_activated_ids(self):
+        active = get_user_model().objects.get(email='active@example.com')
+        self.users[1].activate()
+        user_ids = [self.users[0].pk, active.pk, self.users[1].pk, self.users[2].pk]
+        count = get_user_model().base_objects.bulk_activate(user_ids, batch_size=3)
+        self.assertEqual(count, 2)
+        self.assertEqual(self.activated, [[self.users[0].pk], [self.users[2].pk]])
+
+    def test_bulk_activate_skips_active_users(self):
+        get_user_model().base_objects.bulk_activate(get_user_model().base_objects.all())
+        self.activated = []
+        self.assertEqual(get_user_model().base_objects.bulk_activate(
+            get_user_model().base_objects.all()), 0)
+        self.assertEqual(self.activated, [])
+
+
+class BulkCreateUsersTest(TestCase):
+
+    def rows(self, count, domain='Example.com'):
+        return ({'email': 'User%d@%s' % (i, domain), 'password': 'pa$sw0Rd%d' % i}
+                for i in range(count))
+
+    def test_bulk_create_users(self):
+        # warm the user type registry
+        get_user_model().objects.create_user('user@example.com')
+        with self.assertNumQueries(3):
+            count = get_user_model().objects.bulk_create_users(self.rows(25), batch_size=10)
+        self.assertEqual(count, 25)
+
+        user = get_user_model().objects.get(email='User7@example.com')
+        self.assertEqual(user.normalized_email, 'user7@example.com')
+        self.assertTrue(user.check_password('pa$sw0Rd7'))
+        self.assertEqual(user.user_type, ContentType.objects.get_for_model(get_user_model()))
+        self.assertTrue(user.is_active)
+
+    def test_chunks_larger_than_the_backend_limit(self):
+        # sqlite inserts at most 500 rows per statement
+        rows = ({'email': 'user%d@example.com' % i, 'password': '!'} for i in range(600))
+        count = get_user_model().objects.bulk_create_users(rows, batch_size=600, hashed=True)
+        self.assertEqual(count, 600)
+        self.assertEqual(get_user_model().objects.count(), 600)
+
+    def test_bulk_create_users_without_password(self):
+        get_user_model().objects.bulk_create_users([{'email': 'user@example.com', 'is_staff': True}])
+        user = get_user_model().objects.get()
+        self.assertFalse(user.has_usable_password())
+        self.assertTrue(user.is_staff)
+
+    def test_derived_fields_are_ignored(self):
+        get_user_model().objects.bulk_create_users([{
+            'email': 'User@Example.com', 'normalized_email': 'other@example.com',
+            'user_type_id': ContentType.objects.get_for_model(Customer).pk,
+        }])
+        user = get_user_model().objects.get()
+        self.assertEqual(user.normalized_email, 'user@example.com')
+        self.assertEqual(user.user_type, ContentType.objects.get_for_model(get_user_model()))
+
+    def test_bulk_create_users_requires_email(self):
+        self.assertRaises(ValueError, get_user_model().objects.bulk_create_users, [{'email': ''}])
+
+    def test_bulk_create_multi_table_inherited_users(self):
+        count = Customer.objects.bulk_create_users(
+            dict(row, first_name='Jane') for row in self.rows(5))
+        self.assertEqual(count, 5)
+        self.assertEqual(
+            [user.__class__ for user in get_user_model().objects.all()], [Customer] * 5)
+        self.assertEqual(Customer.objects.filter(first_name='Jane').count(), 5)
+
+    def test_bulk_created_users_refresh_user_types(self):
+        manager = get_user_model().objects
+        self.assertEqual(manager.get_user_types(), [])
+        manager.bulk_create_users(self.rows(2))
+        self.assertEqual(
+            manager.get_user_types(), [ContentType.objects.get_for_model(get_user_model())])
+
+    @override_settings(USERS_EMAIL_FILTER=True, USERS_EMAIL_FILTER_CAPACITY=1000)
+    def test_bulk_created_emails_are_added_to_the_email_filter(self):
+        cache.clear()
+        call_command('rebuild_email_filter', stdout=StringIO())
+        get_user_model().objects.bulk_create_users([{'email': 'dup@example.com'}])
+        self.assertTrue(email_may_exist('dup@example.com'))
+        form = UserCreationForm({
+            'email': 'dup@example.com',
+            'password1': 'Pa$sw0rd',
+            'password2': 'Pa$sw0rd',
+        })
+        self.assertFalse(form.is_valid())
+        self.assertIn('email', form.errors)
+
+    def test_user_type_ids_are_resolved_once(self):
+        user_types.clear()
+        get_user_model().objects.create_user('user1@example.com')
+        with CaptureQueriesContext(connection) as context:
+            get_user_model().objects.create_user('user2@example.com')
+            Customer.objects.create_user('customer@example.com')
+        self.assertFalse([q for q in context.captured_queries if 'django_content_type' in q['sql']])
+
+
+class PurgeUnactivatedTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        manager = get_user_model().base_objects
+        old = timezone.now() - timedelta(days=30)
+        # 1200 stale users, half of them customers
+        manager.bulk_create_users(
+            {'email': 'stale%d@example.com' % i, 'is_active': False,
+             'date_joined': old, 'last_login': old} for i in range(1000))
+        Customer.base_objects.bulk_create_users(
+            {'email': 'customer%d@example.com' % i, 'is_active': False,
+             'date_joined': old} for i in range(200))
+        # recent, active, or logged in users are kept
+        manager.bulk_create_users([
+            {'email': 'recent@example.com', 'is_active': False},
+            {'email': 'active@example.com', 'is_active': True, 'date_joined': old},
+            {'email': 'deactivated@example.com', 'is_active': False,
+             'date_joined': old, 'last_login': timezone.now()},
+        ])
+        self.kept = ['active@example.com', 'deactivated@example.com', 'recent@example.com']
+
+    def test_dry_run(self):
+        out = StringIO()
+        with self.assertNumQueries(1):
+            call_command('cleanup_unactivated_users', dry_run=True, stdout=out)
+        self.assertIn('1200 unactivated users would be deleted', out.getvalue())
+        self.assertEqual(get_user_model().base_objects.count(), 1203)
+
+    def test_purge_unactivated(self):
+        customer_type = ContentType.objects.get_for_model(Customer)
+        self.assertIn(customer_type, get_user_model().base_objects.get_user_types())
+        with CaptureQueriesContext(connection) as context:
+            count = get_user_model().base_objects.purge_unactivated(batch_size=500)
+        self.assertEqual(count, 1200)
+        self.assertEqual(
+            sorted(get_user_model().base_objects.values_list('email', flat=True)), self.kept)
+        self.assertFalse(Customer.objects.exists())
+        self.assertNotIn(customer_type, get_user_model().base_objects.get_user_types())
+
+        # three chunks, each deleted by primary key range
+        chunks = [q['sql'] for q in context.captured_queries if 'LIMIT 500' in q['sql']]
+        self.assertEqual(len(chunks), 3)
+        ranges = [q['sql'] for q in context.captured_queries
+                  if '"users_user"."id" >=' in q['sql'] and '"users_user"."id" <=' in q['sql']]
+        self.assertEqual(len(ranges), 3)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('cleanup_unactivated_users', days=60, stdout=out)
+        self.assertIn('Deleted 0 unactivated users', out.getvalue())
+        call_command('cleanup_unactivated_users', stdout=out)
+        self.assertIn('Deleted 1200 unactivated users', out.getvalue())
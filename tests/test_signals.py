@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.urlresolvers import reverse
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+
+try:
+    from unittest import mock
+except ImportError:  # pragma: no cover
+    import mock
+
+from example.models import Customer
+from users.signals import (SignalDispatcher, signal_dispatcher, user_registered,
+                           users_bulk_activated)
+
+
+class Receiver(object):
+
+    def __init__(self, signal, delay=0, error=None):
+        self.signal = signal
+        self.delay = delay
+        self.error = error
+        self.calls = []
+
+    def __call__(self, sender, **kwargs):
+        self.calls.append((threading.current_thread(), kwargs))
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        self.signal.connect(self, weak=False)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.signal.disconnect(self)
+
+
+class SignalDispatcherTest(TestCase):
+
+    def setUp(self):
+        signal_dispatcher.reset_stats()
+
+    @override_settings(USERS_VERIFY_EMAIL=True)
+    def test_sync_dispatch(self):
+        with Receiver(user_registered) as receiver:
+            self.client.post(reverse('users_register'), {
+                'email': 'user@example.com', 'password1': 'pa$sw0Rd', 'password2': 'pa$sw0Rd'})
+        self.assertEqual(len(receiver.calls), 1)
+        thread, kwargs = receiver.calls[0]
+        self.assertIs(thread, threading.current_thread())
+        self.assertEqual(kwargs['user'].email, 'user@example.com')
+
+    def test_sync_dispatch_raises(self):
+        with Receiver(user_registered, error=ValueError('boom')):
+            self.assertRaises(ValueError, signal_dispatcher.send, user_registered,
+                              sender=get_user_model(), request=None, user=None)
+
+    @override_settings(USERS_SIGNAL_SLOW_RECEIVER_THRESHOLD=0.01)
+    def test_receiver_stats(self):
+        with Receiver(user_registered, delay=0.02) as receiver:
+            with mock.patch('users.signals.logger') as logger:
+                signal_dispatcher.send(user_registered, sender=get_user_model(),
+                                       request=None, user=None)
+            signal_dispatcher.send(user_registered, sender=get_user_model(),
+                                   request=None, user=None)
+        self.assertEqual(len(receiver.calls), 2)
+        self.assertEqual(logger.warning.call_count, 1)
+
+        stats = signal_dispatcher.receiver_stats()
+        self.assertEqual(len(stats), 1)
+        name, stats = stats.popitem()
+        self.assertIn('Receiver', name)
+        self.assertEqual(stats['calls'], 2)
+        self.assertGreaterEqual(stats['max_time'], 0.02)
+        self.assertAlmostEqual(stats['avg_time'], stats['total_time'] / 2)
+
+    def test_deliver_calls_the_receivers_send_calls(self):
+        # deliver() relies on the private Signal._live_receivers()
+        model = get_user_model()
+        other = Receiver(user_registered)
+        with Receiver(user_registered) as receiver:
+            user_registered.connect(other, sender=Customer, weak=False)
+            try:
+                sent = [r for r, response in user_registered.send(model, request=None, user=None)]
+                delivered = [r for r, response in signal_dispatcher.deliver(
+                    user_registered, model, {'request': None, 'user': None})]
+            finally:
+                user_registered.disconnect(other, sender=Customer)
+        self.assertEqual(delivered, sent)
+        self.assertEqual(delivered, [receiver])
+        self.assertEqual(len(receiver.calls), 2)
+        self.assertEqual(other.calls, [])
+
+    def test_background_worker_is_restarted(self):
+        dispatcher = SignalDispatcher()
+        # e.g. the worker of the parent process, lost in a fork
+        dispatcher._thread = threading.Thread(target=lambda: None)
+        dispatcher._thread.start()
+        dispatcher._thread.join()
+        with Receiver(user_registered) as receiver:
+            dispatcher.enqueue(user_registered, get_user_model(), {'request': None, 'user': None})
+            self.assertTrue(dispatcher._thread.is_alive())
+            dispatcher.join()
+        self.assertEqual(len(receiver.calls), 1)
+
+    def test_background_worker_survives_errors(self):
+        dispatcher = SignalDispatcher()
+        event = (user_registered, get_user_model(), {'request': None, 'user': None})
+        with Receiver(user_registered) as receiver, \
+                mock.patch('users.signals.logger') as logger, \
+                mock.patch.object(dispatcher, 'batch', side_effect=[ValueError, [event]]):
+            dispatcher.enqueue(*event)
+            dispatcher.join()
+            dispatcher.enqueue(*event)
+            dispatcher.join()
+        self.assertEqual(logger.exception.call_count, 1)
+        self.assertEqual(len(receiver.calls), 1)
+
+    def test_batch(self):
+        dispatcher = SignalDispatcher()
+        model = get_user_model()
+        events = [
+            (users_bulk_activated, model, {'user_ids': [1, 2], 'request': None}),
+            (users_bulk_activated, model, {'user_ids': [3], 'request': None}),
+            (user_registered, model, {'user': None, 'request': None}),
+            (users_bulk_activated, model, {'user_ids': [4], 'request': None}),
+        ]
+        self.assertEqual(dispatcher.batch(events), [
+            (users_bulk_activated, model, {'user_ids': [1, 2, 3], 'request': None}),
+            (user_registered, model, {'user': None, 'request': None}),
+            (users_bulk_activated, model, {'user_ids': [4], 'request': None}),
+        ])
+
+
+class DeferredSignalDispatchTest(TransactionTestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('user@example.com', is_active=False)
+
+    @override_settings(USERS_SIGNAL_DISPATCH='on_commit')
+    def test_on_commit_dispatch(self):
+        with Receiver(users_bulk_activated) as receiver:
+            with transaction.atomic():
+                get_user_model().base_objects.bulk_activate([self.user.pk])
+                self.assertEqual(receiver.calls, [])
+            self.assertEqual(len(receiver.calls), 1)
+            self.assertEqual(receiver.calls[0][1]['user_ids'], [self.user.pk])
+
+    @override_settings(USERS_SIGNAL_DISPATCH='on_commit')
+    def test_on_commit_dispatch_rolled_back(self):
+        with Receiver(users_bulk_activated) as receiver:
+            try:
+                with transaction.atomic():
+                    get_user_model().base_objects.bulk_activate([self.user.pk])
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(receiver.calls, [])
+
+    @override_settings(USERS_SIGNAL_DISPATCH='background')
+    def test_background_dispatch(self):
+        with Receiver(users_bulk_activated, error=ValueError('boom')) as receiver:
+            with mock.patch('users.signals.logger') as logger:
+                get_user_model().base_objects.bulk_activate([self.user.pk])
+                signal_dispatcher.join()
+        self.assertEqual(logger.exception.call_count, 1)
+        self.assertEqual(len(receiver.calls), 1)
+        thread, kwargs = receiver.calls[0]
+        self.assertIsNot(thread, threading.current_thread())
+        self.assertEqual(kwargs['user_ids'], [self.user.pk])
+
+    @override_settings(USERS_SIGNAL_DISPATCH='background')
+    def test_background_dispatch_detaches_the_request(self):
+        with Receiver(user_registered) as receiver:
+            signal_dispatcher.send(user_registered, sender=get_user_model(),
+                                   request=object(), user=self.user)
+            # changed by the request after the signal is sent
+            self.user.email = 'changed@example.com'
+            signal_dispatcher.join()
+        kwargs = receiver.calls[0][1]
+        self.assertIsNone(kwargs['request'])
+        self.assertIsNot(kwargs['user'], self.user)
+        self.assertEqual(kwargs['user'].email, 'user@example.com')
@@ -4,14 +4,21 @@ from datetime import date, timedelta
 
 from django.contrib.auth import get_user_model
 from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 from django.test.client import RequestFactory
 from django.test.utils import override_settings
 
+from tests.helpers import FlakyEmailBackend
 from users.conf import settings
 from users.utils import (auto_create_superuser, EmailActivationTokenGenerator,
-                         send_activation_email)
+                         send_activation_email, send_activation_emails)
+
+try:
+    from unittest import mock
+except ImportError:  # pragma: no cover
+    import mock
 
 
 class CreateSuperuserTest(TestCase):
@@ -48,6 +55,36 @@ class SendActivationEmailTest(TestCase):
         self.assertEqual(len(mail.outbox), 1)
 
 
+@override_settings(USERS_VERIFY_EMAIL=True)
+class SendActivationEmailsTest(TestCase):
+
+    def setUp(self):
+        self.request = RequestFactory().get(reverse('users_register'))
+        for i in range(5):
+            get_user_model().objects.create_user(
+                'user%d@example.com' % i, 'pa$sw0Rd', is_active=False)
+        get_user_model().objects.create_user('active@example.com', 'pa$sw0Rd', is_active=True)
+
+    def test_one_connection_per_chunk(self):
+        with mock.patch.object(EmailBackend, 'open', autospec=True) as mock_open:
+            sent, failures = send_activation_emails(
+                get_user_model().objects.all(), self.request, batch_size=2)
+        self.assertEqual((sent, failures), (5, {}))
+        self.assertEqual(len(mail.outbox), 5)
+        # 5 inactive users in chunks of 2
+        self.assertEqual(mock_open.call_count, 3)
+
+    @override_settings(EMAIL_BACKEND='tests.helpers.FlakyEmailBackend')
+    def test_failures_are_reported_per_recipient(self):
+        FlakyEmailBackend.failures = 1
+
+        users = get_user_model().objects.order_by('email')
+        sent, failures = send_activation_emails(users, self.request)
+        self.assertEqual(sent, 4)
+        self.assertEqual(list(failures), ['user0@example.com'])
+        self.assertEqual(len(mail.outbox), 4)
+
+
 class EmailActivationTokenGeneratorTest(TestCase):
     user_email = 'user@example.com'
     user_password = 'pa$sw0Rd'
@@ -1,14 +1,35 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import re
+from datetime import date, timedelta
 
-from django.contrib.auth import get_user_model
+from django.contrib.auth import BACKEND_SESSION_KEY, get_user, get_user_model
 from django.core import mail
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 from django.test.utils import override_settings
+from django.utils.encoding import force_bytes, force_text
+from django.utils.http import int_to_base36
 
+from example.models import Customer
+from users.compat import urlsafe_base64_encode
+from users.conf import settings
 from users.forms import RegistrationForm, RegistrationFormHoneypot
+from users.signals import user_activated
+from users.utils import EmailActivationTokenGenerator
+
+
+class RemoteBackend(object):
+    """
+    A backend which can't load the users of this app.
+    """
+
+    def authenticate(self, request, **credentials):
+        return None
+
+    def get_user(self, user_id):
+        return None
 
 
 class RegisterViewTest(TestCase):
@@ -78,6 +99,9 @@ class ActivationViewTest(TestCase):
         'password2': 'pa$sw0Rd'
     }
 
+    def setUp(self):
+        cache.clear()
+
     @override_settings(USERS_VERIFY_EMAIL=True)
     def test_activation_view(self):
         self.client.post(reverse('users_register'), self.user_data)
@@ -90,6 +114,29 @@ class ActivationViewTest(TestCase):
         new_user = get_user_model().objects.get(email=self.user_data['email'])
         self.assertTrue(new_user.is_active)
 
+    @override_settings(USERS_VERIFY_EMAIL=True, USERS_AUTO_LOGIN_ON_ACTIVATION=True,
+                       AUTHENTICATION_BACKENDS=['users.backends.EmailBackend'])
+    def test_activation_logs_in_with_configured_backend(self):
+        self.client.post(reverse('users_register'), self.user_data)
+        urlmatch = re.search(r'https?://[^/]*(/.*activate/\S*)', mail.outbox[0].body)
+        self.client.get(urlmatch.groups()[0])
+        self.assertEqual(self.client.session[BACKEND_SESSION_KEY], 'users.backends.EmailBackend')
+        self.assertEqual(get_user(self.client).email, self.user_data['email'])
+
+    @override_settings(USERS_AUTO_LOGIN_AFTER_REGISTRATION=True,
+                       AUTHENTICATION_BACKENDS=['users.backends.EmailBackend'])
+    def test_registration_logs_in_with_configured_backend(self):
+        self.client.post(reverse('users_register'), self.user_data)
+        self.assertEqual(get_user(self.client).email, self.user_data['email'])
+
+    @override_settings(USERS_AUTO_LOGIN_AFTER_REGISTRATION=True, AUTHENTICATION_BACKENDS=[
+        'tests.test_views.RemoteBackend', 'django.contrib.auth.backends.ModelBackend'])
+    def test_registration_logs_in_with_model_backend(self):
+        self.client.post(reverse('users_register'), self.user_data)
+        self.assertEqual(self.client.session[BACKEND_SESSION_KEY],
+                         'django.contrib.auth.backends.ModelBackend')
+        self.assertEqual(get_user(self.client).email, self.user_data['email'])
+
     @override_settings(USERS_VERIFY_EMAIL=True)
     def test_activation_view_fails_as_expected(self):
         url = reverse('users_activate', kwargs={
@@ -99,3 +146,103 @@ class ActivationViewTest(TestCase):
         resp = self.client.get(url)
         self.assertEqual(200, resp.status_code)
         self.failUnless(resp.context['title'], 'Email confirmation unsuccessful')
+
+    @override_settings(USERS_VERIFY_EMAIL=True)
+    def test_rejected_tokens_do_not_query_the_database(self):
+        expired = date.today() - timedelta(settings.USERS_EMAIL_CONFIRMATION_TIMEOUT_DAYS + 1)
+        tokens = (
+            'bad-69b5cdcd57c6854d1b04',  # timestamp in the future
+            '4ob-69b5cdcd57c6854d1b0',  # short hash
+            '4ob-zzb5cdcd57c6854d1b04',  # not a hexdigest
+            '%s-69b5cdcd57c6854d1b04' % int_to_base36(
+                EmailActivationTokenGenerator._num_days(expired)),
+        )
+        for token in tokens:
+            url = reverse('users_activate', kwargs={'uidb64': 'MQ', 'token': token})
+            with self.assertNumQueries(0):
+                resp = self.client.get(url)
+            self.assertEqual(200, resp.status_code)
+
+    @override_settings(USERS_VERIFY_EMAIL=True)
+    def test_activation_view_downcasts_user(self):
+        customer = Customer.objects.create_user('customer@example.com', 'cu$t0meR')
+        token = EmailActivationTokenGenerator().make_token(customer)
+        received = []
+
+        def on_activated(sender, user, **kwargs):
+            received.append((sender, user.__class__))
+        user_activated.connect(on_activated)
+        try:
+            resp = self.client.get(reverse('users_activate', kwargs={
+                'uidb64': force_text(urlsafe_base64_encode(force_bytes(customer.pk))),
+                'token': token}))
+        finally:
+            user_activated.disconnect(on_activated)
+
+        self.assertRedirects(resp, reverse('users_activation_complete'))
+        self.assertTrue(Customer.objects.get(pk=customer.pk).is_active)
+        self.assertEqual(received, [(Customer, Customer)])
+
+
+@override_settings(USERS_VERIFY_EMAIL=True)
+class ActivationThrottleTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(
+            'user@example.com', 'pa$sw0Rd', is_active=False)
+        self.uidb64 = force_text(urlsafe_base64_encode(force_bytes(self.user.pk)))
+        # well-formed and fresh, but not this user's token
+        self.bad_token = '%s-69b5cdcd57c6854d1b04' % int_to_base36(
+            EmailActivationTokenGenerator._num_days(date.today()))
+
+    def activate(self, uidb64, token, **extra):
+        return self.client.get(reverse('users_activate', kwargs={
+            'uidb64': uidb64, 'token': token}), **extra)
+
+    def test_rejected_tokens_are_remembered(self):
+        with self.assertNumQueries(1):
+            self.activate(self.uidb64, self.bad_token)
+        with self.assertNumQueries(0):
+            resp = self.activate(self.uidb64, self.bad_token)
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(resp.context['title'], 'Email confirmation unsuccessful')
+
+    @override_settings(USERS_ACTIVATION_REJECTED_CACHE_TIMEOUT=0)
+    def test_rejected_token_cache_can_be_disabled(self):
+        self.activate(self.uidb64, self.bad_token)
+        with self.assertNumQueries(1):
+            self.activate(self.uidb64, self.bad_token)
+
+    @override_settings(USERS_ACTIVATION_RATE_LIMIT_PER_IP=3)
+    def test_valid_token_works_after_invalid_attempts_from_other_ips(self):
+        for i in range(10):
+            self.activate(self.uidb64, '%s%d' % (self.bad_token[:-1], i), REMOTE_ADDR='10.0.0.%d' % i)
+        token = EmailActivationTokenGenerator().make_token(self.user)
+        resp = self.activate(self.uidb64, token)
+        self.assertRedirects(resp, reverse('users_activation_complete'))
+        self.assertTrue(get_user_model().objects.get(pk=self.user.pk).is_active)
+
+    @override_settings(USERS_ACTIVATION_RATE_LIMIT_PER_IP=3)
+    def test_attempts_per_ip_are_limited(self):
+        for uidb64 in ('MQ', 'Mg', 'Mw'):
+            self.assertEqual(200, self.activate(uidb64, self.bad_token).status_code)
+        self.assertEqual(429, self.activate('NA', self.bad_token).status_code)
+        resp = self.activate('NA', self.bad_token, REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(200, resp.status_code)
+
+    @override_settings(USERS_ACTIVATION_RATE_LIMIT_PER_IP=3,
+                       USERS_CLIENT_IP_HEADER='HTTP_X_FORWARDED_FOR')
+    def test_client_ip_header(self):
+        # the proxy appends the address of 10.0.0.1, who forged the rest
+        for i in range(3):
+            self.activate('MQ', self.bad_token, HTTP_X_FORWARDED_FOR='1.2.3.%d, 10.0.0.1' % i)
+        self.assertEqual(429, self.activate('MQ', self.bad_token, REMOTE_ADDR='10.0.0.2',
+                                            HTTP_X_FORWARDED_FOR='10.0.0.1').status_code)
+        resp = self.activate('MQ', self.bad_token, HTTP_X_FORWARDED_FOR='10.0.0.2')
+        self.assertEqual(200, resp.status_code)
+
+    @override_settings(USERS_ACTIVATION_RATE_LIMIT_PER_IP=None)
+    def test_limits_can_be_disabled(self):
+        for i in range(50):
+            self.assertEqual(200, self.activate(self.uidb64, self.bad_token).status_code)
@@ -1,11 +1,18 @@
 from django.contrib import admin, messages
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
+from django.core.exceptions import FieldDoesNotExist
+from django.core.paginator import InvalidPage
+from django.db.models.constants import LOOKUP_SEP
+from django.utils import six
 from django.utils.translation import ugettext_lazy as _
 
 from .conf import settings
 from .forms import UserChangeForm, UserCreationForm
 from .models import User
-from .utils import send_activation_email
+from .paginator import EstimatedCountPaginator
+from .utils import send_activation_emails
 
 try:
     from django.contrib.admin.utils import model_ngettext
@@ -22,7 +29,7 @@ class UserModelFilter(admin.SimpleListFilter):
     parameter_name = 'user_type'
 
     def lookups(self, request, model_admin):
-        user_types = set([user.user_type for user in model_admin.model.objects.all()])
+        user_types = model_admin.model.base_objects.get_user_types()
         return [(user_type.id, user_type.name) for user_type in user_types]
 
     def queryset(self, request, queryset):
@@ -37,6 +44,164 @@ class UserModelFilter(admin.SimpleListFilter):
             return queryset
 
 
+AFTER_VAR = 'after'
+BEFORE_VAR = 'before'
+
+
+class UserChangeList(ChangeList):
+    """
+    With ``USERS_ADMIN_FAST_PAGINATION``, counts are estimated past a
+    threshold and pages are linked with keyset cursors on the ordering
+    field (``?after=<email>``), so a page costs the same at any offset.
+    """
+
+    def __init__(self, request, *args, **kwargs):
+        self.fast_pagination = settings.USERS_ADMIN_FAST_PAGINATION
+        self.after = request.GET.get(AFTER_VAR)
+        self.before = request.GET.get(BEFORE_VAR)
+        self.keyset_field = None
+        self.result_count_is_estimate = False
+        self.previous_page_url = self.next_page_url = None
+        super(UserChangeList, self).__init__(request, *args, **kwargs)
+        # like the page number, cursors aren't kept when filtering or sorting
+        self.params.pop(AFTER_VAR, None)
+        self.params.pop(BEFORE_VAR, None)
+
+    def get_queryset(self, request):
+        queryset = super(UserChangeList, self).get_queryset(request)
+        fields = self.get_list_fields(queryset)
+        if fields is not None:
+            queryset = queryset.only(*fields)
+        return queryset
+
+    def get_list_fields(self, queryset):
+        """
+        Returns the fields needed to display the list (``list_display`` and
+        the ordering fields), or ``None`` if ``list_display`` has entries
+        which may read any field.
+        """
+        fields = [self.lookup_opts.pk.name]
+        names = list(self.list_display) + [
+            field.lstrip('-') for field in queryset.query.order_by
+            if isinstance(field, six.string_types)]
+        if isinstance(self.list_select_related, (list, tuple)):
+            names.extend(name.split(LOOKUP_SEP)[0] for name in self.list_select_related)
+        for name in names:
+            if name in ('action_checkbox', 'pk'):
+                continue
+            if name == '__str__':
+                name = self.model.USERNAME_FIELD
+            try:
+                field = self.lookup_opts.get_field(name)
+            except FieldDoesNotExist:
+                return None
+            if not field.concrete or field.many_to_many:
+                return None
+            if field.name not in fields:
+                fields.append(field.name)
+        return fields
+
+    def get_filters_params(self, params=None):
+        lookup_params = super(UserChangeList, self).get_filters_params(params)
+        lookup_params.pop(AFTER_VAR, None)
+        lookup_params.pop(BEFORE_VAR, None)
+        return lookup_params
+
+    def get_results(self, request):
+        if not self.fast_pagination:
+            return super(UserChangeList, self).get_results(request)
+
+        ordering = self.queryset.query.order_by
+        if (len(ordering) == 1 and self._is_unique(ordering[0])
+                and not self.list_editable and not self.show_all):
+            self.keyset_field = ordering[0]
+
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        self.result_count = paginator.count
+        self.result_count_is_estimate = paginator.count_is_estimate
+        self.show_full_result_count = self.model_admin.show_full_result_count
+        if self.show_full_result_count:
+            self.full_result_count = self.model_admin.get_paginator(
+                request, self.root_queryset, self.list_per_page).count
+        else:
+            self.full_result_count = None
+        self.show_admin_actions = not self.show_full_result_count or bool(self.full_result_count)
+        self.can_show_all = self.result_count <= self.list_max_show_all
+        self.multi_page = self.result_count > self.list_per_page
+        self.paginator = paginator
+
+        if self.keyset_field and (self.after is not None or self.before is not None):
+            self.get_keyset_page()
+        elif (self.show_all and self.can_show_all) or not self.multi_page:
+            self.result_list = self.queryset._clone()
+        else:
+            try:
+                self.result_list = paginator.page(self.page_num + 1).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+            if self.keyset_field:
+                # numbered pages link to their neighbours with cursors too
+                self.result_list = list(self.result_list)
+                self.set_cursors(self.page_num > 0, self.page_num + 1 < paginator.num_pages)
+
+    def get_keyset_page(self):
+        name = self.keyset_field.lstrip('-')
+        descending = self.keyset_field.startswith('-')
+        if self.after is not None:
+            lookup = '%s__%s' % (name, 'lt' if descending else 'gt')
+            results = list(self.queryset.filter(**{lookup: self.after})[:self.list_per_page + 1])
+            has_next = len(results) > self.list_per_page
+            results = results[:self.list_per_page]
+            has_previous = True
+        else:
+            lookup = '%s__%s' % (name, 'gt' if descending else 'lt')
+            results = list(self.queryset.filter(
+                **{lookup: self.before}).reverse()[:self.list_per_page + 1])
+            has_previous = len(results) > self.list_per_page
+            results = results[:self.list_per_page][::-1]
+            has_next = True
+        self.result_list = results
+        self.set_cursors(has_previous and bool(results), has_next and bool(results))
+
+    def set_cursors(self, has_previous, has_next):
+        name = self.keyset_field.lstrip('-')
+        if has_previous:
+            self.previous_page_url = self.get_query_string(
+                {BEFORE_VAR: getattr(self.result_list[0], name)}, [AFTER_VAR])
+        if has_next:
+            self.next_page_url = self.get_query_string(
+                {AFTER_VAR: getattr(self.result_list[-1], name)}, [BEFORE_VAR])
+
+    def get_ordering(self, request, queryset):
+        ordering = super(UserChangeList, self).get_ordering(request, queryset)
+        # the queryset ordering is appended to the admin ordering, which
+        # repeats the email ordering of UserAdmin.get_queryset().
+        fields, seen = [], set()
+        for field in ordering:
+            if isinstance(field, six.string_types):
+                if field.lstrip('-') in seen:
+                    continue
+                seen.add(field.lstrip('-'))
+            fields.append(field)
+        ordering = fields
+        # the admin appends '-pk' to make the ordering deterministic, which
+        # an ordering on a unique field like email already is. Dropping it
+        # lets the database read the filter indexes in order instead of
+        # sorting the results.
+        if ordering and ordering[-1] == '-pk' and any(
+                self._is_unique(field) for field in ordering[:-1]):
+            ordering = ordering[:-1]
+        return ordering
+
+    def _is_unique(self, field_name):
+        if not isinstance(field_name, six.string_types):
+            return False
+        try:
+            return self.lookup_opts.get_field(field_name.lstrip('-')).unique
+        except FieldDoesNotExist:
+            return False
+
+
 class UserAdmin(BaseUserAdmin):
     fieldsets = (
         (None, {
@@ -76,17 +241,36 @@ class UserAdmin(BaseUserAdmin):
             qs = qs.order_by(*ordering)
         return qs
 
+    def get_changelist(self, request, **kwargs):
+        return UserChangeList
+
+    def get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        if settings.USERS_ADMIN_FAST_PAGINATION:
+            return EstimatedCountPaginator(
+                queryset, per_page, orphans, allow_empty_first_page,
+                threshold=settings.USERS_ADMIN_EXACT_COUNT_THRESHOLD,
+                cache_timeout=settings.USERS_ADMIN_COUNT_CACHE_TIMEOUT)
+        return super(UserAdmin, self).get_paginator(
+            request, queryset, per_page, orphans, allow_empty_first_page)
+
+    def get_search_results(self, request, queryset, search_term):
+        if not settings.USERS_ADMIN_PREFIX_SEARCH:
+            return super(UserAdmin, self).get_search_results(request, queryset, search_term)
+        # a prefix of the indexed normalized_email column instead of
+        # ``email__icontains``, which has to scan the whole table. A range up
+        # to the prefix + u'\uffff' would drop matches under most collations.
+        prefix = self.model.base_objects.normalize_email_case(search_term)
+        if prefix:
+            queryset = queryset.filter(normalized_email__startswith=prefix)
+        return queryset, False
+
     def activate_users(self, request, queryset):
         """
         Activates the selected users, if they are not already
         activated.
 
         """
-        n = 0
-        for user in queryset:
-            if not user.is_active:
-                user.activate()
-                n += 1
+        n = self.model.base_objects.bulk_activate(queryset, request=request)
         self.message_user(
             request,
             _('Successfully activated %(count)d %(items)s.') %
@@ -98,15 +282,18 @@ class UserAdmin(BaseUserAdmin):
         Send activation emails for the selected users, if they are not already
         activated.
         """
-        n = 0
-        for user in queryset:
-            if not user.is_active and settings.USERS_VERIFY_EMAIL:
-                send_activation_email(user=user, request=request)
-                n += 1
+        # the change list only loads the displayed columns, the activation
+        # token needs the full rows.
+        n, failures = send_activation_emails(
+            queryset.defer(None).filter(is_active=False).iterator(), request=request)
 
         self.message_user(
             request, _('Activation emails sent to %(count)d %(items)s.') %
             {'count': n, 'items': model_ngettext(self.opts, n)},  messages.SUCCESS)
+        if failures:
+            self.message_user(
+                request, _('Failed to send activation emails to: %s') %
+                ', '.join(sorted(failures)), messages.WARNING)
 
     send_activation_email.short_description = \
         _('Send activation emails to selected %(verbose_name_plural)s')
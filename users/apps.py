@@ -0,0 +1,27 @@
+from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_migrate
+from django.utils.translation import ugettext_lazy as _
+
+
+class UsersConfig(AppConfig):
+    name = 'users'
+    verbose_name = _('Users')
+
+    def ready(self):
+        from .registry import user_types
+        user_types.populate()
+        post_migrate.connect(user_types.clear)
+        for model in user_types.models:
+            post_delete.connect(invalidate_cached_user, sender=model)
+
+        from .conf import settings
+        if settings.USERS_VALIDATE_EMAIL_MX:
+            from .mx import get_resolver
+            get_resolver()
+
+
+def invalidate_cached_user(sender, instance, using=None, **kwargs):
+    from .managers import invalidate_cached_users, invalidate_user_types
+    invalidate_cached_users([instance.pk], using=using)
+    # this may have been the last user of its type
+    invalidate_user_types(sender)
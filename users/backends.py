@@ -0,0 +1,75 @@
+import copy
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+from django.utils.crypto import get_random_string
+
+from .conf import settings
+from .managers import user_cache_version_key
+
+
+class EmailBackend(ModelBackend):
+    """
+    Authenticates against the indexed ``normalized_email`` column of the
+    base user table, downcasting the user only once the password matches.
+
+    ``get_user()`` serves the user of each authenticated request from the
+    cache for ``USERS_USER_CACHE_TIMEOUT`` seconds, without the password
+    hash. Cache entries are keyed by a per-user version, which is dropped
+    when the user is saved, deleted or bulk activated, and again once the
+    transaction commits.
+    """
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        UserModel = get_user_model()
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+        try:
+            user = UserModel.base_objects.get_by_natural_key(username)
+        except UserModel.DoesNotExist:
+            # Run the default password hasher once to reduce the timing
+            # difference between an existing and a non-existing user.
+            UserModel().set_password(password)
+        else:
+            if user.check_password(password) and self.user_can_authenticate(user):
+                return user.as_subclass()
+
+    def get_user(self, user_id):
+        timeout = settings.USERS_USER_CACHE_TIMEOUT
+        if not timeout:
+            user = self._load_user(user_id)
+        else:
+            version_key = user_cache_version_key(user_id)
+            version = cache.get(version_key)
+            if version is None:
+                # a new version, so entries cached before an invalidation
+                # can't be read again.
+                cache.add(version_key, get_random_string(12), timeout)
+                version = cache.get(version_key)
+            key = 'users.user.%s.%s' % (user_id, version)
+            user = cache.get(key)
+            if user is None:
+                user = self._load_user(user_id)
+                if user is not None:
+                    cache.set(key, self._cacheable(user), timeout)
+        return user if user is not None and self.user_can_authenticate(user) else None
+
+    def _cacheable(self, user):
+        """
+        Returns a copy of ``user`` without its password hash, which is
+        deferred (loaded again if accessed, left alone by ``save()``), and
+        with its session auth hash instead.
+        """
+        cached = copy.copy(user)
+        cached._session_auth_hash = user.get_session_auth_hash()
+        del cached.__dict__['password']
+        return cached
+
+    def _load_user(self, user_id):
+        UserModel = get_user_model()
+        try:
+            user = UserModel.base_objects.get(pk=user_id)
+        except UserModel.DoesNotExist:
+            return None
+        return user.as_subclass()
@@ -0,0 +1,82 @@
+import hashlib
+import math
+import struct
+
+from django.core.cache import cache
+from django.utils.encoding import force_bytes
+
+from .conf import settings
+from .managers import UserManager
+
+EMAIL_FILTER_CACHE_KEY = 'users.email_filter'
+
+
+class BloomFilter(object):
+    """
+    A fixed size Bloom filter: membership tests never give false negatives,
+    and give false positives at roughly ``error_rate`` once ``capacity``
+    values have been added.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        # double hashing: derive every position from two 64 bit hashes
+        h1, h2 = struct.unpack('<QQ', hashlib.sha1(force_bytes(value)).digest()[:16])
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(value))
+
+
+def build_email_filter(emails):
+    """
+    Builds a filter of ``emails`` and stores it in the cache.
+    """
+    email_filter = BloomFilter(
+        settings.USERS_EMAIL_FILTER_CAPACITY, settings.USERS_EMAIL_FILTER_ERROR_RATE)
+    count = 0
+    for email in emails:
+        email_filter.add(UserManager.normalize_email_case(email))
+        count += 1
+    cache.set(EMAIL_FILTER_CACHE_KEY, email_filter, None)
+    return count
+
+
+def add_to_email_filter(emails):
+    """
+    Adds new or changed emails to the cached filter, if there is one.
+
+    Concurrent updates aren't locked, one of them may be lost. The filter
+    is only a hint, see ``email_may_exist()``.
+    """
+    if not settings.USERS_EMAIL_FILTER:
+        return
+    email_filter = cache.get(EMAIL_FILTER_CACHE_KEY)
+    if email_filter is not None:
+        for email in emails:
+            email_filter.add(UserManager.normalize_email_case(email))
+        cache.set(EMAIL_FILTER_CACHE_KEY, email_filter, None)
+
+
+def email_may_exist(email):
+    """
+    Returns ``False`` if ``email`` is most likely not registered, i.e. the
+    filter is enabled, built and doesn't contain it.
+
+    Emails saved while the filter was built or updated concurrently, and
+    emails written with ``update()``, may be missing from the filter, so
+    this is only a hint: the database has the final say.
+    """
+    if not settings.USERS_EMAIL_FILTER:
+        return True
+    email_filter = cache.get(EMAIL_FILTER_CACHE_KEY)
+    return email_filter is None or UserManager.normalize_email_case(email) in email_filter
@@ -0,0 +1,168 @@
+import hashlib
+import heapq
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from django.utils.encoding import force_bytes
+
+# header: magic, then the length of the (sorted, fixed size) records which
+# hold the first bytes of the SHA-1 digests of breached passwords.
+MAGIC = b'USRSBPW1'
+HEADER = struct.Struct('>8sB7x')
+
+
+def password_digest(password, length):
+    return hashlib.sha1(force_bytes(password)).digest()[:length]
+
+
+class BreachedPasswordIndex(object):
+    """
+    A sorted file of SHA-1 digest prefixes, memory mapped and looked up
+    with a binary search so only the pages visited are read from disk.
+    """
+    check_interval = 1
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, self.record_length = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError('%s is not a breached passwords file.' % path)
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._file_version = self.file_version(os.fstat(f.fileno()))
+        self._checked = time.time()
+        self.count = (len(self._map) - HEADER.size) // self.record_length
+
+    @staticmethod
+    def file_version(stat):
+        return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+    def is_stale(self):
+        """
+        Returns whether ``path`` was replaced or modified since it was
+        opened, checking at most every ``check_interval`` seconds.
+        """
+        now = time.time()
+        if now - self._checked < self.check_interval:
+            return False
+        self._checked = now
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            # keep the last version while the file is being replaced
+            return False
+        return self.file_version(stat) != self._file_version
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, password):
+        return self.contains_digest(password_digest(password, self.record_length))
+
+    def contains_digest(self, digest):
+        digest = digest[:self.record_length]
+        length, data = self.record_length, self._map
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start = HEADER.size + middle * length
+            record = data[start:start + length]
+            if record < digest:
+                low = middle + 1
+            elif record > digest:
+                high = middle
+            else:
+                return True
+        return False
+
+    def close(self):
+        self._map.close()
+
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def get_breached_password_index(path):
+    with _lock:
+        index = _indexes.get(path)
+        if index is None or index.is_stale():
+            # the replaced index isn't closed as other threads may still be
+            # searching it, it's unmapped once they drop it.
+            index = _indexes[path] = BreachedPasswordIndex(path)
+        return index
+
+
+def close_breached_password_indexes():
+    with _lock:
+        for index in _indexes.values():
+            index.close()
+        _indexes.clear()
+
+
+def parse_hash(line):
+    """
+    Returns the digest of a ``<SHA-1 hex>[:<count>]`` line, as in the
+    offline Pwned Passwords downloads.
+    """
+    line = line.strip()
+    if not line:
+        return None
+    return bytearray.fromhex(line.split(b':', 1)[0].decode('ascii'))
+
+
+def write_breached_password_file(digests, path, record_length=10, chunk_size=10 ** 7):
+    """
+    Writes an iterable of SHA-1 digests as a sorted, deduplicated
+    breached passwords file at ``path``. Digests are sorted in chunks of
+    ``chunk_size`` which are then merged, so memory use is bounded by the
+    chunk size rather than the corpus size. Returns the number of records.
+    """
+    runs = []
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        chunk = []
+        for digest in digests:
+            chunk.append(bytes(digest[:record_length]))
+            if len(chunk) >= chunk_size:
+                runs.append(_write_run(sorted(chunk), directory))
+                chunk = []
+        runs.append(_write_run(sorted(chunk), directory))
+
+        count = 0
+        previous = None
+        files = [open(run, 'rb') for run in runs]
+        try:
+            with open(path, 'wb') as output:
+                output.write(HEADER.pack(MAGIC, record_length))
+                for record in heapq.merge(*[_read_run(f, record_length) for f in files]):
+                    if record != previous:
+                        output.write(record)
+                        previous = record
+                        count += 1
+        finally:
+            for f in files:
+                f.close()
+        return count
+    finally:
+        for run in runs:
+            os.remove(run)
+
+
+def _write_run(records, directory):
+    fd, run = tempfile.mkstemp(suffix='.run', dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(b''.join(records))
+    return run
+
+
+def _read_run(f, record_length):
+    while True:
+        record = f.read(record_length)
+        if len(record) < record_length:
+            return
+        yield record
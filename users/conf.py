@@ -9,6 +9,9 @@ class UsersAppConf(AppConf):
     SUPERUSER_PASSWORD = 'django'
     EMAIL_CONFIRMATION_TIMEOUT_DAYS = 3
     SPAM_PROTECTION = True
+    SPAM_TIMING_CHECK = False
+    SPAM_MIN_SUBMIT_TIME = 3
+    SPAM_MAX_SUBMIT_TIME = 24 * 60 * 60
     REGISTRATION_OPEN = True
     AUTO_LOGIN_ON_ACTIVATION = True
     AUTO_LOGIN_AFTER_REGISTRATION = False
@@ -21,9 +24,38 @@ class UsersAppConf(AppConf):
         'DIGITS': 0,      # Digits '0123456789'
         'PUNCTUATION': 0  # Punctuation """!"#$%&'()*+,-./:;<=>?@[\]^_`{|}~"""
     }
+    BREACHED_PASSWORDS_FILE = None
     VALIDATE_EMAIL_DOMAIN = True
     EMAIL_DOMAINS_BLACKLIST = []
     EMAIL_DOMAINS_WHITELIST = []
+    EMAIL_DOMAINS_BLACKLIST_FILE = None
+    EMAIL_DOMAINS_WHITELIST_FILE = None
+    VALIDATE_EMAIL_MX = False
+    EMAIL_MX_RESOLVER = 'users.mx.DNSPythonResolver'
+    EMAIL_MX_TIMEOUT = 2
+    EMAIL_MX_MAX_TTL = 24 * 60 * 60
+    EMAIL_MX_WORKERS = 10
+    RESOLVE_SUBCLASSES_BY_TYPE = False
+    USER_TYPES_CACHE_TIMEOUT = 60 * 60
+    EMAIL_DISPATCH_BACKEND = None
+    EMAIL_DISPATCH_WORKERS = 2
+    EMAIL_DISPATCH_MAX_RETRIES = 3
+    EMAIL_DISPATCH_RETRY_DELAY = 30
+    EMAIL_TEMPLATE_CACHE_SIZE = 64
+    ACTIVATION_RATE_LIMIT_WINDOW = 60 * 60
+    ACTIVATION_RATE_LIMIT_PER_IP = 30
+    CLIENT_IP_HEADER = 'REMOTE_ADDR'
+    ACTIVATION_REJECTED_CACHE_TIMEOUT = 5 * 60
+    EMAIL_FILTER = False
+    EMAIL_FILTER_CAPACITY = 1000000
+    EMAIL_FILTER_ERROR_RATE = 0.01
+    ADMIN_PREFIX_SEARCH = False
+    ADMIN_FAST_PAGINATION = False
+    ADMIN_EXACT_COUNT_THRESHOLD = 10000
+    ADMIN_COUNT_CACHE_TIMEOUT = 60
+    USER_CACHE_TIMEOUT = 5 * 60
+    SIGNAL_DISPATCH = 'sync'
+    SIGNAL_SLOW_RECEIVER_THRESHOLD = 0.5
 
     class Meta:
         prefix = 'users'
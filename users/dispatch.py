@@ -0,0 +1,426 @@
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import timedelta
+
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.signals import setting_changed
+from django.db import close_old_connections, connections, router, transaction
+from django.db.models.signals import post_delete, post_save
+from django.template.loader import get_template
+from django.utils import timezone, translation
+from django.utils.module_loading import import_string
+from django.utils.six.moves import queue
+from django.utils.translation import get_language
+
+from .conf import settings
+from .models import QueuedActivationEmail
+
+try:
+    from django.contrib.sites.shortcuts import get_current_site
+except ImportError:  # pragma: no cover
+    from django.contrib.sites.models import get_current_site
+
+logger = logging.getLogger(__name__)
+
+ActivationSite = namedtuple('ActivationSite', ['domain', 'name'])
+
+
+class LRUCache(object):
+    """
+    A small thread-safe mapping which keeps the ``size`` most recently
+    used entries.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.pop(key, None)
+            if value is not None:
+                self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        if not self.size:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+_templates = LRUCache(settings.USERS_EMAIL_TEMPLATE_CACHE_SIZE)
+_sites = LRUCache(settings.USERS_EMAIL_TEMPLATE_CACHE_SIZE)
+
+
+def get_email_template(template_name):
+    """
+    Returns the compiled template for ``template_name`` in the active
+    language, loading it only once.
+    """
+    key = (template_name, get_language())
+    template = _templates.get(key)
+    if template is None:
+        template = get_template(template_name)
+        _templates.set(key, template)
+    return template
+
+
+def get_request_site(request):
+    """
+    Returns the current site and protocol for ``request``, memoized per
+    host so site lookups are done once per host.
+    """
+    key = (request.get_host(), request.is_secure())
+    site = _sites.get(key)
+    if site is None:
+        site = (get_current_site(request), 'https' if request.is_secure() else 'http')
+        _sites.set(key, site)
+    return site
+
+
+def clear_email_caches(**kwargs):
+    if kwargs.get('setting') in (None, 'TEMPLATES', 'SITE_ID',
+                                 'USERS_EMAIL_TEMPLATE_CACHE_SIZE'):
+        _templates.size = _sites.size = settings.USERS_EMAIL_TEMPLATE_CACHE_SIZE
+        _templates.clear()
+        _sites.clear()
+
+
+setting_changed.connect(clear_email_caches)
+
+if apps.is_installed('django.contrib.sites'):
+    from django.contrib.sites.models import Site
+    post_save.connect(clear_email_caches, sender=Site)
+    post_delete.connect(clear_email_caches, sender=Site)
+
+
+def build_activation_email(job, user=None, site=None):
+    """
+    Renders the activation email described by ``job``, a dict of the
+    primitives collected by ``users.utils.send_activation_email``.
+    """
+    context = {
+        'email': job['email'],
+        'site': site or ActivationSite(job['domain'], job['site_name']),
+        'expiration_days': settings.USERS_EMAIL_CONFIRMATION_TIMEOUT_DAYS,
+        'user': user,
+        'uid': job['uid'],
+        'token': job['token'],
+        'protocol': job['protocol'],
+    }
+
+    with translation.override(job['language']):
+        subject = get_email_template(job['subject_template']).render(context)
+        # email subject *must not* contain newlines
+        subject = ''.join(subject.splitlines())
+        body = get_email_template(job['email_template']).render(context)
+
+        email_message = EmailMultiAlternatives(
+            subject, body, job['from_email'], [job['email']])
+        if job['html_email_template'] is not None:
+            html_email = get_email_template(job['html_email_template']).render(context)
+            email_message.attach_alternative(html_email, 'text/html')
+
+    return email_message
+
+
+def send_messages(messages, connection=None):
+    """
+    Sends ``messages`` over a single mail connection, one at a time so a
+    failing recipient doesn't abort the rest. Returns the exceptions raised,
+    keyed by position in ``messages``.
+    """
+    failures = {}
+    if not messages:
+        return failures
+
+    connection = connection or get_connection()
+    try:
+        connection.open()
+    except Exception as e:
+        # nothing can be sent, fail the whole batch so it is retried
+        return dict.fromkeys(range(len(messages)), e)
+    try:
+        for i, message in enumerate(messages):
+            try:
+                connection.send_messages([message])
+            except Exception as e:
+                failures[i] = e
+    finally:
+        connection.close()
+    return failures
+
+
+class BaseDispatchBackend(object):
+    """
+    Base class for activation email backends which send emails outside of
+    the request/response cycle.
+    """
+
+    def __init__(self, max_retries=None, retry_delay=None):
+        if max_retries is None:
+            max_retries = settings.USERS_EMAIL_DISPATCH_MAX_RETRIES
+        if retry_delay is None:
+            retry_delay = settings.USERS_EMAIL_DISPATCH_RETRY_DELAY
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._lock = threading.Lock()
+        self.sent = self.failed = self.retried = 0
+        self.send_time = 0.0
+
+    def enqueue(self, job, user=None):
+        raise NotImplementedError  # pragma: no cover
+
+    def queue_depth(self):
+        raise NotImplementedError  # pragma: no cover
+
+    def get_retry_delay(self, attempts):
+        """
+        Exponential backoff: ``retry_delay`` seconds doubled on each attempt.
+        """
+        return self.retry_delay * 2 ** (attempts - 1)
+
+    def deliver(self, items):
+        """
+        Renders ``(job, user)`` pairs and sends them over one mail connection.
+        Returns the exceptions raised, keyed by position in ``items``.
+        """
+        start = time.time()
+        messages, positions, failures = [], [], {}
+        for i, (job, user) in enumerate(items):
+            try:
+                messages.append(build_activation_email(job, user=user))
+            except Exception as e:
+                failures[i] = e
+            else:
+                positions.append(i)
+
+        for i, e in send_messages(messages).items():
+            failures[positions[i]] = e
+
+        with self._lock:
+            self.sent += len(items) - len(failures)
+            self.send_time += time.time() - start
+        return failures
+
+    def record_failure(self, job, attempts, error):
+        will_retry = attempts <= self.max_retries
+        logger.warning(
+            'Sending activation email to %s failed (attempt %d%s): %r', job['email'],
+            attempts, '' if will_retry else ', giving up', error)
+        with self._lock:
+            if will_retry:
+                self.retried += 1
+            else:
+                self.failed += 1
+        return will_retry
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queue_depth': self.queue_depth(),
+                'sent': self.sent,
+                'retried': self.retried,
+                'failed': self.failed,
+                'avg_send_latency': self.send_time / self.sent if self.sent else 0.0,
+            }
+
+
+class ThreadPoolBackend(BaseDispatchBackend):
+    """
+    Sends activation emails from a pool of in-process worker threads.
+
+    Failed emails wait for their retry in a heap ordered by due time, which
+    a scheduler thread moves back onto the queue, so workers never sleep.
+
+    Jobs are queued once the current transaction commits, without the user:
+    the request goes on changing it, so the workers load it again and skip
+    users activated in the meantime.
+    """
+
+    def __init__(self, workers=None, **kwargs):
+        super(ThreadPoolBackend, self).__init__(**kwargs)
+        self.workers = workers or settings.USERS_EMAIL_DISPATCH_WORKERS
+        self.queue = queue.Queue()
+        self._threads = []
+        self._retries = []
+        self._retry_condition = threading.Condition()
+        self._retry_counter = itertools.count()
+        self._scheduler = None
+
+    def _start(self):
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name='users-dispatch')
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            if self._scheduler is None or not self._scheduler.is_alive():
+                self._scheduler = threading.Thread(
+                    target=self._schedule, name='users-dispatch-retries')
+                self._scheduler.daemon = True
+                self._scheduler.start()
+
+    def enqueue(self, job, user=None):
+        self._start()
+        using = router.db_for_write(get_user_model())
+        transaction.on_commit(lambda: self.queue.put((job, 0)), using=using)
+
+    def _work(self):
+        while True:
+            job, attempts = self.queue.get()
+            retrying = False
+            try:
+                try:
+                    user = get_user_model().base_objects.filter(
+                        pk=job['user_id'], is_active=False).first()
+                    failures = self.deliver([(job, user)]) if user is not None else {}
+                except Exception as e:
+                    failures = {0: e}
+                finally:
+                    close_old_connections()
+                if failures:
+                    attempts += 1
+                    if self.record_failure(job, attempts, failures[0]):
+                        self._retry(job, attempts)
+                        retrying = True
+            finally:
+                # a retried email stays unfinished until the scheduler has
+                # queued it again, so join() waits for it.
+                if not retrying:
+                    self.queue.task_done()
+
+    def _retry(self, job, attempts):
+        due = time.time() + self.get_retry_delay(attempts)
+        with self._retry_condition:
+            heapq.heappush(self._retries, (due, next(self._retry_counter), job, attempts))
+            self._retry_condition.notify()
+
+    def _schedule(self):
+        while True:
+            with self._retry_condition:
+                while not self._retries:
+                    self._retry_condition.wait()
+                delay = self._retries[0][0] - time.time()
+                if delay > 0:
+                    self._retry_condition.wait(delay)
+                    continue
+                due, counter, job, attempts = heapq.heappop(self._retries)
+            self.queue.put((job, attempts))
+            self.queue.task_done()
+
+    def join(self):
+        """
+        Blocks until every queued email has been sent or given up on.
+        """
+        self.queue.join()
+
+    def queue_depth(self):
+        with self._retry_condition:
+            return self.queue.qsize() + len(self._retries)
+
+
+class OutboxBackend(BaseDispatchBackend):
+    """
+    Stores activation emails in the ``QueuedActivationEmail`` table, to be
+    sent by the ``send_queued_activation_emails`` management command.
+    """
+    lease = timedelta(minutes=5)
+
+    def enqueue(self, job, user=None):
+        QueuedActivationEmail.objects.create(user_id=job['user_id'], payload=json.dumps(job))
+
+    def queue_depth(self):
+        return QueuedActivationEmail.objects.filter(next_attempt__isnull=False).count()
+
+    def _claim(self, limit, due=None):
+        """
+        Leases up to ``limit`` emails due by ``due`` (now by default) so
+        concurrent workers skip them.
+        """
+        now = timezone.now()
+        if due is None:
+            due = now
+        db = router.db_for_write(QueuedActivationEmail)
+        skip_locked = connections[db].features.has_select_for_update_skip_locked
+        with transaction.atomic(using=db):
+            pks = list(QueuedActivationEmail.objects.select_for_update(
+                skip_locked=skip_locked).filter(next_attempt__lte=due).order_by(
+                'next_attempt').values_list('pk', flat=True)[:limit])
+            QueuedActivationEmail.objects.filter(pk__in=pks).update(
+                next_attempt=now + self.lease)
+        return QueuedActivationEmail.objects.filter(pk__in=pks).select_related('user')
+
+    def process(self, limit=100, due=None):
+        """
+        Sends up to ``limit`` emails due by ``due`` (now by default), returns
+        the number processed. Emails which fail are due again later, so
+        repeated calls with the same ``due`` don't retry them.
+        """
+        entries = list(self._claim(limit, due))
+        pending = []
+        for entry in entries:
+            if entry.user.is_active:
+                entry.delete()
+            else:
+                pending.append(entry)
+
+        failures = self.deliver(
+            [(json.loads(entry.payload), entry.user) for entry in pending])
+        for i, entry in enumerate(pending):
+            if i not in failures:
+                entry.delete()
+                continue
+            entry.attempts += 1
+            if self.record_failure(json.loads(entry.payload), entry.attempts, failures[i]):
+                entry.next_attempt = timezone.now() + timedelta(
+                    seconds=self.get_retry_delay(entry.attempts))
+            else:
+                entry.next_attempt = None
+            entry.last_error = repr(failures[i])
+            entry.save()
+        return len(entries)
+
+
+_backends = {}
+
+
+def get_dispatch_backend():
+    """
+    Returns the backend configured by ``USERS_EMAIL_DISPATCH_BACKEND``, or
+    ``None`` if activation emails are sent synchronously.
+    """
+    path = settings.USERS_EMAIL_DISPATCH_BACKEND
+    if not path:
+        return None
+    if path not in _backends:
+        _backends[path] = import_string(path)()
+    return _backends[path]
+
+
+def reset_dispatch_backends(**kwargs):
+    if kwargs['setting'].startswith('USERS_EMAIL_DISPATCH_'):
+        _backends.clear()
+
+
+setting_changed.connect(reset_dispatch_backends)
@@ -0,0 +1,94 @@
+import io
+import os
+import threading
+import time
+
+from django.utils.encoding import force_text
+
+
+def normalize_domain(domain):
+    return force_text(domain).strip().lower().rstrip('.')
+
+
+class DomainList(object):
+    """
+    A set of email domains, checked in a constant number of set lookups
+    (one per label of the domain) whatever the size of the list.
+
+    Like ``ALLOWED_HOSTS``, ``example.com`` only matches itself,
+    ``.example.com`` matches it and all of its subdomains and
+    ``*.example.com`` only its subdomains. Domains can also be read from
+    ``path``, one per line (``#`` starts a comment); the file is read again
+    when it changes, checking at most every ``check_interval`` seconds.
+    """
+    check_interval = 1
+
+    def __init__(self, domains=(), path=None):
+        self.path = path
+        self._exact, self._wildcard = self.compile(domains)
+        self._file_exact = self._file_wildcard = frozenset()
+        self._file_version = None
+        self._checked = 0
+        self._lock = threading.Lock()
+        if path:
+            self.refresh(force=True)
+
+    @staticmethod
+    def compile(domains):
+        exact, wildcard = set(), set()
+        for domain in domains:
+            domain = normalize_domain(domain)
+            if domain.startswith('*.'):
+                wildcard.add(domain[2:])
+            elif domain.startswith('.'):
+                exact.add(domain[1:])
+                wildcard.add(domain[1:])
+            elif domain:
+                exact.add(domain)
+        return frozenset(exact), frozenset(wildcard)
+
+    def refresh(self, force=False):
+        """
+        Reads ``path`` again if it was modified since it was last read.
+        """
+        now = time.time()
+        if not force and now - self._checked < self.check_interval:
+            return
+        with self._lock:
+            self._checked = now
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                if self._file_version is None:
+                    raise
+                # keep the last version while the file is being replaced
+                return
+            version = (stat.st_mtime, stat.st_size, stat.st_ino)
+            if version == self._file_version:
+                return
+            with io.open(self.path, encoding='utf-8') as f:
+                domains = [line.split('#', 1)[0] for line in f]
+            self._file_exact, self._file_wildcard = self.compile(domains)
+            self._file_version = version
+
+    def __contains__(self, domain):
+        if self.path:
+            self.refresh()
+        domain = normalize_domain(domain)
+        if domain in self._exact or domain in self._file_exact:
+            return True
+        wildcard, file_wildcard = self._wildcard, self._file_wildcard
+        if not wildcard and not file_wildcard:
+            return False
+        parent = domain
+        while '.' in parent:
+            parent = parent.split('.', 1)[1]
+            if parent in wildcard or parent in file_wildcard:
+                return True
+        return False
+
+    def __bool__(self):
+        if self.path:
+            self.refresh()
+        return bool(self._exact or self._wildcard or self._file_exact or self._file_wildcard)
+    __nonzero__ = __bool__
@@ -1,12 +1,18 @@
 import string
+import time
 
 from django import forms
+from django.core import signing
+from django.core.signals import setting_changed
 from django.core.validators import validate_email
 from django.forms.widgets import CheckboxInput
 from django.utils.encoding import force_text
 from django.utils.translation import ugettext_lazy as _
 
+from .breached import close_breached_password_indexes, get_breached_password_index
 from .conf import settings
+from .domains import DomainList, normalize_domain
+from .mx import check_domains
 
 
 class LengthValidator(object):
@@ -29,59 +35,167 @@ class LengthValidator(object):
 length_validator = LengthValidator()
 
 
+# character classes, in the order the policy rules are checked.
+PASSWORD_CATEGORIES = ('UPPER', 'LOWER', 'DIGITS', 'PUNCTUATION')
+
+_ascii_categories = {}
+for _chars, _category in ((string.ascii_uppercase, 'UPPER'),
+                          (string.ascii_lowercase, 'LOWER'),
+                          (string.digits, 'DIGITS'),
+                          (string.punctuation, 'PUNCTUATION')):
+    _ascii_categories.update(dict.fromkeys(_chars, _category))
+
+
+def get_char_category(char):
+    category = _ascii_categories.get(char)
+    if category is None and char > '\x7f':
+        if char.isupper():
+            return 'UPPER'
+        elif char.islower():
+            return 'LOWER'
+        elif char.isdigit():
+            return 'DIGITS'
+    return category
+
+
+class PasswordPolicy(object):
+    """
+    A ``USERS_PASSWORD_POLICY`` dict compiled into the rules to check:
+    the minimum number of distinct characters of each category.
+    """
+    messages = {
+        'UPPER': _('must contain %(UPPER)s or more uppercase characters (A-Z)'),
+        'LOWER': _('Must contain %(LOWER)s or more lowercase characters (a-z)'),
+        'DIGITS': _('must contain %(DIGITS)s or more numbers (0-9)'),
+        'PUNCTUATION': _('must contain %(PUNCTUATION)s or more symbols'),
+    }
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.rules = [(category, policy[category]) for category in PASSWORD_CATEGORIES
+                      if policy.get(category, 0) > 0]
+
+    def violations(self, value):
+        """
+        Returns the categories of ``value`` with too few distinct characters.
+        """
+        if not self.rules:
+            return []
+        counts = dict.fromkeys(PASSWORD_CATEGORIES, 0)
+        lookup = _ascii_categories.get
+        for char in set(value):
+            category = lookup(char)
+            if category is None:
+                if char <= '\x7f':
+                    continue
+                category = get_char_category(char)
+                if category is None:
+                    continue
+            counts[category] += 1
+        return [category for category, minimum in self.rules if counts[category] < minimum]
+
+
+_password_policy = None
+
+
+def get_password_policy():
+    """
+    Returns the compiled ``USERS_PASSWORD_POLICY``, an empty policy if
+    ``USERS_CHECK_PASSWORD_COMPLEXITY`` is off.
+    """
+    global _password_policy
+    if _password_policy is None:
+        if settings.USERS_CHECK_PASSWORD_COMPLEXITY:
+            _password_policy = PasswordPolicy(settings.USERS_PASSWORD_POLICY)
+        else:
+            _password_policy = PasswordPolicy({})
+    return _password_policy
+
+
+def reset_password_policy(**kwargs):
+    global _password_policy
+    if kwargs['setting'] in ('USERS_PASSWORD_POLICY', 'USERS_CHECK_PASSWORD_COMPLEXITY'):
+        _password_policy = None
+
+
+setting_changed.connect(reset_password_policy)
+
+
 class ComplexityValidator(object):
+    """
+    Checks passwords against a ``PasswordPolicy`` (``USERS_PASSWORD_POLICY``
+    by default), reporting every rule a password breaks.
+    """
     code = 'complexity'
     message = _('Weak password, %s')
 
-    def __init__(self):
-        self.password_policy = settings.USERS_PASSWORD_POLICY
+    def __init__(self, password_policy=None):
+        self._policy = None if password_policy is None else PasswordPolicy(password_policy)
 
-    def __call__(self, value):
-        if not settings.USERS_CHECK_PASSWORD_COMPLEXITY:  # pragma: no cover
-            return
+    @property
+    def policy(self):
+        return self._policy or get_password_policy()
 
-        uppercase, lowercase, digits, non_ascii, punctuation = set(), set(), set(), set(), set()
-
-        for char in value:
-            if char.isupper():
-                uppercase.add(char)
-            elif char.islower():
-                lowercase.add(char)
-            elif char.isdigit():
-                digits.add(char)
-            elif char in string.punctuation:
-                punctuation.add(char)
-            else:
-                non_ascii.add(char)
-
-        if len(uppercase) < self.password_policy.get('UPPER', 0):
-            raise forms.ValidationError(
-                self.message % _('must contain %(UPPER)s or '
-                                 'more uppercase characters (A-Z)') % self.password_policy,
-                code=self.code)
-        elif len(lowercase) < self.password_policy.get('LOWER', 0):
-            raise forms.ValidationError(
-                self.message % _('Must contain %(LOWER)s or '
-                                 'more lowercase characters (a-z)') % self.password_policy,
-                code=self.code)
-        elif len(digits) < self.password_policy.get('DIGITS', 0):
-            raise forms.ValidationError(
-                self.message % _('must contain %(DIGITS)s or '
-                                 'more numbers (0-9)') % self.password_policy,
-                code=self.code)
-        elif len(punctuation) < self.password_policy.get('PUNCTUATION', 0):
-            raise forms.ValidationError(
-                self.message % _('must contain %(PUNCTUATION)s or more '
-                                 'symbols') % self.password_policy,
-                code=self.code)
+    def __call__(self, value):
+        error = self.check(self.policy, value)
+        if error is not None:
+            raise error
+
+    def check(self, policy, value):
+        violations = policy.violations(value)
+        if violations:
+            return forms.ValidationError([
+                forms.ValidationError(
+                    self.message % (policy.messages[category] % policy.policy), code=self.code)
+                for category in violations])
+
+    def validate_many(self, passwords):
+        """
+        Validates an iterable of passwords, returning the ``ValidationError``
+        of each invalid password keyed by its position.
+        """
+        policy = self.policy
+        errors = {}
+        for i, password in enumerate(passwords):
+            error = self.check(policy, password)
+            if error is not None:
+                errors[i] = error
+        return errors
 
 
 complexity_validator = ComplexityValidator()
 
 
+class BreachedPasswordValidator(object):
+    """
+    Rejects passwords found in the breached passwords file
+    ``USERS_BREACHED_PASSWORDS_FILE``, see ``build_breached_passwords``.
+    """
+    code = 'breached'
+    message = _('This password has appeared in a data breach, please choose a different one.')
+
+    def __init__(self, path=None):
+        self.path = path
+
+    def __call__(self, value):
+        path = self.path or settings.USERS_BREACHED_PASSWORDS_FILE
+        if path and value in get_breached_password_index(path):
+            raise forms.ValidationError(self.message, code=self.code)
+
+
+def reset_breached_password_indexes(**kwargs):
+    if kwargs['setting'] == 'USERS_BREACHED_PASSWORDS_FILE':
+        close_breached_password_indexes()
+
+
+setting_changed.connect(reset_breached_password_indexes)
+
+breached_password_validator = BreachedPasswordValidator()
+
+
 class PasswordField(forms.CharField):
     widget = forms.PasswordInput()
-    default_validators = [length_validator, complexity_validator, ]
+    default_validators = [length_validator, complexity_validator, breached_password_validator]
 
 
 class HoneyPotField(forms.BooleanField):
@@ -100,13 +214,89 @@ class HoneyPotField(forms.BooleanField):
             raise forms.ValidationError(_('Doh! You are a robot!'))
 
 
+_email_domains = {}
+
+
+def get_email_domains(name):
+    """
+    Returns the ``DomainList`` of ``USERS_EMAIL_DOMAINS_<name>`` and
+    ``USERS_EMAIL_DOMAINS_<name>_FILE``, e.g. ``get_email_domains('BLACKLIST')``.
+    """
+    domains = _email_domains.get(name)
+    if domains is None:
+        domains = _email_domains[name] = DomainList(
+            getattr(settings, 'USERS_EMAIL_DOMAINS_%s' % name),
+            getattr(settings, 'USERS_EMAIL_DOMAINS_%s_FILE' % name))
+    return domains
+
+
+def reset_email_domains(**kwargs):
+    if kwargs['setting'].startswith('USERS_EMAIL_DOMAINS_'):
+        _email_domains.clear()
+
+
+setting_changed.connect(reset_email_domains)
+
+
+class SignedTimestampField(forms.CharField):
+    """
+    A hidden field holding the signed time the form was rendered at, which
+    rejects forms submitted faster than ``USERS_SPAM_MIN_SUBMIT_TIME`` or
+    later than ``USERS_SPAM_MAX_SUBMIT_TIME`` seconds after.
+    """
+    widget = forms.HiddenInput
+    salt = 'users.fields.SignedTimestampField'
+    default_error_messages = {
+        'invalid': _('Invalid form submission, please reload the page and try again.'),
+        'too_fast': _('The form was submitted too quickly, please try again.'),
+        'expired': _('The form has expired, please reload the page and try again.'),
+    }
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('initial', self.get_timestamp)
+        kwargs.setdefault('label', '')
+        super(SignedTimestampField, self).__init__(*args, **kwargs)
+        self.error_messages['required'] = self.error_messages['invalid']
+
+    def get_timestamp(self):
+        return signing.Signer(salt=self.salt).sign('%d' % time.time())
+
+    def clean(self, value):
+        value = super(SignedTimestampField, self).clean(value)
+        try:
+            rendered = int(signing.Signer(salt=self.salt).unsign(value))
+        except (signing.BadSignature, ValueError):
+            raise forms.ValidationError(self.error_messages['invalid'], code='invalid')
+
+        elapsed = time.time() - rendered
+        min_time = settings.USERS_SPAM_MIN_SUBMIT_TIME
+        max_time = settings.USERS_SPAM_MAX_SUBMIT_TIME
+        if min_time and elapsed < min_time:
+            raise forms.ValidationError(self.error_messages['too_fast'], code='too_fast')
+        if max_time and elapsed > max_time:
+            raise forms.ValidationError(self.error_messages['expired'], code='expired')
+        return value
+
+
 class EmailDomainValidator(object):
     message = _('Sorry, %s emails are not allowed. Please use a different email address.')
     code = 'invalid'
 
-    def __init__(self, ):
-        self.domain_blacklist = settings.USERS_EMAIL_DOMAINS_BLACKLIST
-        self.domain_whitelist = settings.USERS_EMAIL_DOMAINS_WHITELIST
+    def __init__(self, blacklist=None, whitelist=None):
+        self._blacklist = None if blacklist is None else DomainList(blacklist)
+        self._whitelist = None if whitelist is None else DomainList(whitelist)
+
+    @property
+    def domain_blacklist(self):
+        if self._blacklist is not None:
+            return self._blacklist
+        return get_email_domains('BLACKLIST')
+
+    @property
+    def domain_whitelist(self):
+        if self._whitelist is not None:
+            return self._whitelist
+        return get_email_domains('WHITELIST')
 
     def __call__(self, value):
         if not settings.USERS_VALIDATE_EMAIL_DOMAIN:  # pragma: no cover
@@ -118,15 +308,62 @@ class EmailDomainValidator(object):
         value = force_text(value)
         user_part, domain_part = value.rsplit('@', 1)
 
-        if self.domain_blacklist and domain_part in self.domain_blacklist:
+        if domain_part in self.domain_blacklist:
             raise forms.ValidationError(self.message % domain_part, code=self.code)
 
-        if self.domain_whitelist and domain_part not in self.domain_whitelist:
+        whitelist = self.domain_whitelist
+        if whitelist and domain_part not in whitelist:
             raise forms.ValidationError(self.message % domain_part, code=self.code)
 
 
 validate_email_domain = EmailDomainValidator()
 
 
+class MXRecordValidator(object):
+    """
+    Rejects emails whose domain doesn't accept mail, when
+    ``USERS_VALIDATE_EMAIL_MX`` is set. Domains which can't be resolved in
+    time are accepted.
+    """
+    message = _('Sorry, %s does not accept emails. Please use a different email address.')
+    code = 'invalid'
+
+    def __call__(self, value):
+        error = self.validate_many([value]).get(0)
+        if error is not None:
+            raise error
+
+    def validate_many(self, emails):
+        """
+        Validates an iterable of emails, looking up their domains
+        concurrently. Returns the ``ValidationError`` of each rejected email
+        keyed by its position.
+        """
+        if not settings.USERS_VALIDATE_EMAIL_MX:
+            return {}
+        domains = {}
+        for i, value in enumerate(emails):
+            value = force_text(value)
+            if '@' in value:
+                domain = normalize_domain(value.rsplit('@', 1)[1])
+                if domain:
+                    domains[i] = domain
+        results = check_domains(set(domains.values()))
+        return dict(
+            (i, forms.ValidationError(self.message % domain, code=self.code))
+            for i, domain in domains.items() if results[domain] is False)
+
+
+validate_email_mx = MXRecordValidator()
+
+
 class UsersEmailField(forms.EmailField):
     default_validators = [validate_email, validate_email_domain]
+
+    def clean(self, value):
+        value = super(UsersEmailField, self).clean(value)
+        # only look up the domains of emails which passed the other checks,
+        # the validators all run even if one of them fails.
+        if value:
+            validate_email_mx(value)
+        return value
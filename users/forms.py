@@ -1,10 +1,11 @@
 from django import forms
 from django.contrib.auth import get_user_model
 from django.contrib.auth.forms import ReadOnlyPasswordHashField
+from django.forms.utils import ErrorDict
 from django.utils.translation import ugettext_lazy as _
 
 from .conf import settings
-from .fields import HoneyPotField, PasswordField, UsersEmailField
+from .fields import HoneyPotField, PasswordField, SignedTimestampField, UsersEmailField
 
 
 class UserCreationForm(forms.ModelForm):
@@ -28,15 +29,23 @@ class UserCreationForm(forms.ModelForm):
 
         # Since User.email is unique, this check is redundant,
         # but it sets a nicer error message than the ORM. See #13147.
-        email = self.cleaned_data['email']
+        manager = get_user_model().base_objects
+        email = manager.normalize_email(self.cleaned_data['email'])
+        if manager.filter(normalized_email=manager.normalize_email_case(email)).exists():
+            raise forms.ValidationError(
+                self.error_messages['duplicate_email'],
+                code='duplicate_email',
+            )
+        return email
+
+    def validate_unique(self):
+        exclude = self._get_validation_exclusions()
+        # clean_email() has checked the email already
+        exclude.append('email')
         try:
-            get_user_model()._default_manager.get(email=email)
-        except get_user_model().DoesNotExist:
-            return email
-        raise forms.ValidationError(
-            self.error_messages['duplicate_email'],
-            code='duplicate_email',
-        )
+            self.instance.validate_unique(exclude=exclude)
+        except forms.ValidationError as e:
+            self._update_errors(e)
 
     def clean_password2(self):
 
@@ -101,7 +110,43 @@ class RegistrationFormTermsOfService(RegistrationForm):
 class RegistrationFormHoneypot(RegistrationForm):
     """
     Subclass of ``RegistrationForm`` which adds a honeypot field
-    for Spam Prevention
+    for Spam Prevention, and a signed timestamp field if
+    ``USERS_SPAM_TIMING_CHECK`` is set.
 
     """
     accept_terms = HoneyPotField()
+    timestamp = SignedTimestampField()
+
+    spam_protection_fields = ('accept_terms', 'timestamp')
+
+    def __init__(self, *args, **kwargs):
+        super(RegistrationFormHoneypot, self).__init__(*args, **kwargs)
+        if not settings.USERS_SPAM_TIMING_CHECK:
+            del self.fields['timestamp']
+
+    def full_clean(self):
+        # reject spam before the other fields are cleaned, which queries the
+        # database and hashes passwords.
+        if self.is_bound:
+            errors = self.check_spam_protection()
+            if errors:
+                self._errors = ErrorDict()
+                self.cleaned_data = {}
+                for name, error in errors:
+                    self.add_error(name, error)
+                return
+        super(RegistrationFormHoneypot, self).full_clean()
+
+    def check_spam_protection(self):
+        errors = []
+        for name in self.spam_protection_fields:
+            field = self.fields.get(name)
+            if field is None:
+                continue
+            value = field.widget.value_from_datadict(self.data, self.files, self.add_prefix(name))
+            try:
+                field.clean(value)
+            except forms.ValidationError as e:
+                # hidden fields' errors are shown with the form's errors
+                errors.append((None if field.widget.is_hidden else name, e))
+        return errors
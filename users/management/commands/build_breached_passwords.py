@@ -0,0 +1,80 @@
+import io
+import os
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from users.breached import parse_hash, password_digest, write_breached_password_file
+
+
+class Command(BaseCommand):
+    help = ('Converts a breached passwords corpus ("<SHA-1 hex>[:<count>]" lines) '
+            'into the sorted binary file read by USERS_BREACHED_PASSWORDS_FILE.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path',
+            help='Corpus to read, "-" for stdin.')
+        parser.add_argument(
+            'output',
+            help='Breached passwords file to write.')
+        parser.add_argument(
+            '--plaintext', action='store_true',
+            help='The corpus lists passwords rather than SHA-1 hashes.')
+        parser.add_argument(
+            '--record-length', type=int, default=10,
+            help='Number of bytes of each SHA-1 digest to keep (1-20).')
+        parser.add_argument(
+            '--chunk-size', type=int, default=10 ** 7,
+            help='Number of hashes sorted in memory at a time.')
+        parser.add_argument(
+            '--min-count', type=int, default=0,
+            help='Skip hashes seen fewer times than this in the corpus.')
+
+    def handle(self, *args, **options):
+        record_length = options['record_length']
+        if not 1 <= record_length <= 20:
+            raise CommandError('--record-length must be between 1 and 20.')
+
+        if options['path'] == '-':
+            stream = getattr(sys.stdin, 'buffer', sys.stdin)
+        else:
+            stream = io.open(options['path'], 'rb')
+
+        # write next to the output and rename, so processes with the file
+        # open keep reading a complete one.
+        tmp = options['output'] + '.tmp'
+        start = time.time()
+        try:
+            count = write_breached_password_file(
+                self.get_digests(stream, record_length, options),
+                tmp, record_length=record_length, chunk_size=options['chunk_size'])
+        except ValueError as e:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise CommandError('Invalid corpus: %s' % e)
+        finally:
+            if options['path'] != '-':
+                stream.close()
+        os.rename(tmp, options['output'])
+
+        self.stdout.write('Wrote %d hashes in %.1fs.' % (count, time.time() - start))
+
+    def get_digests(self, stream, record_length, options):
+        min_count = options['min_count']
+        for line in stream:
+            if options['plaintext']:
+                password = line.rstrip(b'\r\n')
+                if password:
+                    yield password_digest(password, record_length)
+                continue
+            if min_count:
+                parts = line.strip().split(b':', 1)
+                if len(parts) == 2 and int(parts[1]) < min_count:
+                    continue
+            digest = parse_hash(line)
+            if digest is not None:
+                if len(digest) != 20:
+                    raise ValueError('%r is not a SHA-1 hash.' % line.strip())
+                yield digest
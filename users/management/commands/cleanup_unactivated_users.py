@@ -0,0 +1,28 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from users.conf import settings
+
+
+class Command(BaseCommand):
+    help = 'Deletes inactive users who never logged in and whose activation link has expired.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=settings.USERS_EMAIL_CONFIRMATION_TIMEOUT_DAYS,
+            help='Only delete users who joined more than this many days ago.')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Maximum number of users deleted per transaction.')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only count the users that would be deleted.')
+
+    def handle(self, *args, **options):
+        count = get_user_model().base_objects.purge_unactivated(
+            days=options['days'], batch_size=options['batch_size'],
+            dry_run=options['dry_run'])
+        if options['dry_run']:
+            self.stdout.write('%d unactivated users would be deleted.' % count)
+        else:
+            self.stdout.write('Deleted %d unactivated users.' % count)
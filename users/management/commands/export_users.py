@@ -0,0 +1,181 @@
+import csv
+import io
+import json
+
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import six, timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from users.managers import downcast_users, get_user_type_model
+from users.registry import user_types
+
+
+def parse_when(value):
+    when = parse_datetime(value)
+    if when is None:
+        day = parse_date(value)
+        if day is None:
+            raise CommandError('"%s" is not a valid date or datetime.' % value)
+        when = parse_datetime(day.isoformat() + 'T00:00:00')
+    if timezone.is_naive(when):
+        when = timezone.make_aware(when, timezone.get_current_timezone())
+    return when
+
+
+class CSVWriter(object):
+
+    def __init__(self, stream, fields):
+        self.writer = csv.writer(stream, lineterminator='\n')
+        self.writerow(fields)
+
+    def writerow(self, values):
+        if six.PY2:
+            values = [value.encode('utf-8') for value in values]
+        self.writer.writerow(values)
+
+    def write(self, fields, values):
+        self.writerow([values.get(name, '') for name in fields])
+
+
+class JSONLinesWriter(object):
+
+    def __init__(self, stream, fields):
+        self.stream = stream
+
+    def write(self, fields, values):
+        self.stream.write(json.dumps(values, cls=DjangoJSONEncoder) + '\n')
+
+
+class Command(BaseCommand):
+    help = 'Exports users as CSV or JSON lines, reading them in chunks.'
+
+    writers = {
+        'csv': CSVWriter,
+        'jsonl': JSONLinesWriter,
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--format', choices=sorted(self.writers), default='csv',
+            help='Output format.')
+        parser.add_argument(
+            '--output',
+            help='File to write to, defaults to stdout.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=2000,
+            help='Number of users read from the database at a time.')
+        parser.add_argument(
+            '--active', action='store_true', default=None,
+            help='Only export active users.')
+        parser.add_argument(
+            '--inactive', action='store_false', dest='active',
+            help='Only export inactive users.')
+        parser.add_argument(
+            '--joined-after',
+            help='Only export users who joined at or after this date or datetime.')
+        parser.add_argument(
+            '--joined-before',
+            help='Only export users who joined before this date or datetime.')
+        parser.add_argument(
+            '--type', action='append', dest='types', default=[],
+            help='Only export users of this type, as "app_label.ModelName". Can be repeated.')
+        parser.add_argument(
+            '--subclass-fields', action='store_true',
+            help='Also export the fields of each user\'s subclass.')
+        parser.add_argument(
+            '--passwords', action='store_true',
+            help='Include password hashes.')
+
+    def handle(self, *args, **options):
+        user_model = get_user_model()
+        queryset = user_model.base_objects.order_by('pk')
+        if options['active'] is not None:
+            queryset = queryset.filter(is_active=options['active'])
+        if options['joined_after']:
+            queryset = queryset.filter(date_joined__gte=parse_when(options['joined_after']))
+        if options['joined_before']:
+            queryset = queryset.filter(date_joined__lt=parse_when(options['joined_before']))
+
+        models = list(user_types.models)
+        if options['types']:
+            try:
+                models = [apps.get_model(label) for label in options['types']]
+            except (LookupError, ValueError) as e:
+                raise CommandError(e)
+            queryset = queryset.filter(
+                user_type_id__in=[user_types.get_user_type_id(model) for model in models])
+
+        exclude = {'normalized_email', 'user_type'}
+        if not options['passwords']:
+            exclude.add('password')
+            queryset = queryset.defer('password')
+        fields = [field for field in user_model._meta.concrete_fields if field.name not in exclude]
+        names = [field.attname for field in fields] + ['user_type']
+        if options['subclass_fields']:
+            for model in models:
+                for field in self.get_subclass_fields(model):
+                    if field.attname not in names:
+                        names.append(field.attname)
+
+        if options['output']:
+            if six.PY2 and options['format'] == 'csv':
+                stream = open(options['output'], 'wb')
+            else:
+                stream = io.open(options['output'], 'w', encoding='utf-8', newline='')
+        else:
+            stream = self.stdout
+        writer = self.writers[options['format']](stream, names)
+        serialize = self.serialize_csv if options['format'] == 'csv' else self.serialize
+
+        count = 0
+        last_pk = None
+        try:
+            while True:
+                # paginate on the primary key so every chunk is an indexed
+                # range scan and only one chunk is held in memory.
+                chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+                users = list(chunk[:options['chunk_size']])
+                if not users:
+                    break
+                last_pk = users[-1].pk
+                if options['subclass_fields']:
+                    users = downcast_users(users)
+
+                for user in users:
+                    values = serialize(user, fields)
+                    model = get_user_type_model(user.user_type_id)
+                    values['user_type'] = model._meta.label if model else ''
+                    if options['subclass_fields'] and user.__class__ is not user_model:
+                        values.update(serialize(user, self.get_subclass_fields(user.__class__)))
+                    writer.write(names, values)
+                count += len(users)
+                if len(users) < options['chunk_size']:
+                    break
+        finally:
+            if stream is not self.stdout:
+                stream.close()
+
+        if options['output']:
+            self.stdout.write('Exported %d users.' % count)
+
+    def get_subclass_fields(self, model):
+        """
+        Returns the concrete fields ``model`` adds to the user model.
+        """
+        user_fields = set(field.name for field in get_user_model()._meta.concrete_fields)
+        return [field for field in model._meta.concrete_fields
+                if field.name not in user_fields
+                and not (field.remote_field and field.remote_field.parent_link)]
+
+    def serialize(self, user, fields):
+        return dict((field.attname, field.value_from_object(user)) for field in fields)
+
+    def serialize_csv(self, user, fields):
+        values = {}
+        for field in fields:
+            value = field.value_from_object(user)
+            values[field.attname] = '' if value is None else field.value_to_string(user)
+        return values
@@ -0,0 +1,143 @@
+import csv
+import io
+import json
+import multiprocessing
+import sys
+import time
+from itertools import islice
+
+import django
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import six
+
+
+def create_pool(processes):
+    """
+    Returns a pool of processes to hash passwords in. Workers are forked
+    where possible so they inherit the configured settings, otherwise they
+    set Django up again from ``DJANGO_SETTINGS_MODULE``.
+    """
+    try:
+        context = multiprocessing.get_context('fork')
+    except (AttributeError, ValueError):  # python 2, or a platform which can't fork
+        return multiprocessing.Pool(processes, initializer=django.setup)
+    return context.Pool(processes)
+
+
+def read_csv(stream):
+    for row in csv.DictReader(stream):
+        if six.PY2:
+            row = dict((key.decode('utf-8'), value.decode('utf-8')) for key, value in row.items())
+        yield row
+
+
+def read_jsonl(stream):
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+class Command(BaseCommand):
+    help = 'Imports users from a CSV (with a header row) or JSON lines file.'
+
+    readers = {
+        'csv': read_csv,
+        'jsonl': read_jsonl,
+    }
+    derived_fields = ('normalized_email', 'user_type', 'user_type_id')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', help='File to import, or "-" to read from stdin.')
+        parser.add_argument(
+            '--format', choices=sorted(self.readers),
+            help='Input format, guessed from the file extension by default.')
+        parser.add_argument(
+            '--model',
+            help='User model to create, as "app_label.ModelName". Defaults to AUTH_USER_MODEL.')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of users hashed and inserted at a time.')
+        parser.add_argument(
+            '--processes', type=int, default=multiprocessing.cpu_count(),
+            help='Number of processes hashing passwords, 1 hashes in this process.')
+        parser.add_argument(
+            '--hashed', action='store_true',
+            help='Store passwords verbatim, they are already hashed.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or path.rpartition('.')[2].lower()
+        if file_format not in self.readers:
+            raise CommandError('Unknown input format, use --format to set it.')
+
+        if options['model']:
+            try:
+                model = apps.get_model(options['model'])
+            except (LookupError, ValueError) as e:
+                raise CommandError(e)
+            if not issubclass(model, get_user_model()):
+                raise CommandError('%s is not a user model.' % options['model'])
+        else:
+            model = get_user_model()
+
+        pool = None
+        if not options['hashed'] and options['processes'] > 1:
+            pool = create_pool(options['processes'])
+
+        if path == '-':
+            stream = sys.stdin
+        elif six.PY2 and file_format == 'csv':
+            stream = open(path, 'rb')
+        else:
+            stream = io.open(path, encoding='utf-8', newline='')
+
+        rows = self.get_rows(model, self.readers[file_format](stream))
+        count = 0
+        started = time.time()
+        try:
+            while True:
+                chunk = list(islice(rows, options['batch_size']))
+                if not chunk:
+                    break
+                count += model.base_objects.bulk_create_users(
+                    chunk, batch_size=options['batch_size'],
+                    hashed=options['hashed'], pool=pool)
+                if options['verbosity'] > 1:
+                    self.stdout.write('Imported %d users...' % count)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            if stream is not sys.stdin:
+                stream.close()
+
+        elapsed = time.time() - started
+        self.stdout.write('Imported %d users in %.2fs (%.1f users/s).' % (
+            count, elapsed, count / elapsed if elapsed else 0))
+
+    def get_rows(self, model, rows):
+        """
+        Converts text values to python values, blank values are left out so
+        that model defaults apply. The ``user_type`` column written by
+        ``export_users`` is ignored, it is set from ``--model``, as is
+        ``normalized_email`` which is set from ``email``.
+        """
+        for row in rows:
+            values = {}
+            for name, value in row.items():
+                if value is None or value == '' or name in self.derived_fields:
+                    continue
+                if name not in ('email', 'password') and isinstance(value, six.string_types):
+                    try:
+                        value = model._meta.get_field(name).to_python(value)
+                    except FieldDoesNotExist:
+                        raise CommandError('Unknown field "%s".' % name)
+                    except ValidationError as e:
+                        raise CommandError('Invalid %s for %s: %s' % (
+                            name, row.get('email'), '; '.join(e.messages)))
+                values[name] = value
+            yield values
@@ -0,0 +1,14 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from users.bloom import build_email_filter
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the Bloom filter of registered emails used by email_may_exist().'
+
+    def handle(self, *args, **options):
+        emails = get_user_model().base_objects.order_by().values_list(
+            'email', flat=True).iterator()
+        count = build_email_filter(emails)
+        self.stdout.write('Added %d emails to the filter.' % count)
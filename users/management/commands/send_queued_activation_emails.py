@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from users.dispatch import OutboxBackend
+
+
+class Command(BaseCommand):
+    help = 'Sends the activation emails queued by the OutboxBackend.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--limit', type=int, default=100,
+            help='Maximum number of emails to send per batch.')
+        parser.add_argument(
+            '--loop', action='store_true',
+            help='Keep polling the outbox instead of exiting once it is drained.')
+        parser.add_argument(
+            '--interval', type=float, default=5,
+            help='Seconds to wait between polls when running with --loop.')
+
+    def handle(self, *args, **options):
+        backend = OutboxBackend()
+        while True:
+            processed = 0
+            # only the emails due now, failed emails are retried on the next
+            # poll even if their retry delay has already passed.
+            due = timezone.now()
+            while True:
+                count = backend.process(limit=options['limit'], due=due)
+                processed += count
+                if count < options['limit']:
+                    break
+
+            if processed or not options['loop']:
+                self.stdout.write(
+                    'Sent %(sent)d activation emails (%(retried)d retries, %(failed)d failed, '
+                    '%(queue_depth)d queued, %(avg_send_latency).3fs average send time).'
+                    % backend.stats())
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
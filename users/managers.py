@@ -1,12 +1,148 @@
+from collections import defaultdict
+from datetime import timedelta
+from itertools import islice
+
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import BaseUserManager
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import router, transaction
+from django.db.models import F, Q
+from django.db.models.query import ModelIterable, QuerySet
 from django.utils import timezone
+from django.utils.encoding import force_text
 
-from model_utils.managers import InheritanceQuerySet
+from model_utils.managers import InheritanceIterable, InheritanceQuerySet
 
 from .conf import settings
+from .registry import user_types
+from .signals import send_user_signal, users_bulk_activated
+
+
+def get_user_type_model(user_type_id):
+    """
+    Returns the model class recorded by a ``user_type_id``, or ``None`` if
+    the content type no longer exists.
+    """
+    if user_type_id is None:
+        return None
+    model = user_types.get_model(user_type_id)
+    if model is not None:
+        return model
+    try:
+        return ContentType.objects.get_for_id(user_type_id).model_class()
+    except ContentType.DoesNotExist:
+        return None
+
+
+def user_types_cache_key(model):
+    return 'users.user_types.%s' % model._meta.label_lower
+
+
+def invalidate_user_types(model):
+    """
+    Drops the cached user types of ``model`` and its parents, e.g. when
+    users are deleted and a type may have no users left.
+    """
+    cache.delete_many([user_types_cache_key(parent) for parent in
+                       [model] + model._meta.get_parent_list()])
+
+
+def user_cache_version_key(user_id):
+    return 'users.user.version.%s' % user_id
+
+
+def invalidate_cached_users(user_ids, using=None):
+    """
+    Drops the cache versions of the given users, so the users cached by
+    ``EmailBackend.get_user()`` are reloaded on the next request.
+    """
+    keys = [user_cache_version_key(user_id) for user_id in user_ids]
+    cache.delete_many(keys)
+    # until the transaction commits, a concurrent get_user() can still read
+    # and cache the old rows.
+    transaction.on_commit(lambda: cache.delete_many(keys), using=using)
+
+
+def downcast_users(users, using=None):
+    """
+    Downcasts a list of loaded users to the models recorded in their
+    ``user_type``, issuing one ``pk__in`` query per child model present
+    in ``users``. Users are returned in their original order.
+    """
+    pks_by_model = defaultdict(list)
+    for user in users:
+        model = get_user_type_model(user.user_type_id)
+        if model is None or model is user.__class__:
+            continue
+        if model._meta.concrete_model is user._meta.concrete_model:
+            # proxy models share the same table, no need to query.
+            user.__class__ = model
+        elif issubclass(model, user.__class__):
+            pks_by_model[model].append(user.pk)
+
+    children = {}
+    for model, pks in pks_by_model.items():
+        for child in model._base_manager.using(using).filter(pk__in=pks):
+            children[child.pk] = child
+
+    return [children.get(user.pk, user) for user in users]
+
+
+class UserTypeIterable(ModelIterable):
+    """
+    Iterable which reads the base table only and downcasts each chunk of
+    rows by ``user_type_id``, rather than LEFT JOINing every subclass table.
+    """
+    chunk_size = 500
+
+    def __iter__(self):
+        queryset = self.queryset
+        attrs = tuple(queryset.query.annotations) + tuple(queryset.query.extra)
+        rows = iter(ModelIterable(queryset, chunked_fetch=self.chunked_fetch))
+        while True:
+            chunk = list(islice(rows, self.chunk_size))
+            if not chunk:
+                break
+            for obj, sub_obj in zip(chunk, downcast_users(chunk, using=queryset.db)):
+                for attr in attrs:
+                    setattr(sub_obj, attr, getattr(obj, attr))
+                yield sub_obj
+
+
+class UserQuerySet(QuerySet):
+
+    def downcast(self):
+        """
+        Returns users downcast to their concrete model using ``user_type_id``,
+        reading the base table and then each child table present in the
+        results with one ``pk__in`` query.
+        """
+        qs = self._clone()
+        qs._iterable_class = UserTypeIterable
+        return qs
+
+
+class UserInheritanceQuerySet(UserQuerySet, InheritanceQuerySet):
+
+    def select_subclasses(self, *subclasses):
+        qs = super(UserInheritanceQuerySet, self).select_subclasses(*subclasses)
+        qs._iterable_class = InheritanceIterable
+        return qs
+
+    def downcast(self):
+        qs = super(UserInheritanceQuerySet, self).downcast()
+        if getattr(qs, 'subclasses', False):
+            # drop the joins added by select_subclasses()
+            qs.query.select_related = False
+            qs.subclasses = []
+        return qs
+
+    select_subclasses_by_type = downcast
 
 
 class UserManager(BaseUserManager):
+    _queryset_class = UserQuerySet
 
     def get_queryset(self):
         """
@@ -20,6 +156,184 @@ class UserManager(BaseUserManager):
 
     get_query_set = get_queryset
 
+    @classmethod
+    def normalize_email_case(cls, email):
+        """
+        Returns the case-insensitive lookup key stored in ``normalized_email``.
+        """
+        return force_text(email or '').strip().lower()
+
+    def get_by_natural_key(self, username):
+        """
+        Looks users up by the indexed ``normalized_email``, so logins are
+        case-insensitive.
+        """
+        try:
+            return self.get(normalized_email=self.normalize_email_case(username))
+        except self.model.MultipleObjectsReturned:
+            # legacy accounts which only differ by case
+            return self.get(**{self.model.USERNAME_FIELD: username})
+
+    def get_user_types(self):
+        """
+        Returns the content types of the users stored in this table, using a
+        cached distinct aggregate over the indexed ``user_type_id`` column.
+        """
+        key = user_types_cache_key(self.model)
+        user_type_ids = cache.get(key)
+        if user_type_ids is None:
+            user_type_ids = list(
+                self.get_queryset().order_by().values_list(
+                    'user_type_id', flat=True).distinct())
+            cache.set(key, user_type_ids, settings.USERS_USER_TYPES_CACHE_TIMEOUT)
+        return [ContentType.objects.get_for_id(user_type_id)
+                for user_type_id in user_type_ids if user_type_id is not None]
+
+    def bulk_activate(self, queryset_or_ids, batch_size=500, request=None):
+        """
+        Activates the given users with chunked ``UPDATE`` statements rather
+        than saving them one at a time, sending ``users_bulk_activated`` once
+        per chunk with the ids of the users it activated. Returns the number
+        of users activated.
+        """
+        if isinstance(queryset_or_ids, QuerySet):
+            user_ids = queryset_or_ids.filter(
+                is_active=False).order_by().values_list('pk', flat=True)
+        else:
+            user_ids = queryset_or_ids
+        user_ids = list(user_ids)
+
+        using = self._db or router.db_for_write(self.model)
+        manager = self.model._base_manager.using(using)
+        count = 0
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            # lock the inactive users of the chunk, so only the users this
+            # update activates are reported.
+            with transaction.atomic(using=using, savepoint=False):
+                activated = list(manager.select_for_update().filter(
+                    pk__in=batch, is_active=False).values_list('pk', flat=True))
+                if activated:
+                    manager.filter(pk__in=activated).update(is_active=True)
+            if activated:
+                invalidate_cached_users(activated, using=using)
+                send_user_signal(
+                    users_bulk_activated, sender=self.model, using=using,
+                    user_ids=activated, request=request)
+            count += len(activated)
+        return count
+
+    def bulk_create_users(self, rows, batch_size=1000, hashed=False, pool=None):
+        """
+        Creates users from an iterable of dicts of field values (``email``,
+        ``password`` and any other model fields) with chunked
+        ``bulk_create()`` inserts. Returns the number of users created.
+
+        Like ``create_user()``, emails are normalized and passwords hashed;
+        ``normalized_email`` and the user type are always set from the email
+        and the model, any values given for them are ignored.
+        Passwords are stored verbatim if ``hashed`` is set, otherwise they are
+        hashed with ``pool.map()`` when a ``multiprocessing.Pool`` is given.
+
+        For models stored in a single table, ``save()`` isn't called and no
+        signals are sent; the emails are added to the email filter once per
+        chunk. Django can't bulk insert multi-table inherited models, so those
+        users are saved one at a time in a transaction per chunk, which sends
+        the ``pre_save``/``post_save`` signals.
+        """
+        from .bloom import add_to_email_filter  # bloom imports this module
+
+        users_auto_activate = not settings.USERS_VERIFY_EMAIL
+        user_type_id = user_types.get_user_type_id(self.model)
+        # Django can't bulk insert into multi-table inherited models
+        multi_table = bool(self.model._meta.concrete_model._meta.parents)
+
+        rows = iter(rows)
+        count = 0
+        while True:
+            users, passwords = [], []
+            for row in islice(rows, batch_size):
+                row = dict(row)
+                for name in ('normalized_email', 'user_type', 'user_type_id'):
+                    row.pop(name, None)
+                email = self.normalize_email(row.pop('email', None))
+                if not email:
+                    raise ValueError('The given email must be set')
+                passwords.append(row.pop('password', None) or None)
+                row.setdefault('is_active', users_auto_activate)
+                users.append(self.model(
+                    email=email, normalized_email=self.normalize_email_case(email),
+                    user_type_id=user_type_id, **row))
+            if not users:
+                break
+
+            if hashed:
+                passwords = [password or make_password(None) for password in passwords]
+            elif pool is not None:
+                passwords = pool.map(make_password, passwords)
+            else:
+                passwords = [make_password(password) for password in passwords]
+            for user, password in zip(users, passwords):
+                user.password = password
+
+            if multi_table:
+                using = self._db or router.db_for_write(self.model)
+                with transaction.atomic(using=using):
+                    for user in users:
+                        user.save(using=using)
+            else:
+                # no batch_size, so the backend splits the chunk if it limits
+                # the rows or parameters of a query (sqlite)
+                self.bulk_create(users)
+                # save() isn't called, do what it does once for the chunk
+                for user in dict((user.user_type_id, user) for user in users).values():
+                    user._invalidate_user_types()
+                add_to_email_filter([user.email for user in users])
+            count += len(users)
+        return count
+
+    def purge_unactivated(self, days=None, batch_size=1000, dry_run=False):
+        """
+        Deletes inactive users who never logged in and joined more than
+        ``days`` ago (``USERS_EMAIL_CONFIRMATION_TIMEOUT_DAYS`` by default),
+        so their activation links have expired. Returns the number of users
+        deleted, or that would be deleted if ``dry_run`` is set.
+
+        Users are deleted in transactions of at most ``batch_size`` users
+        covering a primary key range, so rows aren't locked for long.
+        Subclass rows are deleted along with the users.
+        """
+        if days is None:
+            days = settings.USERS_EMAIL_CONFIRMATION_TIMEOUT_DAYS
+        # create_user() sets last_login to the join time, so users who never
+        # logged in have it there (or unset, e.g. if bulk created); logging
+        # in moves it past date_joined.
+        queryset = self.filter(
+            Q(last_login__isnull=True) | Q(last_login__lte=F('date_joined')),
+            is_active=False,
+            date_joined__lt=timezone.now() - timedelta(days=days),
+        ).order_by()
+        if dry_run:
+            return queryset.count()
+
+        count = 0
+        last_pk = None
+        while True:
+            chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            pks = list(chunk.order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
+            # the filter is applied again, users activated in the meantime
+            # are kept.
+            deleted = queryset.filter(pk__gte=pks[0], pk__lte=last_pk).delete()[1]
+            count += deleted.get(self.model._meta.label, 0)
+            if len(pks) < batch_size:
+                break
+        if count:
+            invalidate_user_types(self.model)
+        return count
+
     def _create_user(self, email, password,
                      is_staff, is_superuser, **extra_fields):
 
@@ -52,6 +366,9 @@ class UserManager(BaseUserManager):
 
 class UserInheritanceManager(UserManager):
     def get_queryset(self):
-        return InheritanceQuerySet(self.model).select_subclasses()
+        qs = UserInheritanceQuerySet(self.model, using=self._db)
+        if settings.USERS_RESOLVE_SUBCLASSES_BY_TYPE:
+            return qs.downcast()
+        return qs.select_subclasses()
 
     get_query_set = get_queryset
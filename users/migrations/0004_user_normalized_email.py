@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models.functions import Lower
+
+
+def populate_normalized_email(apps, schema_editor):
+    User = apps.get_model('users', 'User')
+    if User._meta.swapped:
+        return
+    User.objects.using(schema_editor.connection.alias).update(
+        normalized_email=Lower('email'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_queuedactivationemail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='normalized_email',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255),
+            preserve_default=False,
+        ),
+        migrations.RunPython(populate_normalized_email, migrations.RunPython.noop),
+    ]
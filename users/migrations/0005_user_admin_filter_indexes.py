@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('users', '0004_user_normalized_email'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='user',
+            index_together=set([('is_active', 'email'), ('is_staff', 'email'), ('is_superuser', 'email'), ('user_type', 'email')]),
+        ),
+    ]
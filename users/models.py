@@ -1,12 +1,16 @@
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.mail import send_mail
 from django.db import models
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
+from .bloom import add_to_email_filter
 from .conf import settings
-from .managers import UserInheritanceManager, UserManager
+from .managers import (UserInheritanceManager, UserManager, downcast_users,
+                       invalidate_cached_users, user_types_cache_key)
+from .registry import user_types
 
 
 class AbstractUser(AbstractBaseUser, PermissionsMixin):
@@ -14,6 +18,7 @@ class AbstractUser(AbstractBaseUser, PermissionsMixin):
 
     email = models.EmailField(
         _('email address'), max_length=255, unique=True, db_index=True)
+    normalized_email = models.CharField(max_length=255, db_index=True, editable=False)
     is_staff = models.BooleanField(
         _('staff status'), default=False,
         help_text=_('Designates whether the user can log into this admin site.'))
@@ -35,6 +40,25 @@ class AbstractUser(AbstractBaseUser, PermissionsMixin):
         verbose_name = _('User')
         verbose_name_plural = _('Users')
         abstract = True
+        # match the UserAdmin list filters, ordered by email.
+        index_together = (
+            ('user_type', 'email'),
+            ('is_active', 'email'),
+            ('is_staff', 'email'),
+            ('is_superuser', 'email'),
+        )
+
+    def __init__(self, *args, **kwargs):
+        super(AbstractUser, self).__init__(*args, **kwargs)
+        # deferred fields aren't in __dict__, don't load them
+        self._loaded_email = self.__dict__.get('email')
+
+    def get_session_auth_hash(self):
+        # users cached by EmailBackend.get_user() carry the hash instead of
+        # the password, which is only loaded (and hashed) if it's needed.
+        if 'password' not in self.__dict__ and getattr(self, '_session_auth_hash', None):
+            return self._session_auth_hash
+        return super(AbstractUser, self).get_session_auth_hash()
 
     def get_full_name(self):
         """ Return the email."""
@@ -52,10 +76,41 @@ class AbstractUser(AbstractBaseUser, PermissionsMixin):
         self.is_active = True
         self.save()
 
+    def as_subclass(self):
+        """
+        Return this user as an instance of the model recorded in its
+        ``user_type``, fetching the child row if there is one.
+        """
+        return downcast_users([self], using=self._state.db)[0]
+
     def save(self, *args, **kwargs):
+        adding = self._state.adding
+        self.normalized_email = self.__class__.base_objects.normalize_email_case(self.email)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'email' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'normalized_email'}
         if not self.user_type_id:
-            self.user_type = ContentType.objects.get_for_model(self, for_concrete_model=False)
+            self.user_type_id = user_types.get_user_type_id(self.__class__)
         super(AbstractUser, self).save(*args, **kwargs)
+        if adding:
+            self._invalidate_user_types()
+        else:
+            invalidate_cached_users([self.pk], using=self._state.db)
+        if adding or self.email != self._loaded_email:
+            add_to_email_filter([self.email])
+            self._loaded_email = self.email
+
+    def _invalidate_user_types(self):
+        """
+        Drops the cached user types of this model and its parents if they
+        don't include the type of this user yet.
+        """
+        keys = [user_types_cache_key(model) for model in
+                [self.__class__] + self._meta.get_parent_list()]
+        stale = [key for key, user_type_ids in cache.get_many(keys).items()
+                 if self.user_type_id not in user_type_ids]
+        if stale:
+            cache.delete_many(stale)
 
 
 class User(AbstractUser):
@@ -67,3 +122,22 @@ class User(AbstractUser):
 
     class Meta(AbstractUser.Meta):
         swappable = 'AUTH_USER_MODEL'
+
+
+class QueuedActivationEmail(models.Model):
+
+    """
+    An activation email waiting to be sent by the
+    ``send_queued_activation_emails`` command (see ``OutboxBackend``).
+    """
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    payload = models.TextField()
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now, null=True, db_index=True)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name = _('queued activation email')
+        verbose_name_plural = _('queued activation emails')
@@ -0,0 +1,224 @@
+import hashlib
+import logging
+import threading
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.utils.encoding import force_bytes
+from django.utils.module_loading import import_string
+
+from .conf import settings
+from .domains import normalize_domain
+
+logger = logging.getLogger(__name__)
+
+
+class ResolverError(Exception):
+    """
+    The resolver could not find out whether a domain accepts mail.
+    """
+
+
+class BaseResolver(object):
+    """
+    Base class for the resolvers set by ``USERS_EMAIL_MX_RESOLVER``.
+    """
+
+    def resolve(self, domain, timeout):
+        """
+        Returns ``(accepts_mail, ttl)`` for ``domain``, giving up after
+        ``timeout`` seconds with a ``ResolverError``.
+        """
+        raise NotImplementedError  # pragma: no cover
+
+
+class DNSPythonResolver(BaseResolver):
+    """
+    Looks up MX records with dnspython, falling back to A and AAAA
+    records (the implicit MX of RFC 5321). Domains which don't exist or
+    publish a null MX (RFC 7505) don't accept mail.
+    """
+
+    def __init__(self, negative_ttl=60 * 60):
+        try:
+            import dns.resolver
+        except ImportError:
+            raise ImproperlyConfigured('DNSPythonResolver requires dnspython.')
+        self.dns = dns
+        self.negative_ttl = negative_ttl
+
+    def query(self, domain, rdtype, timeout):
+        resolver = self.dns.resolver.Resolver()
+        resolver.lifetime = timeout
+        # dnspython >= 2.0 renamed query() to resolve()
+        query = getattr(resolver, 'resolve', None) or resolver.query
+        return query(domain, rdtype)
+
+    def resolve(self, domain, timeout):
+        deadline = time.time() + timeout
+        try:
+            for rdtype in ('MX', 'A', 'AAAA'):
+                try:
+                    answer = self.query(domain, rdtype, max(deadline - time.time(), 0.01))
+                except self.dns.resolver.NoAnswer:
+                    continue
+                if rdtype == 'MX' and all(record.exchange.to_text() == '.' for record in answer):
+                    return False, answer.rrset.ttl
+                return True, answer.rrset.ttl
+        except self.dns.resolver.NXDOMAIN:
+            pass
+        except self.dns.exception.DNSException as e:
+            raise ResolverError(e)
+        return False, self.negative_ttl
+
+
+class StaticResolver(BaseResolver):
+    """
+    Resolves domains from a ``{domain: accepts_mail}`` mapping, and other
+    domains to ``default``, without any network access.
+    """
+
+    def __init__(self, domains=None, default=True, ttl=60 * 60):
+        self.domains = domains or {}
+        self.default = default
+        self.ttl = ttl
+
+    def resolve(self, domain, timeout):
+        return self.domains.get(domain, self.default), self.ttl
+
+
+# results are cached in-process and in Django's cache, as
+# (accepts_mail, expiry timestamp) tuples.
+MAX_CACHED_RESULTS = 10000
+
+_results = {}
+_resolvers = {}
+_pool = None
+_lock = threading.Lock()
+
+
+def get_resolver():
+    """
+    Returns the ``USERS_EMAIL_MX_RESOLVER`` instance. Called when the app is
+    ready if ``USERS_VALIDATE_EMAIL_MX`` is set, so a missing resolver or
+    dnspython fails at startup rather than on every registration.
+    """
+    path = settings.USERS_EMAIL_MX_RESOLVER
+    if path not in _resolvers:
+        try:
+            resolver_class = import_string(path)
+        except ImportError as e:
+            raise ImproperlyConfigured('Could not import USERS_EMAIL_MX_RESOLVER: %s' % e)
+        _resolvers[path] = resolver_class()
+    return _resolvers[path]
+
+
+def get_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPool(settings.USERS_EMAIL_MX_WORKERS)
+        return _pool
+
+
+def cache_key(domain):
+    return 'users.mx.%s' % hashlib.md5(force_bytes(domain)).hexdigest()
+
+
+def get_cached_results(domains):
+    now = time.time()
+    results, missing = {}, []
+    with _lock:
+        for domain in domains:
+            entry = _results.get(domain)
+            if entry is not None and entry[1] > now:
+                results[domain] = entry[0]
+            else:
+                missing.append(domain)
+    if missing:
+        keys = dict((cache_key(domain), domain) for domain in missing)
+        for key, entry in cache.get_many(list(keys)).items():
+            if entry[1] > now:
+                results[keys[key]] = entry[0]
+                with _lock:
+                    _results[keys[key]] = entry
+    return results
+
+
+def store_result(domain, accepts_mail, ttl):
+    ttl = min(ttl, settings.USERS_EMAIL_MX_MAX_TTL)
+    if ttl <= 0:
+        return
+    entry = (accepts_mail, time.time() + ttl)
+    with _lock:
+        if len(_results) >= MAX_CACHED_RESULTS:
+            _results.clear()
+        _results[domain] = entry
+    cache.set(cache_key(domain), entry, int(ttl))
+
+
+def lookup(domain, resolver, timeout):
+    try:
+        accepts_mail, ttl = resolver.resolve(domain, timeout)
+    except ResolverError as e:
+        logger.warning('MX lookup for %s failed: %s', domain, e)
+        return None
+    except Exception:
+        logger.exception('MX lookup for %s failed', domain)
+        return None
+    store_result(domain, accepts_mail, ttl)
+    return accepts_mail
+
+
+def check_domains(domains, timeout=None):
+    """
+    Returns whether each of ``domains`` accepts mail, keyed by normalized
+    domain: ``True``, ``False``, or ``None`` if it couldn't be found out
+    within ``timeout`` seconds (``USERS_EMAIL_MX_TIMEOUT`` by default).
+    Uncached domains are looked up concurrently, sharing the timeout.
+    """
+    if timeout is None:
+        timeout = settings.USERS_EMAIL_MX_TIMEOUT
+    domains = set(normalize_domain(domain) for domain in domains)
+    results = get_cached_results(domains)
+    missing = [domain for domain in domains if domain not in results]
+    if missing:
+        deadline = time.time() + timeout
+        resolver, pool = get_resolver(), get_pool()
+        # lookups still running at the deadline are cached when they finish
+        pending = [(domain, pool.apply_async(lookup, (domain, resolver, timeout)))
+                   for domain in missing]
+        for domain, result in pending:
+            try:
+                results[domain] = result.get(max(deadline - time.time(), 0))
+            except TimeoutError:
+                logger.warning('MX lookup for %s timed out', domain)
+                results[domain] = None
+    return results
+
+
+def check_domain(domain, timeout=None):
+    return check_domains([domain], timeout)[normalize_domain(domain)]
+
+
+def clear_mx_cache():
+    with _lock:
+        _results.clear()
+
+
+def reset_mx(**kwargs):
+    global _pool
+    if kwargs['setting'].startswith('USERS_EMAIL_MX_'):
+        _resolvers.clear()
+        clear_mx_cache()
+        with _lock:
+            if _pool is not None:
+                _pool.close()
+                _pool = None
+
+
+setting_changed.connect(reset_mx)
@@ -0,0 +1,74 @@
+import hashlib
+
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.encoding import force_bytes
+from django.utils.functional import cached_property
+
+
+def estimate_row_count(model, using):
+    """
+    Returns the row count of ``model``'s table estimated from the database
+    statistics, or ``None`` if the backend doesn't keep one.
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+    if connection.vendor == 'postgresql':
+        sql = 'SELECT reltuples FROM pg_class WHERE oid = %s::regclass'
+        params = [connection.ops.quote_name(table)]
+    elif connection.vendor == 'mysql':
+        sql = ('SELECT table_rows FROM information_schema.tables '
+               'WHERE table_schema = DATABASE() AND table_name = %s')
+        params = [table]
+    else:
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+    # tables which were never analyzed report -1 (or 0)
+    if row and row[0] and row[0] > 0:
+        return int(row[0])
+    return None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    A paginator which stops counting at ``threshold`` rows.
+
+    Past the threshold, the count of an unfiltered queryset is estimated
+    from the database statistics where available; otherwise the exact count
+    is cached for ``cache_timeout`` seconds. ``count_is_estimate`` tells
+    whether ``count`` may be inexact.
+    """
+
+    def __init__(self, object_list, per_page, orphans=0, allow_empty_first_page=True,
+                 threshold=10000, cache_timeout=60):
+        super(EstimatedCountPaginator, self).__init__(
+            object_list, per_page, orphans, allow_empty_first_page)
+        self.threshold = threshold
+        self.cache_timeout = cache_timeout
+        self.count_is_estimate = False
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list.order_by()
+        # counting at most threshold + 1 rows is cheap, whatever the table size
+        count = queryset[:self.threshold + 1].count()
+        if count <= self.threshold:
+            return count
+
+        self.count_is_estimate = True
+        if not queryset.query.where:
+            estimate = estimate_row_count(queryset.model, queryset.db)
+            if estimate is not None:
+                return max(count, estimate)
+
+        sql, params = queryset.query.sql_with_params()
+        key = 'users.paginator.count.%s' % hashlib.md5(
+            force_bytes(repr((queryset.db, sql, params)))).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = queryset.count()
+            cache.set(key, count, self.cache_timeout)
+        return count
@@ -0,0 +1,56 @@
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+
+
+class UserTypeRegistry(object):
+    """
+    Maps the installed user models (including proxies) to the ids of their
+    ``user_type`` content types and back, so saving or downcasting a user
+    doesn't need a ``ContentType`` lookup.
+
+    The models are collected when the app is ready; their content types
+    are resolved with a single query the first time they're needed.
+    """
+
+    def __init__(self):
+        self.models = []
+        self._user_type_ids = None
+        self._models_by_id = None
+
+    def populate(self):
+        from .models import AbstractUser
+        # swapped out models are excluded by get_models()
+        self.models = [model for model in apps.get_models()
+                       if issubclass(model, AbstractUser)]
+        self.clear()
+
+    def clear(self, **kwargs):
+        self._user_type_ids = None
+        self._models_by_id = None
+
+    def _load(self):
+        content_types = ContentType.objects.get_for_models(
+            *self.models, for_concrete_models=False)
+        self._models_by_id = dict(
+            (content_type.id, model) for model, content_type in content_types.items())
+        self._user_type_ids = dict(
+            (model, content_type.id) for model, content_type in content_types.items())
+
+    def get_user_type_id(self, model):
+        if self._user_type_ids is None:
+            self._load()
+        try:
+            return self._user_type_ids[model]
+        except KeyError:
+            return ContentType.objects.get_for_model(model, for_concrete_model=False).id
+
+    def get_model(self, user_type_id):
+        """
+        Returns the registered user model of ``user_type_id``, or ``None``.
+        """
+        if self._models_by_id is None:
+            self._load()
+        return self._models_by_id.get(user_type_id)
+
+
+user_types = UserTypeRegistry()
@@ -1,7 +1,188 @@
+import copy
+import logging
+import threading
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections, transaction
 from django.dispatch import Signal
+from django.utils.six.moves import queue
+
+from .conf import settings
+
+logger = logging.getLogger(__name__)
 
 # A new user has registered.
 user_registered = Signal(providing_args=['user', 'request'])
 
 # A user has activated his or her account.
 user_activated = Signal(providing_args=['user', 'request'])
+
+# A batch of users has been activated with a single update.
+users_bulk_activated = Signal(providing_args=['user_ids', 'request'])
+
+
+def get_receiver_name(receiver):
+    name = getattr(receiver, '__qualname__', getattr(receiver, '__name__', None))
+    if name is None:
+        return repr(receiver)
+    return '%s.%s' % (receiver.__module__, name)
+
+
+class SignalDispatcher(object):
+    """
+    Sends the user signals according to ``USERS_SIGNAL_DISPATCH``:
+
+    * ``'sync'`` calls the receivers right away, like ``Signal.send()``.
+    * ``'on_commit'`` calls them once the current transaction commits.
+    * ``'background'`` queues them, once the transaction commits, for a
+      worker thread which delivers consecutive ``users_bulk_activated``
+      signals as a single batch. The request has been answered by then, so
+      receivers get ``request=None`` and a copy of the ``user``.
+
+    Each receiver call is timed, see ``receiver_stats()``.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._timings = {}
+
+    def send(self, signal, sender, using=None, **kwargs):
+        mode = settings.USERS_SIGNAL_DISPATCH
+        if mode == 'sync':
+            return self.deliver(signal, sender, kwargs, robust=False)
+        elif mode == 'on_commit':
+            transaction.on_commit(lambda: self.deliver(signal, sender, kwargs), using=using)
+        elif mode == 'background':
+            kwargs = self.detach(kwargs)
+            transaction.on_commit(lambda: self.enqueue(signal, sender, kwargs), using=using)
+        else:
+            raise ImproperlyConfigured(
+                "USERS_SIGNAL_DISPATCH must be 'sync', 'on_commit' or 'background'.")
+        return []
+
+    def detach(self, kwargs):
+        """
+        Returns the signal arguments without the objects the request goes on
+        changing after the signal is queued.
+        """
+        kwargs = dict(kwargs, request=None)
+        if kwargs.get('user') is not None:
+            kwargs['user'] = copy.copy(kwargs['user'])
+        return kwargs
+
+    def deliver(self, signal, sender, kwargs, robust=True):
+        """
+        Calls the receivers of ``signal`` one at a time, so each call can be
+        timed. Exceptions are logged rather than raised if ``robust`` is set.
+        """
+        responses = []
+        # the same (private) lookup Signal.send() uses, pinned by
+        # SignalDispatcherTest.test_deliver_calls_the_receivers_send_calls
+        for receiver in signal._live_receivers(sender):
+            start = time.time()
+            try:
+                response = receiver(signal=signal, sender=sender, **kwargs)
+            except Exception as e:
+                if not robust:
+                    raise
+                logger.exception('Receiver %s failed', get_receiver_name(receiver))
+                response = e
+            finally:
+                self._record(receiver, time.time() - start)
+            responses.append((receiver, response))
+        return responses
+
+    def _record(self, receiver, elapsed):
+        name = get_receiver_name(receiver)
+        threshold = settings.USERS_SIGNAL_SLOW_RECEIVER_THRESHOLD
+        if threshold is not None and elapsed > threshold:
+            logger.warning('Receiver %s took %.3fs', name, elapsed)
+        with self._lock:
+            calls, total, slowest = self._timings.get(name, (0, 0.0, 0.0))
+            self._timings[name] = (calls + 1, total + elapsed, max(slowest, elapsed))
+
+    def receiver_stats(self):
+        """
+        Returns the number of calls, total, average and maximum time spent
+        in each receiver, keyed by receiver name.
+        """
+        with self._lock:
+            return dict(
+                (name, {
+                    'calls': calls,
+                    'total_time': total,
+                    'avg_time': total / calls,
+                    'max_time': slowest,
+                }) for name, (calls, total, slowest) in self._timings.items())
+
+    def reset_stats(self):
+        with self._lock:
+            self._timings.clear()
+
+    def enqueue(self, signal, sender, kwargs):
+        with self._lock:
+            # the worker may have died, or not survived a fork
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._work, name='users-signals')
+                self._thread.daemon = True
+                self._thread.start()
+        self.queue.put((signal, sender, kwargs))
+
+    def _work(self):
+        while True:
+            events = [self.queue.get()]
+            while True:
+                try:
+                    events.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._deliver_events(events)
+            except Exception:
+                logger.exception('Could not deliver %d user signals', len(events))
+            finally:
+                for event in events:
+                    self.queue.task_done()
+
+    def _deliver_events(self, events):
+        try:
+            for signal, sender, kwargs in self.batch(events):
+                self.deliver(signal, sender, kwargs)
+        finally:
+            close_old_connections()
+
+    def batch(self, events):
+        """
+        Merges consecutive ``users_bulk_activated`` events of the same sender
+        and request into one.
+        """
+        batched = []
+        for signal, sender, kwargs in events:
+            if batched and signal is users_bulk_activated:
+                last_signal, last_sender, last_kwargs = batched[-1]
+                if (last_signal is signal and last_sender is sender
+                        and last_kwargs.get('request') is kwargs.get('request')):
+                    user_ids = list(last_kwargs['user_ids']) + list(kwargs['user_ids'])
+                    batched[-1] = (signal, sender, dict(last_kwargs, user_ids=user_ids))
+                    continue
+            batched.append((signal, sender, kwargs))
+        return batched
+
+    def join(self):
+        """
+        Blocks until every queued signal has been delivered.
+        """
+        self.queue.join()
+
+
+signal_dispatcher = SignalDispatcher()
+
+
+def send_user_signal(signal, sender, **kwargs):
+    """
+    Sends one of the user signals through the ``SignalDispatcher``.
+    """
+    return signal_dispatcher.send(signal, sender, **kwargs)
@@ -0,0 +1,79 @@
+import hashlib
+import time
+
+from django.core.cache import cache
+from django.utils.encoding import force_bytes
+
+from .conf import settings
+
+
+def _hash(value):
+    return hashlib.md5(force_bytes(value)).hexdigest()
+
+
+def hit(key, window):
+    """
+    Records an attempt for ``key`` and returns the number of attempts made
+    in the last ``window`` seconds. The sliding window is approximated by
+    weighting the previous fixed window by how much of it still overlaps.
+    """
+    now = time.time()
+    current = int(now // window)
+    current_key = 'users.throttle.%s.%d' % (key, current)
+    previous_key = 'users.throttle.%s.%d' % (key, current - 1)
+
+    cache.add(current_key, 0, window * 2)
+    try:
+        count = cache.incr(current_key)
+    except ValueError:  # pragma: no cover
+        # expired between add() and incr()
+        cache.set(current_key, 1, window * 2)
+        count = 1
+
+    overlap = 1 - (now % window) / float(window)
+    return count + cache.get(previous_key, 0) * overlap
+
+
+def get_client_ip(request):
+    """
+    Returns the client IP from ``USERS_CLIENT_IP_HEADER``, ``REMOTE_ADDR``
+    by default. If the header holds a list, as ``X-Forwarded-For`` does,
+    the last address (added by the closest proxy) is used.
+    """
+    value = request.META.get(settings.USERS_CLIENT_IP_HEADER, '')
+    return value.rpartition(',')[2].strip()
+
+
+def throttle_activation(request):
+    """
+    Records an activation attempt, returns ``True`` if the client IP has
+    exceeded its limit for ``USERS_ACTIVATION_RATE_LIMIT_WINDOW``.
+    """
+    limit = settings.USERS_ACTIVATION_RATE_LIMIT_PER_IP
+    if limit is None:
+        return False
+    key = 'activate.ip.%s' % _hash(get_client_ip(request))
+    return hit(key, settings.USERS_ACTIVATION_RATE_LIMIT_WINDOW) > limit
+
+
+def _rejected_token_key(uidb64, token):
+    return 'users.rejected_token.%s' % _hash('%s/%s' % (uidb64, token))
+
+
+def is_rejected_token(uidb64, token):
+    """
+    Returns ``True`` if this uid/token pair was rejected recently.
+    """
+    if not settings.USERS_ACTIVATION_REJECTED_CACHE_TIMEOUT:
+        return False
+    return cache.get(_rejected_token_key(uidb64, token)) is not None
+
+
+def reject_token(uidb64, token):
+    """
+    Remembers a rejected uid/token pair, so replays short-circuit without
+    touching the database or recomputing the HMAC.
+    """
+    timeout = settings.USERS_ACTIVATION_REJECTED_CACHE_TIMEOUT
+    if timeout:
+        cache.set(_rejected_token_key(uidb64, token), True, timeout)
@@ -1,20 +1,18 @@
 from datetime import date
+from itertools import islice
+from string import hexdigits
 
 from django.contrib.auth import get_user_model
-from django.core.mail import EmailMultiAlternatives
-from django.template.loader import render_to_string
 from django.utils import six
 from django.utils.crypto import constant_time_compare, salted_hmac
-from django.utils.encoding import force_bytes
+from django.utils.encoding import force_bytes, force_text
 from django.utils.http import base36_to_int, int_to_base36
+from django.utils.translation import get_language
 
 from .compat import urlsafe_base64_encode
 from .conf import settings
-
-try:
-    from django.contrib.sites.shortcuts import get_current_site
-except ImportError:  # pragma: no cover
-    from django.contrib.sites.models import get_current_site
+from .dispatch import (build_activation_email, get_dispatch_backend,
+                       get_request_site, send_messages)
 
 try:
     from django.db.models.signals import post_migrate
@@ -51,10 +49,13 @@ def auto_create_superuser(sender, **kwargs):
         print('Creating superuser ({0}:{1})'.format(email, password))
         User.objects.create_superuser(email, password)
 
+
 post_migrate.connect(auto_create_superuser, sender=None)
 
 
 class EmailActivationTokenGenerator(object):
+    # every other character of a SHA1 hexdigest
+    hash_length = 20
 
     def make_token(self, user):
         return self._make_token_with_timestamp(user, self._num_days(self._today()))
@@ -63,26 +64,49 @@ class EmailActivationTokenGenerator(object):
         """
         Check that a activation token is correct for a given user.
         """
+        ts = self._parse_token(token)
+        if ts is None:
+            return False
+
+        # Check that the timestamp/uid has not been tampered with
+        if not constant_time_compare(self._make_token_with_timestamp(user, ts), token):
+            return False
+
+        return True
+
+    def precheck_token(self, token):
+        """
+        Check the structure and age of an activation token without the
+        user, so malformed or expired tokens can be rejected before any
+        database access.
+        """
+        return self._parse_token(token) is not None
+
+    def _parse_token(self, token):
+        """
+        Returns the timestamp of a well-formed, unexpired token, or ``None``.
+        """
         # Parse the token
         try:
             ts_b36, hash = token.split('-')
-        except ValueError:
-            return False
+        except (AttributeError, ValueError):
+            return None
+
+        if len(hash) != self.hash_length or not all(c in hexdigits for c in hash):
+            return None
 
         try:
             ts = base36_to_int(ts_b36)
         except ValueError:
-            return False
+            return None
 
-        # Check that the timestamp/uid has not been tampered with
-        if not constant_time_compare(self._make_token_with_timestamp(user, ts), token):
-            return False
-
-        # Check the timestamp is within limit
-        if (self._num_days(self._today()) - ts) > settings.USERS_EMAIL_CONFIRMATION_TIMEOUT_DAYS:
-            return False
+        # Check the timestamp is within limit (allowing a day of clock skew
+        # for tokens made by other servers)
+        age = self._num_days(self._today()) - ts
+        if not -1 <= age <= settings.USERS_EMAIL_CONFIRMATION_TIMEOUT_DAYS:
+            return None
 
-        return True
+        return ts
 
     def _make_token_with_timestamp(self, user, timestamp):
 
@@ -105,34 +129,92 @@ class EmailActivationTokenGenerator(object):
         return date.today()
 
 
+def make_activation_job(
+        user, request, from_email=None,
+        subject_template='users/activation_email_subject.html',
+        email_template='users/activation_email.html', html_email_template=None):
+    """
+    Collects everything needed to render a user's activation email, so it
+    can be rendered later without the request.
+    """
+    token_generator = EmailActivationTokenGenerator()
+
+    current_site, protocol = get_request_site(request)
+
+    return {
+        'user_id': user.pk,
+        'email': user.email,
+        'domain': current_site.domain,
+        'site_name': current_site.name,
+        'uid': force_text(urlsafe_base64_encode(force_bytes(user.pk))),
+        'token': token_generator.make_token(user=user),
+        'protocol': protocol,
+        'language': get_language(),
+        'from_email': from_email,
+        'subject_template': subject_template,
+        'email_template': email_template,
+        'html_email_template': html_email_template,
+    }
+
+
 def send_activation_email(
         user=None, request=None, from_email=None,
         subject_template='users/activation_email_subject.html',
         email_template='users/activation_email.html', html_email_template=None):
 
     if not user.is_active and settings.USERS_VERIFY_EMAIL:
-        token_generator = EmailActivationTokenGenerator()
-
-        current_site = get_current_site(request)
-
-        context = {
-            'email': user.email,
-            'site': current_site,
-            'expiration_days': settings.USERS_EMAIL_CONFIRMATION_TIMEOUT_DAYS,
-            'user': user,
-            'uid': urlsafe_base64_encode(force_bytes(user.pk)),
-            'token': token_generator.make_token(user=user),
-            'protocol': 'https' if request.is_secure() else 'http',
-        }
-
-        subject = render_to_string(subject_template, context)
-        # email subject *must not* contain newlines
-        subject = ''.join(subject.splitlines())
-        body = render_to_string(email_template, context)
-
-        email_message = EmailMultiAlternatives(subject, body, from_email, [user.email])
-        if html_email_template is not None:
-            html_email = render_to_string(html_email_template, context)
-            email_message.attach_alternative(html_email, 'text/html')
-
-        email_message.send()
+        current_site = get_request_site(request)[0]
+        job = make_activation_job(
+            user, request, from_email, subject_template, email_template,
+            html_email_template)
+
+        backend = get_dispatch_backend()
+        if backend is not None:
+            backend.enqueue(job, user=user)
+        else:
+            build_activation_email(job, user=user, site=current_site).send()
+
+
+def send_activation_emails(
+        users, request, from_email=None,
+        subject_template='users/activation_email_subject.html',
+        email_template='users/activation_email.html', html_email_template=None,
+        batch_size=100):
+    """
+    Sends activation emails to the inactive ``users`` in chunks of
+    ``batch_size``, reusing one mail connection per chunk.
+
+    Returns the number of emails sent (or queued, if a dispatch backend is
+    configured) and a dict of the exceptions raised, keyed by email address.
+    """
+    sent, failures = 0, {}
+    if not settings.USERS_VERIFY_EMAIL:
+        return sent, failures
+
+    current_site = get_request_site(request)[0]
+    backend = get_dispatch_backend()
+
+    users = (user for user in users if not user.is_active)
+    while True:
+        chunk = list(islice(users, batch_size))
+        if not chunk:
+            break
+
+        jobs = [make_activation_job(
+            user, request, from_email, subject_template, email_template,
+            html_email_template) for user in chunk]
+
+        if backend is not None:
+            for job, user in zip(jobs, chunk):
+                backend.enqueue(job, user=user)
+            sent += len(jobs)
+            continue
+
+        messages = [build_activation_email(job, user=user, site=current_site)
+                    for job, user in zip(jobs, chunk)]
+        chunk_failures = send_messages(messages)
+        for i, e in chunk_failures.items():
+            failures[chunk[i].email] = e
+        sent += len(messages) - len(chunk_failures)
+
+    return sent, failures
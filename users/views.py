@@ -9,7 +9,8 @@ from django.views.decorators.csrf import csrf_protect
 
 from .compat import urlsafe_base64_decode
 from .conf import settings
-from .signals import user_activated, user_registered
+from .signals import send_user_signal, user_activated, user_registered
+from .throttling import is_rejected_token, reject_token, throttle_activation
 from .utils import EmailActivationTokenGenerator, send_activation_email
 
 try:
@@ -18,6 +19,18 @@ except ImportError:  # pragma: no cover
     from django.contrib.sites.models import get_current_site
 
 
+def get_login_backend():
+    """
+    Returns the backend users are logged in with after registration or
+    activation: ``EmailBackend`` if it is configured, as it authenticates
+    these users by email, otherwise Django's ``ModelBackend``.
+    """
+    backend = 'users.backends.EmailBackend'
+    if backend in settings.AUTHENTICATION_BACKENDS:
+        return backend
+    return 'django.contrib.auth.backends.ModelBackend'
+
+
 if settings.USERS_SPAM_PROTECTION:  # pragma: no cover
     from .forms import RegistrationFormHoneypot as RegistrationForm
 else:
@@ -55,8 +68,7 @@ def register(request,
         if form.is_valid():
             user = form.save()
             if settings.USERS_AUTO_LOGIN_AFTER_REGISTRATION:
-                user.backend = 'django.contrib.auth.backends.ModelBackend'
-                login(request, user)
+                login(request, user, backend=get_login_backend())
             elif not user.is_active and settings.USERS_VERIFY_EMAIL:
                 opts = {
                     'user': user,
@@ -67,7 +79,8 @@ def register(request,
                     'html_email_template': activation_email_html_template_name,
                 }
                 send_activation_email(**opts)
-                user_registered.send(sender=user.__class__, request=request, user=user)
+                send_user_signal(
+                    user_registered, sender=user.__class__, request=request, user=user)
             return redirect(post_registration_redirect)
     else:
         form = registration_form()
@@ -132,21 +145,32 @@ def activate(request,
 
     token_generator = EmailActivationTokenGenerator()
 
-    try:
-        uid = urlsafe_base64_decode(uidb64)
-        user = UserModel._default_manager.get(pk=uid)
-    except (TypeError, ValueError, OverflowError, UserModel.DoesNotExist):
-        user = None
+    if throttle_activation(request):
+        context['title'] = _('Too many activation attempts')
+        if extra_context is not None:  # pragma: no cover
+            context.update(extra_context)
+        return TemplateResponse(request, template_name, context, status=429)
+
+    user = None
+    # reject replayed, malformed and expired tokens without touching the database
+    if not is_rejected_token(uidb64, token) and token_generator.precheck_token(token):
+        try:
+            uid = urlsafe_base64_decode(uidb64)
+            user = UserModel.base_objects.only(
+                'email', 'password', 'last_login', 'is_active', 'user_type').get(pk=uid)
+        except (TypeError, ValueError, OverflowError, UserModel.DoesNotExist):
+            user = None
 
     if user is not None and token_generator.check_token(user, token):
+        user = user.as_subclass()
         user.activate()
-        user_activated.send(sender=user.__class__, request=request, user=user)
+        send_user_signal(user_activated, sender=user.__class__, request=request, user=user)
         if settings.USERS_AUTO_LOGIN_ON_ACTIVATION:
-            user.backend = 'django.contrib.auth.backends.ModelBackend'  # todo - remove this hack
-            login(request, user)
+            login(request, user, backend=get_login_backend())
             messages.info(request, 'Thanks for registering. You are now logged in.')
         return redirect(post_activation_redirect)
     else:
+        reject_token(uidb64, token)
         title = _('Email confirmation unsuccessful')
         context = {
             'title': title,